@@ -93,6 +93,15 @@ def train(args):
 
     train_dataset_group.verify_bucket_reso_steps(64)
 
+    if args.latent_random_crop:
+        train_dataset_group.enable_latent_random_crop()
+
+    if args.dynamic_token_chunks:
+        train_dataset_group.enable_dynamic_token_chunks(args.group_by_caption_length)
+
+    if args.fast_image_decode:
+        train_dataset_group.enable_fast_image_decode()
+
     if args.debug_dataset:
         train_util.debug_dataset(train_dataset_group)
         return
@@ -173,6 +182,10 @@ def train(args):
         clean_memory_on_device(accelerator.device)
 
         accelerator.wait_for_everyone()
+    elif args.cache_resized_images:
+        # latentをキャッシュしない場合、リサイズ済みの画像をキャッシュする / cache resized images if latents are not cached
+        train_dataset_group.cache_resized_images(args.max_data_loader_n_workers or None, accelerator.is_main_process)
+        accelerator.wait_for_everyone()
 
     # 学習を準備する：モデルを適切な状態にする
     training_models = []
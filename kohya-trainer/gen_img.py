@@ -44,7 +44,7 @@ from diffusers import (
 from einops import rearrange
 from tqdm import tqdm
 from torchvision import transforms
-from transformers import CLIPTextModel, CLIPTokenizer, CLIPVisionModelWithProjection, CLIPImageProcessor
+from transformers import CLIPTextModel, CLIPTextModelWithProjection, CLIPTokenizer, CLIPVisionModelWithProjection, CLIPImageProcessor
 import PIL
 from PIL import Image
 from PIL.PngImagePlugin import PngInfo
@@ -53,7 +53,7 @@ import library.model_util as model_util
 import library.train_util as train_util
 import library.sdxl_model_util as sdxl_model_util
 import library.sdxl_train_util as sdxl_train_util
-from networks.lora import LoRANetwork
+from networks.lora import LoRANetwork, apply_multi_adapters
 import tools.original_control_net as original_control_net
 from tools.original_control_net import ControlNetInfo
 from library.original_unet import UNet2DConditionModel, InferUNet2DConditionModel
@@ -302,11 +302,13 @@ class PipelineLike:
         unet: InferSdxlUNet2DConditionModel,
         scheduler: Union[DDIMScheduler, PNDMScheduler, LMSDiscreteScheduler],
         clip_skip: int,
+        clip_skip_early_exit: bool = False,
     ):
         super().__init__()
         self.is_sdxl = is_sdxl
         self.device = device
         self.clip_skip = clip_skip
+        self.clip_skip_early_exit = clip_skip_early_exit
 
         if hasattr(scheduler.config, "steps_offset") and scheduler.config.steps_offset != 1:
             deprecation_message = (
@@ -505,6 +507,7 @@ class PipelineLike:
                 uncond_prompt=negative_prompt if do_classifier_free_guidance else None,
                 max_embeddings_multiples=max_embeddings_multiples,
                 clip_skip=self.clip_skip,
+                clip_skip_early_exit=self.clip_skip_early_exit,
                 token_replacer=token_replacer,
                 device=self.device,
                 emb_normalize_mode=emb_normalize_mode,
@@ -521,6 +524,7 @@ class PipelineLike:
                     uncond_prompt=[""] * batch_size,
                     max_embeddings_multiples=max_embeddings_multiples,
                     clip_skip=self.clip_skip,
+                    clip_skip_early_exit=self.clip_skip_early_exit,
                     token_replacer=token_replacer,
                     device=self.device,
                     emb_normalize_mode=emb_normalize_mode,
@@ -1088,11 +1092,15 @@ def get_unweighted_text_embeddings(
     eos: int,
     pad: int,
     no_boseos_middle: Optional[bool] = True,
+    clip_skip_early_exit: bool = False,
 ):
     """
     When the length of tokens is a multiple of the capacity of the text encoder,
     it should be split into chunks and sent to the text encoder individually.
     """
+    # Text Encoder 2 of SDXL needs the last layer for the pool, so early exit is not applied to it
+    early_exit = clip_skip_early_exit and not isinstance(text_encoder, CLIPTextModelWithProjection)
+
     max_embeddings_multiples = (text_input.shape[1] - 2) // (chunk_length - 2)
     if max_embeddings_multiples > 1:
         text_embeddings = []
@@ -1113,10 +1121,16 @@ def get_unweighted_text_embeddings(
                         text_input_chunk[j, 1] = eos
 
             # in sdxl, value of clip_skip is same for Text Encoder 1 and 2
-            enc_out = text_encoder(text_input_chunk, output_hidden_states=True, return_dict=True)
-            text_embedding = enc_out["hidden_states"][-clip_skip]
-            if not is_sdxl:  # SD 1.5 requires final_layer_norm
-                text_embedding = text_encoder.text_model.final_layer_norm(text_embedding)
+            if early_exit:
+                text_embedding = train_util.get_hidden_states_with_early_exit(
+                    text_encoder, text_input_chunk, clip_skip, final_layer_norm=not is_sdxl
+                )
+                enc_out = {}
+            else:
+                enc_out = text_encoder(text_input_chunk, output_hidden_states=True, return_dict=True)
+                text_embedding = enc_out["hidden_states"][-clip_skip]
+                if not is_sdxl:  # SD 1.5 requires final_layer_norm
+                    text_embedding = text_encoder.text_model.final_layer_norm(text_embedding)
             if pool is None:
                 pool = enc_out.get("text_embeds", None)  # use 1st chunk, if provided
                 if pool is not None:
@@ -1136,10 +1150,16 @@ def get_unweighted_text_embeddings(
             text_embeddings.append(text_embedding)
         text_embeddings = torch.concat(text_embeddings, axis=1)
     else:
-        enc_out = text_encoder(text_input, output_hidden_states=True, return_dict=True)
-        text_embeddings = enc_out["hidden_states"][-clip_skip]
-        if not is_sdxl:  # SD 1.5 requires final_layer_norm
-            text_embeddings = text_encoder.text_model.final_layer_norm(text_embeddings)
+        if early_exit:
+            text_embeddings = train_util.get_hidden_states_with_early_exit(
+                text_encoder, text_input, clip_skip, final_layer_norm=not is_sdxl
+            )
+            enc_out = {}
+        else:
+            enc_out = text_encoder(text_input, output_hidden_states=True, return_dict=True)
+            text_embeddings = enc_out["hidden_states"][-clip_skip]
+            if not is_sdxl:  # SD 1.5 requires final_layer_norm
+                text_embeddings = text_encoder.text_model.final_layer_norm(text_embeddings)
         pool = enc_out.get("text_embeds", None)  # text encoder 1 doesn't return this
         if pool is not None:
             pool = train_util.pool_workaround(text_encoder, enc_out["last_hidden_state"], text_input, eos)
@@ -1157,6 +1177,7 @@ def get_weighted_text_embeddings(
     skip_parsing: Optional[bool] = False,
     skip_weighting: Optional[bool] = False,
     clip_skip: int = 1,
+    clip_skip_early_exit: bool = False,
     token_replacer=None,
     device=None,
     emb_normalize_mode: Optional[str] = "original",  # "original", "abs", "none"
@@ -1237,6 +1258,7 @@ def get_weighted_text_embeddings(
         eos,
         pad,
         no_boseos_middle=no_boseos_middle,
+        clip_skip_early_exit=clip_skip_early_exit,
     )
 
     prompt_weights = torch.tensor(prompt_weights, dtype=text_embeddings.dtype, device=device)
@@ -1250,6 +1272,7 @@ def get_weighted_text_embeddings(
             eos,
             pad,
             no_boseos_middle=no_boseos_middle,
+            clip_skip_early_exit=clip_skip_early_exit,
         )
         uncond_weights = torch.tensor(uncond_weights, dtype=uncond_embeddings.dtype, device=device)
 
@@ -1797,7 +1820,7 @@ def main(args):
                 network.to(dtype).to(device)
 
                 if network_pre_calc:
-                    print("backup original weights")
+                    print("prepare to restore original weights")
                     network.backup_weights()
 
                 networks.append(network)
@@ -1805,6 +1828,10 @@ def main(args):
             else:
                 network.merge_to(text_encoders, unet, weights_sd, dtype, device)
 
+        if args.network_multi_adapter and len(networks) > 1:
+            num_modules = apply_multi_adapters(networks)
+            print(f"LoRAs are computed together in {num_modules} modules")
+
     else:
         networks = []
 
@@ -1897,6 +1924,7 @@ def main(args):
         unet,
         scheduler,
         args.clip_skip,
+        args.clip_skip_early_exit,
     )
     pipe.set_control_nets(control_nets)
     pipe.set_control_net_lllites(control_net_lllites)
@@ -3153,6 +3181,12 @@ def setup_parser() -> argparse.ArgumentParser:
     parser.add_argument(
         "--network_merge", action="store_true", help="merge network weights to original model / ネットワークの重みをマージする"
     )
+    parser.add_argument(
+        "--network_multi_adapter",
+        action="store_true",
+        help="compute multiple LoRAs applied to the same module together in one down/up matmul (networks.lora only, not merged) "
+        + "/ 同じモジュールに適用された複数のLoRAを一回のdown/upのmatmulでまとめて計算する（networks.loraのみ、マージしない場合）",
+    )
     parser.add_argument(
         "--network_pre_calc",
         action="store_true",
@@ -3178,6 +3212,12 @@ def setup_parser() -> argparse.ArgumentParser:
         help="layer number from bottom to use in CLIP, default is 1 for SD1/2, 2 for SDXL "
         + "/ CLIPの後ろからn層目の出力を使う（デフォルトはSD1/2の場合1、SDXLの場合2）",
     )
+    parser.add_argument(
+        "--clip_skip_early_exit",
+        action="store_true",
+        help="do not run the unused last layers of text encoder with clip_skip (the result is the same, except for Text Encoder 2 of SDXL) "
+        + "/ clip_skip指定時にtext encoderの使わない後ろの層を実行しない（結果は同じ。SDXLのText Encoder 2には適用されない）",
+    )
     parser.add_argument(
         "--max_embeddings_multiples",
         type=int,
@@ -78,6 +78,7 @@ class BaseSubsetParams:
     caption_tag_dropout_rate: float = 0.0
     token_warmup_min: int = 1
     token_warmup_step: float = 0
+    network_multiplier: float = 1.0
 
 
 @dataclass
@@ -199,6 +200,7 @@ class ConfigSanitizer:
         "token_warmup_step": Any(float, int),
         "caption_prefix": str,
         "caption_suffix": str,
+        "network_multiplier": float,
     }
     # DO means DropOut
     DO_SUBSET_ASCENDABLE_SCHEMA = {
@@ -543,6 +545,7 @@ def generate_dataset_group_by_blueprint(dataset_group_blueprint: DatasetGroupBlu
           token_warmup_min: {subset.token_warmup_min},
           token_warmup_step: {subset.token_warmup_step},
           alpha_mask: {subset.alpha_mask},
+          network_multiplier: {subset.network_multiplier},
       """
                 ),
                 "  ",
@@ -578,6 +581,7 @@ def generate_dataset_group_by_blueprint(dataset_group_blueprint: DatasetGroupBlu
         print(f"[Dataset {i}]")
         dataset.make_buckets()
         dataset.set_seed(seed)
+        dataset.pretokenize_captions()
 
     return DatasetGroup(datasets)
 
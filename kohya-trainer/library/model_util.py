@@ -11,6 +11,9 @@ init_ipex()
 import diffusers
 from transformers import CLIPTextModel, CLIPTokenizer, CLIPTextConfig, logging
 from diffusers import AutoencoderKL, DDIMScheduler, StableDiffusionPipeline  # , UNet2DConditionModel
+from accelerate import init_empty_weights
+from accelerate.utils.modeling import set_module_tensor_to_device
+from safetensors import safe_open
 from safetensors.torch import load_file, save_file
 from library.original_unet import UNet2DConditionModel
 from library.utils import setup_logging
@@ -51,6 +54,10 @@ V2_UNET_PARAMS_CONTEXT_DIM = 1024
 DIFFUSERS_REF_MODEL_ID_V1 = "runwayml/stable-diffusion-v1-5"
 DIFFUSERS_REF_MODEL_ID_V2 = "stabilityai/stable-diffusion-2-1"
 
+# 変換済みのモデルのキャッシュ。形式を変えたらバージョンを上げる / cache of converted models. bump the version if the format is changed
+CONVERTED_MODEL_CACHE_VERSION = 1
+CONVERTED_MODEL_CACHE_COMPONENTS = ["unet", "vae", "text_encoder"]
+
 
 # region StableDiffusion->Diffusersの変換コード
 # convert_original_stable_diffusion_to_diffusers をコピーして修正している（ASL 2.0）
@@ -995,29 +1002,8 @@ def load_checkpoint_with_text_encoder_conversion(ckpt_path, device="cpu"):
     return checkpoint, state_dict
 
 
-# TODO dtype指定の動作が怪しいので確認する text_encoderを指定形式で作れるか未確認
-def load_models_from_stable_diffusion_checkpoint(v2, ckpt_path, device="cpu", dtype=None, unet_use_linear_projection_in_v2=True):
-    _, state_dict = load_checkpoint_with_text_encoder_conversion(ckpt_path, device)
-
-    # Convert the UNet2DConditionModel model.
-    unet_config = create_unet_diffusers_config(v2, unet_use_linear_projection_in_v2)
-    converted_unet_checkpoint = convert_ldm_unet_checkpoint(v2, state_dict, unet_config)
-
-    unet = UNet2DConditionModel(**unet_config).to(device)
-    info = unet.load_state_dict(converted_unet_checkpoint)
-    print(f"loading u-net: {info}")
-
-    # Convert the VAE model.
-    vae_config = create_vae_diffusers_config()
-    converted_vae_checkpoint = convert_ldm_vae_checkpoint(state_dict, vae_config)
-
-    vae = AutoencoderKL(**vae_config).to(device)
-    info = vae.load_state_dict(converted_vae_checkpoint)
-    print(f"loading vae: {info}")
-
-    # convert text_model
+def create_text_encoder_config(v2):
     if v2:
-        converted_text_encoder_checkpoint = convert_ldm_clip_checkpoint_v2(state_dict, 77)
         cfg = CLIPTextConfig(
             vocab_size=49408,
             hidden_size=1024,
@@ -1039,11 +1025,7 @@ def load_models_from_stable_diffusion_checkpoint(v2, ckpt_path, device="cpu", dt
             torch_dtype="float32",
             transformers_version="4.25.0.dev0",
         )
-        text_model = CLIPTextModel._from_config(cfg)
-        info = text_model.load_state_dict(converted_text_encoder_checkpoint)
     else:
-        converted_text_encoder_checkpoint = convert_ldm_clip_checkpoint_v1(state_dict)
-
         # logging.set_verbosity_error()  # don't show annoying warning
         # text_model = CLIPTextModel.from_pretrained("openai/clip-vit-large-patch14").to(device)
         # logging.set_verbosity_warning()
@@ -1068,11 +1050,136 @@ def load_models_from_stable_diffusion_checkpoint(v2, ckpt_path, device="cpu", dt
             projection_dim=768,
             torch_dtype="float32",
         )
-        text_model = CLIPTextModel._from_config(cfg)
-        info = text_model.load_state_dict(converted_text_encoder_checkpoint)
+    return cfg
+
+
+def _check_state_dict_keys(model, keys):
+    # similar to model.load_state_dict(), but the model may be on the meta device
+    model_keys = model.state_dict().keys()
+    missing_keys = list(model_keys - keys)
+    unexpected_keys = list(keys - model_keys)
+    if not missing_keys and not unexpected_keys:
+        return
+
+    error_msgs = []
+    if missing_keys:
+        error_msgs.insert(0, "Missing key(s) in state_dict: {}. ".format(", ".join('"{}"'.format(k) for k in missing_keys)))
+    if unexpected_keys:
+        error_msgs.insert(0, "Unexpected key(s) in state_dict: {}. ".format(", ".join('"{}"'.format(k) for k in unexpected_keys)))
+    raise RuntimeError("Error(s) in loading state_dict for {}:\n\t{}".format(model.__class__.__name__, "\n\t".join(error_msgs)))
+
+
+# load state_dict without allocating new tensors
+def _load_state_dict_on_device(model, state_dict, device, dtype=None):
+    # dtype will use fp32 as default
+    _check_state_dict_keys(model, set(state_dict.keys()))
+    for k in list(state_dict.keys()):
+        set_module_tensor_to_device(model, k, device, value=state_dict.pop(k), dtype=dtype)
+    return "<All keys matched successfully>"
+
+
+# mmapしたsafetensorsから一つずつ読み込むので、state_dict全体をメモリに載せない
+# load tensors one by one from mmapped safetensors, the whole state_dict is not loaded into memory
+def _load_safetensors_on_device(model, file, device, dtype=None):
+    with safe_open(file, framework="pt") as f:
+        keys = set(f.keys())
+        _check_state_dict_keys(model, keys)
+        for k in keys:
+            set_module_tensor_to_device(model, k, device, value=f.get_tensor(k), dtype=dtype)
+    return "<All keys matched successfully>"
+
+
+def get_converted_model_cache_dir(cache_root, source_hash, v2, unet_use_linear_projection_in_v2):
+    # 変換結果は変換の設定にも依存するので、ソースのハッシュと合わせてキーにする
+    # the converted weights depend on the conversion settings, so they are a part of the key with the hash of the source
+    name = source_hash + ("_v2" if v2 else "_v1")
+    if v2 and unet_use_linear_projection_in_v2:
+        name += "_linear"
+    return os.path.join(cache_root, f"{name}_c{CONVERTED_MODEL_CACHE_VERSION}")
+
+
+def is_converted_model_cache_available(cache_dir):
+    return all(os.path.isfile(os.path.join(cache_dir, f"{c}.safetensors")) for c in CONVERTED_MODEL_CACHE_COMPONENTS)
+
+
+def save_converted_model_cache(cache_dir, state_dicts):
+    print(f"save converted models to cache / 変換済みのモデルをキャッシュに保存します: {cache_dir}")
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        for component in CONVERTED_MODEL_CACHE_COMPONENTS:
+            tensors = {}
+            for k, v in state_dicts[component].items():
+                # torch.chunkで分割したtensorなどはメモリを共有しているのでコピーする / copy tensors sharing memory such as chunks of torch.chunk
+                v = v.contiguous()
+                if v.untyped_storage().nbytes() != v.numel() * v.element_size():
+                    v = v.clone()
+                tensors[k] = v
+
+            # 途中で中断しても不完全なファイルが残らないようにする / do not leave an incomplete file if interrupted
+            file = os.path.join(cache_dir, f"{component}.safetensors")
+            save_file(tensors, file + ".tmp")
+            os.replace(file + ".tmp", file)
+    except OSError as e:
+        print(f"failed to save converted models to cache, ignored / 変換済みのモデルをキャッシュに保存できませんでした。無視します: {e}")
+
+
+def load_models_from_stable_diffusion_checkpoint(
+    v2, ckpt_path, device="cpu", dtype=None, unet_use_linear_projection_in_v2=True, converted_model_cache_dir=None
+):
+    # dtype is applied to U-Net and VAE. Text Encoder will remain fp32 on CPU
+    # converted_model_cache_dirを指定した場合は、変換済みのモデルをキャッシュから読み込む。キャッシュがなければ変換して保存する
+    # if converted_model_cache_dir is specified, converted models are loaded from the cache. if not cached, they are converted and saved
+    unet_config = create_unet_diffusers_config(v2, unet_use_linear_projection_in_v2)
+    vae_config = create_vae_diffusers_config()
+    text_model_config = create_text_encoder_config(v2)
+
+    # 乱数で初期化せずにmeta deviceに作成する / build on the meta device without random initialization
+    with init_empty_weights():
+        unet = UNet2DConditionModel(**unet_config)
+        vae = AutoencoderKL(**vae_config)
+        text_model = CLIPTextModel._from_config(text_model_config)
+
+    if converted_model_cache_dir is not None and is_converted_model_cache_available(converted_model_cache_dir):
+        print(f"load converted models from cache / 変換済みのモデルをキャッシュから読み込みます: {converted_model_cache_dir}")
+        info = _load_safetensors_on_device(unet, os.path.join(converted_model_cache_dir, "unet.safetensors"), device, dtype)
+        print(f"loading u-net: {info}")
+        info = _load_safetensors_on_device(vae, os.path.join(converted_model_cache_dir, "vae.safetensors"), device, dtype)
+        print(f"loading vae: {info}")
+        info = _load_safetensors_on_device(text_model, os.path.join(converted_model_cache_dir, "text_encoder.safetensors"), "cpu")
+        print(f"loading text encoder: {info}")
+        return text_model, vae.to(device), unet.to(device)
+
+    _, state_dict = load_checkpoint_with_text_encoder_conversion(ckpt_path, device)
+
+    # Convert the UNet2DConditionModel model.
+    converted_unet_checkpoint = convert_ldm_unet_checkpoint(v2, state_dict, unet_config)
+
+    # Convert the VAE model.
+    converted_vae_checkpoint = convert_ldm_vae_checkpoint(state_dict, vae_config)
+
+    # convert text_model
+    if v2:
+        converted_text_encoder_checkpoint = convert_ldm_clip_checkpoint_v2(state_dict, 77)
+    else:
+        converted_text_encoder_checkpoint = convert_ldm_clip_checkpoint_v1(state_dict)
+    del state_dict
+
+    if converted_model_cache_dir is not None:
+        save_converted_model_cache(
+            converted_model_cache_dir,
+            {"unet": converted_unet_checkpoint, "vae": converted_vae_checkpoint, "text_encoder": converted_text_encoder_checkpoint},
+        )
+
+    info = _load_state_dict_on_device(unet, converted_unet_checkpoint, device, dtype)
+    print(f"loading u-net: {info}")
+
+    info = _load_state_dict_on_device(vae, converted_vae_checkpoint, device, dtype)
+    print(f"loading vae: {info}")
+
+    info = _load_state_dict_on_device(text_model, converted_text_encoder_checkpoint, "cpu")
     print(f"loading text encoder: {info}")
 
-    return text_model, vae, unet
+    return text_model, vae.to(device), unet.to(device)
 
 
 def get_model_version_str_for_sd1_sd2(v2, v_parameterization):
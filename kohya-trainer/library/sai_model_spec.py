@@ -5,7 +5,7 @@ from io import BytesIO
 import os
 from typing import List, Optional, Tuple, Union
 import safetensors
-from library.utils import setup_logging
+from library.utils import setup_logging, tensor_to_bytes_view
 setup_logging()
 import logging
 logger = logging.getLogger(__name__)
@@ -81,12 +81,10 @@ def load_bytes_in_safetensors(tensors):
 
 
 def precalculate_safetensors_hashes(state_dict):
-    # calculate each tensor one by one to reduce memory usage
+    # calculate each tensor one by one to reduce memory usage. tensor bytes are hashed directly without serializing
     hash_sha256 = hashlib.sha256()
     for tensor in state_dict.values():
-        single_tensor_sd = {"tensor": tensor}
-        bytes_for_tensor = load_bytes_in_safetensors(single_tensor_sd)
-        hash_sha256.update(bytes_for_tensor)
+        hash_sha256.update(tensor_to_bytes_view(tensor))
 
     return f"0x{hash_sha256.hexdigest()}"
 
@@ -3,6 +3,8 @@
 import argparse
 import ast
 import asyncio
+import collections
+import concurrent.futures
 import datetime
 import importlib
 import json
@@ -10,8 +12,11 @@ import logging
 import pathlib
 import re
 import shutil
+import tempfile
+import threading
 import time
 from typing import (
+    Callable,
     Dict,
     List,
     NamedTuple,
@@ -23,6 +28,7 @@ from typing import (
 from accelerate import Accelerator, InitProcessGroupKwargs, DistributedDataParallelKwargs, PartialState
 import glob
 import math
+import multiprocessing
 import os
 import random
 import hashlib
@@ -75,7 +81,7 @@ import library.model_util as model_util
 import library.huggingface_util as huggingface_util
 import library.sai_model_spec as sai_model_spec
 import library.deepspeed_utils as deepspeed_utils
-from library.utils import setup_logging, pil_resize
+from library.utils import setup_logging, pil_resize, tensor_to_bytes_view
 
 setup_logging()
 import logging
@@ -140,7 +146,15 @@ IMAGE_TRANSFORMS = transforms.Compose(
     ]
 )
 
+# cv2 (libpng etc.) decodes these formats faster than PIL
+CV2_FAST_DECODE_EXTENSIONS = [".png", ".bmp"]
+
 TEXT_ENCODER_OUTPUTS_CACHE_SUFFIX = "_te_outputs.npz"
+RESIZED_IMAGE_CACHE_SUFFIX = "_resized.npy"
+
+# 動的なcaption（shuffle等）のinput_idsをキャッシュする最大数 / max number of cached input_ids for dynamic captions (shuffle etc.)
+INPUT_IDS_CACHE_MAX_SIZE = 4096
+PRETOKENIZE_BATCH_SIZE = 1024
 
 
 class ImageInfo:
@@ -166,6 +180,7 @@ class ImageInfo:
         self.text_encoder_outputs2: Optional[torch.Tensor] = None
         self.text_encoder_pool2: Optional[torch.Tensor] = None
         self.alpha_mask: Optional[torch.Tensor] = None  # alpha mask can be flipped in runtime
+        self.resized_image_npy: Optional[str] = None  # uint8 image resized to resized_size, optional
 
 
 class BucketManager:
@@ -364,6 +379,75 @@ class AugHelper:
         return self.color_aug if use_color_aug else None
 
 
+def _rgb_to_hsv_torch(rgb: torch.Tensor) -> torch.Tensor:
+    # rgb: B,3,H,W in 0.0~1.0, returns B,3,H,W with h, s, v in 0.0~1.0 (same as colorsys)
+    r, g, b = rgb[:, 0], rgb[:, 1], rgb[:, 2]
+    maxc, argmaxc = rgb.max(dim=1)
+    minc = rgb.min(dim=1).values
+    delta = maxc - minc
+    safe_delta = torch.where(delta > 0, delta, torch.ones_like(delta))
+    h = torch.stack([((g - b) / safe_delta) % 6.0, (b - r) / safe_delta + 2.0, (r - g) / safe_delta + 4.0], dim=1)
+    h = h.gather(1, argmaxc.unsqueeze(1)).squeeze(1) / 6.0
+    h = torch.where(delta > 0, h, torch.zeros_like(h))
+    s = torch.where(maxc > 0, delta / torch.where(maxc > 0, maxc, torch.ones_like(maxc)), torch.zeros_like(maxc))
+    return torch.stack([h, s, maxc], dim=1)
+
+
+def _hsv_to_rgb_torch(hsv: torch.Tensor) -> torch.Tensor:
+    h, s, v = hsv[:, 0], hsv[:, 1], hsv[:, 2]
+    h6 = h * 6.0
+    i = torch.floor(h6)
+    f = h6 - i
+    i = i.long() % 6
+    p = v * (1.0 - s)
+    q = v * (1.0 - s * f)
+    t = v * (1.0 - s * (1.0 - f))
+    index = i.unsqueeze(1)
+    r = torch.stack([v, q, p, p, t, v], dim=1).gather(1, index)
+    g = torch.stack([t, v, v, q, p, p], dim=1).gather(1, index)
+    b = torch.stack([p, p, t, v, v, q], dim=1).gather(1, index)
+    return torch.cat([r, g, b], dim=1)
+
+
+def transform_images_on_device(images: torch.Tensor, flippeds: List[bool], color_augs: List[bool]) -> torch.Tensor:
+    r"""
+    uint8のB,H,W,C画像をデバイス上で-1.0~1.0のfloat B,C,H,Wに変換する。flipとcolor_augもバッチでまとめて行う
+    convert uint8 B,H,W,C images to float B,C,H,W in -1.0~1.0 on the device, with batched flip and color_aug.
+    color_aug follows AugHelper.color_aug: hue shift or random gamma, applied to each sample with p=0.33.
+    """
+    batch_size = images.shape[0]
+    images = images[..., :3].permute(0, 3, 1, 2).float().contiguous()  # B,C,H,W, 0.0~255.0
+
+    if any(color_augs):
+        # decide augmentation for each sample on CPU, same random sequence as AugHelper
+        hue_shifts = [0.0] * batch_size
+        gammas = [1.0] * batch_size
+        for i in range(batch_size):
+            if color_augs[i] and random.random() <= 0.33:
+                if random.random() > 0.5:
+                    hue_shifts[i] = random.uniform(-8, 8) / 180  # OpenCV hue is 0~180
+                else:
+                    gammas[i] = random.uniform(0.95, 1.05)
+
+        if any(hs != 0.0 for hs in hue_shifts):
+            hue_shifts_t = torch.tensor(hue_shifts, device=images.device, dtype=images.dtype).view(-1, 1, 1)
+            hsv = _rgb_to_hsv_torch(images / 255.0)
+            hsv = torch.stack([(hsv[:, 0] + hue_shifts_t) % 1.0, hsv[:, 1], hsv[:, 2]], dim=1)
+            shifted = torch.round(_hsv_to_rgb_torch(hsv) * 255.0)
+            images = torch.where(hue_shifts_t.unsqueeze(1) != 0.0, shifted, images)
+
+        if any(gm != 1.0 for gm in gammas):
+            gammas_t = torch.tensor(gammas, device=images.device, dtype=images.dtype).view(-1, 1, 1, 1)
+            images = torch.floor(torch.clamp(images**gammas_t, 0, 255))  # gamma=1.0 keeps the image as is
+
+    if any(flippeds):
+        flip_mask = torch.tensor(flippeds, device=images.device).view(-1, 1, 1, 1)
+        images = torch.where(flip_mask, images.flip(3), images)
+
+    images = images / 127.5 - 1.0  # same as IMAGE_TRANSFORMS
+    return images
+
+
 class BaseSubset:
     def __init__(
         self,
@@ -387,6 +471,7 @@ class BaseSubset:
         caption_suffix: Optional[str],
         token_warmup_min: int,
         token_warmup_step: Union[float, int],
+        network_multiplier: float = 1.0,
     ) -> None:
         self.image_dir = image_dir
         self.alpha_mask = alpha_mask if alpha_mask is not None else False
@@ -410,6 +495,8 @@ class BaseSubset:
         self.token_warmup_min = token_warmup_min  # step=0におけるタグの数
         self.token_warmup_step = token_warmup_step  # N（N<1ならN*max_train_steps）ステップ目でタグの数が最大になる
 
+        self.network_multiplier = network_multiplier  # サンプルごとのnetworkの適用率 / multiplier of the network for each sample
+
         self.img_count = 0
 
 
@@ -440,6 +527,7 @@ class DreamBoothSubset(BaseSubset):
         caption_suffix,
         token_warmup_min,
         token_warmup_step,
+        network_multiplier=1.0,
     ) -> None:
         assert image_dir is not None, "image_dir must be specified / image_dirは指定が必須です"
 
@@ -464,6 +552,7 @@ class DreamBoothSubset(BaseSubset):
             caption_suffix,
             token_warmup_min,
             token_warmup_step,
+            network_multiplier,
         )
 
         self.is_reg = is_reg
@@ -503,6 +592,7 @@ class FineTuningSubset(BaseSubset):
         caption_suffix,
         token_warmup_min,
         token_warmup_step,
+        network_multiplier=1.0,
     ) -> None:
         assert metadata_file is not None, "metadata_file must be specified / metadata_fileは指定が必須です"
 
@@ -527,6 +617,7 @@ class FineTuningSubset(BaseSubset):
             caption_suffix,
             token_warmup_min,
             token_warmup_step,
+            network_multiplier,
         )
 
         self.metadata_file = metadata_file
@@ -562,6 +653,7 @@ class ControlNetSubset(BaseSubset):
         caption_suffix,
         token_warmup_min,
         token_warmup_step,
+        network_multiplier=1.0,
     ) -> None:
         assert image_dir is not None, "image_dir must be specified / image_dirは指定が必須です"
 
@@ -586,6 +678,7 @@ class ControlNetSubset(BaseSubset):
             caption_suffix,
             token_warmup_min,
             token_warmup_step,
+            network_multiplier,
         )
 
         self.conditioning_data_dir = conditioning_data_dir
@@ -622,6 +715,14 @@ class BaseDataset(torch.utils.data.Dataset):
         self.subsets: List[Union[DreamBoothSubset, FineTuningSubset]] = []
 
         self.token_padding_disabled = False
+        self.fast_image_decode = False
+        self.image_transforms_on_device = False  # return uint8 HWC images, transforms are done after collate
+        self.latent_random_crop = False  # cache latents of uncropped images and random crop them in latent space
+        self.stage_stats: Optional["DatasetStageStats"] = None  # per-stage timers and counters of __getitem__
+        self.dynamic_token_chunks = False  # trim input_ids to the number of 75-token chunks needed in the batch
+        self.group_by_caption_length = False  # make batches of captions with the same number of chunks
+        self.caption_token_chunks: Dict[str, int] = {}  # image_key -> number of chunks, for group_by_caption_length
+        self.tokenizer_calls = 0  # number of tokenizer calls in this process, for stage stats
         self.tag_frequency = {}
         self.XTI_layers = None
         self.token_strings = None
@@ -652,6 +753,10 @@ class BaseDataset(torch.utils.data.Dataset):
 
         self.replacements = {}
 
+        # tokenized caption cache: key is (tokenizer index, caption)
+        self.static_input_ids: Dict[Tuple[int, str], torch.Tensor] = {}  # pre-tokenized static captions, never evicted
+        self.input_ids_cache: collections.OrderedDict = collections.OrderedDict()  # LRU cache for dynamic captions
+
         # caching
         self.caching_mode = None  # None, 'latents', 'text'
 
@@ -722,6 +827,26 @@ class BaseDataset(torch.utils.data.Dataset):
     def disable_token_padding(self):
         self.token_padding_disabled = True
 
+    def enable_fast_image_decode(self):
+        self.fast_image_decode = True
+
+    def enable_image_transforms_on_device(self):
+        self.image_transforms_on_device = True
+
+    def enable_latent_random_crop(self):
+        # bucketがないとキャッシュはcrop後のサイズになり、random_cropが固定されてしまう / without buckets, the cache would freeze the crop
+        assert self.enable_bucket, "latent_random_crop requires enable_bucket / latent_random_cropにはenable_bucketが必要です"
+        self.latent_random_crop = True
+
+    def enable_stage_stats(self, stage_stats: "DatasetStageStats"):
+        self.stage_stats = stage_stats
+
+    def enable_dynamic_token_chunks(self, group_by_caption_length=False):
+        self.dynamic_token_chunks = True
+        self.group_by_caption_length = group_by_caption_length
+        if group_by_caption_length and self.bucket_manager is not None:
+            self.shuffle_buckets()  # apply grouping to the current epoch
+
     def enable_XTI(self, layers=None, token_strings=None):
         self.XTI_layers = layers
         self.token_strings = token_strings
@@ -842,14 +967,78 @@ class BaseDataset(torch.utils.data.Dataset):
 
         return caption
 
+    def get_input_ids_cache_key(self, caption, tokenizer) -> Optional[Tuple[int, str]]:
+        # XTIのcaptionはlistなのでキャッシュしない / caption for XTI is list, not cached
+        if not isinstance(caption, str):
+            return None
+        for i, t in enumerate(self.tokenizers):
+            if t is tokenizer:
+                return (i, caption)
+        return None
+
+    def is_caption_static(self, subset: BaseSubset) -> bool:
+        # process_captionの結果が毎回同じになるか / whether process_caption always returns the same caption
+        return not (
+            subset.caption_dropout_rate > 0
+            or subset.caption_dropout_every_n_epochs > 0
+            or subset.shuffle_caption
+            or subset.token_warmup_step > 0
+            or subset.caption_tag_dropout_rate > 0
+            or subset.enable_wildcard
+            or any([type(str_to) == list for str_to in self.replacements.values()])
+        )
+
+    def pretokenize_captions(self):
+        r"""
+        静的なcaptionを事前にまとめてtokenizeしておく。動的なcaptionはget_input_idsでLRUキャッシュされる
+        tokenize static captions in batches beforehand. dynamic captions are LRU-cached in get_input_ids
+        """
+        captions = set()
+        for info in self.image_data.values():
+            subset = self.image_to_subset[info.image_key]
+            if self.is_caption_static(subset):
+                captions.add(self.process_caption(subset, info.caption))
+        if len(captions) == 0:
+            return
+
+        print(f"pre-tokenizing {len(captions)} captions.")
+        captions = sorted(captions)
+        for tokenizer_index, tokenizer in enumerate(self.tokenizers):
+            for i in range(0, len(captions), PRETOKENIZE_BATCH_SIZE):
+                batch = captions[i : i + PRETOKENIZE_BATCH_SIZE]
+                input_ids = tokenizer(
+                    batch, padding="max_length", truncation=True, max_length=self.tokenizer_max_length, return_tensors="pt"
+                ).input_ids
+                for caption, ids in zip(batch, input_ids):
+                    # same shape as tokenizing one caption
+                    self.static_input_ids[(tokenizer_index, caption)] = self.split_input_ids(ids.unsqueeze(0), tokenizer)
+
     def get_input_ids(self, caption, tokenizer=None):
         if tokenizer is None:
             tokenizer = self.tokenizers[0]
 
+        key = self.get_input_ids_cache_key(caption, tokenizer)
+        if key is not None:
+            if key in self.static_input_ids:
+                return self.static_input_ids[key]
+            if key in self.input_ids_cache:
+                self.input_ids_cache.move_to_end(key)
+                return self.input_ids_cache[key]
+
         input_ids = tokenizer(
             caption, padding="max_length", truncation=True, max_length=self.tokenizer_max_length, return_tensors="pt"
         ).input_ids
+        input_ids = self.split_input_ids(input_ids, tokenizer)
+        self.tokenizer_calls += 1
+
+        if key is not None:
+            self.input_ids_cache[key] = input_ids
+            if len(self.input_ids_cache) > INPUT_IDS_CACHE_MAX_SIZE:
+                self.input_ids_cache.popitem(last=False)
+        return input_ids
 
+    def split_input_ids(self, input_ids: torch.Tensor, tokenizer) -> torch.Tensor:
+        # 75トークンごとのchunkに分割する / split to chunks of 75 tokens
         if self.tokenizer_max_length > tokenizer.model_max_length:
             input_ids = input_ids.squeeze(0)
             iids_list = []
@@ -991,12 +1180,30 @@ class BaseDataset(torch.utils.data.Dataset):
         self._length = len(self.buckets_indices)
 
     def shuffle_buckets(self):
+        if self.group_by_caption_length:
+            self.cache_caption_token_chunks()  # before setting the seed, because process_caption may use random
+
         # set random seed for this epoch
         random.seed(self.seed + self.current_epoch)
 
         random.shuffle(self.buckets_indices)
         self.bucket_manager.shuffle()
 
+        if self.group_by_caption_length:
+            # shuffle後に安定ソートして、chunk数が同じcaptionを同じbatchにする。batchの順番はbuckets_indicesでランダムになる
+            # stable sort after shuffling to make batches of captions with the same number of chunks. the order of batches is random by buckets_indices
+            for bucket in self.bucket_manager.buckets:
+                bucket.sort(key=lambda image_key: self.caption_token_chunks[image_key])
+
+    def cache_caption_token_chunks(self):
+        # 動的なcaptionは一回処理した結果で近似する / dynamic captions are approximated by the result of processing once
+        for image_key, info in self.image_data.items():
+            if image_key in self.caption_token_chunks:
+                continue
+            subset = self.image_to_subset[image_key]
+            input_ids = self.get_input_ids(self.process_caption(subset, info.caption), self.tokenizers[0])
+            self.caption_token_chunks[image_key] = count_token_chunks(input_ids, self.tokenizers[0])
+
     def verify_bucket_reso_steps(self, min_steps: int):
         assert self.bucket_reso_steps is None or self.bucket_reso_steps % min_steps == 0, (
             f"bucket_reso_steps is {self.bucket_reso_steps}. it must be divisible by {min_steps}.\n"
@@ -1004,7 +1211,22 @@ class BaseDataset(torch.utils.data.Dataset):
         )
 
     def is_latent_cacheable(self):
-        return all([not subset.color_aug and not subset.random_crop for subset in self.subsets])
+        return all(
+            [
+                not subset.color_aug and (not subset.random_crop or (self.latent_random_crop and self.enable_bucket))
+                for subset in self.subsets
+            ]
+        )
+
+    def get_latents_cache_reso(self, info: ImageInfo, subset: BaseSubset) -> Tuple[int, int]:
+        # latent_random_cropの場合、cropせずに8の倍数に切り詰めた画像のlatentをキャッシュする
+        # in case of latent_random_crop, cache latents of the uncropped image trimmed to multiples of 8
+        if not (self.latent_random_crop and subset.random_crop and self.enable_bucket):
+            return info.bucket_reso
+        return (
+            max(info.bucket_reso[0], info.resized_size[0] // 8 * 8),
+            max(info.bucket_reso[1], info.resized_size[1] // 8 * 8),
+        )
 
     def is_text_encoder_output_cacheable(self):
         return all(
@@ -1055,21 +1277,22 @@ class BaseDataset(torch.utils.data.Dataset):
             if info.latents_npz is not None:  # fine tuning dataset
                 continue
 
+            # bucket_resoより大きい場合はlatent空間でrandom cropする / larger than bucket_reso if random crop in latent space
+            cache_reso = self.get_latents_cache_reso(info, subset)
+
             # check disk cache exists and size of latents
             if cache_to_disk:
                 info.latents_npz = os.path.splitext(info.absolute_path)[0] + ".npz"
                 if not is_main_process:  # store to info only
                     continue
 
-                cache_available = is_disk_cached_latents_is_expected(
-                    info.bucket_reso, info.latents_npz, subset.flip_aug, subset.alpha_mask
-                )
+                cache_available = is_disk_cached_latents_is_expected(cache_reso, info.latents_npz, subset.flip_aug, subset.alpha_mask)
 
                 if cache_available:  # do not add to batch
                     continue
 
             # if batch is not empty and condition is changed, flush the batch. Note that current_condition is not None if batch is not empty
-            condition = Condition(info.bucket_reso, subset.flip_aug, subset.alpha_mask, subset.random_crop)
+            condition = Condition(cache_reso, subset.flip_aug, subset.alpha_mask, subset.random_crop)
             if len(batch) > 0 and current_condition != condition:
                 batches.append((current_condition, batch))
                 batch = []
@@ -1092,7 +1315,10 @@ class BaseDataset(torch.utils.data.Dataset):
         # iterate batches: batch doesn't have image, image will be loaded in cache_batch_latents and discarded
         print("caching latents...")
         for condition, batch in tqdm(batches, smoothing=1, total=len(batches)):
-            cache_batch_latents(vae, cache_to_disk, batch, condition.flip_aug, condition.alpha_mask, condition.random_crop)
+            cache_reso = condition.reso if condition.reso != batch[0].bucket_reso else None
+            cache_batch_latents(
+                vae, cache_to_disk, batch, condition.flip_aug, condition.alpha_mask, condition.random_crop, cache_reso
+            )
 
     # weight_dtypeを指定するとText Encoderそのもの、およひ出力がweight_dtypeになる
     # SDXLでのみ有効だが、datasetのメソッドとする必要があるので、sdxl_train_util.pyではなくこちらに実装する
@@ -1157,6 +1383,48 @@ class BaseDataset(torch.utils.data.Dataset):
                 infos, tokenizers, text_encoders, self.max_token_length, cache_to_disk, input_ids1, input_ids2, weight_dtype
             )
 
+    def cache_resized_images(self, max_workers=None, is_main_process=True):
+        # latentをキャッシュできない場合（color_aug、random_crop）に、bucketのresized_sizeにリサイズ済みの画像をディスクにキャッシュする
+        # 学習時はcropとaugmentationのみ行えばよい
+        # cache images resized to resized_size of the bucket when latents cannot be cached (color_aug, random_crop)
+        # only crop and augmentation are done in training
+        if not self.enable_bucket:
+            print("resized image cache requires enable_bucket, skipped / resized画像のキャッシュにはenable_bucketが必要です")
+            return
+
+        print("caching resized images.")
+        image_infos = list(self.image_data.values())
+
+        print("checking cache validity...")
+        image_infos_to_cache: List[Tuple[ImageInfo, bool]] = []
+        for info in tqdm(image_infos):
+            if info.latents is not None or info.latents_npz is not None:  # latents are used instead of images
+                continue
+
+            subset = self.image_to_subset[info.image_key]
+            info.resized_image_npy = os.path.splitext(info.absolute_path)[0] + RESIZED_IMAGE_CACHE_SUFFIX
+            if not is_main_process:  # store to info only
+                continue
+
+            if is_disk_cached_resized_image_is_expected(
+                info.absolute_path, info.resized_image_npy, info.resized_size, subset.alpha_mask
+            ):
+                continue
+
+            image_infos_to_cache.append((info, subset.alpha_mask))
+
+        if not is_main_process:
+            return
+
+        print(f"caching resized images... {len(image_infos_to_cache)} images")
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [
+                executor.submit(cache_resized_image, info, use_alpha_mask, self.fast_image_decode)
+                for info, use_alpha_mask in image_infos_to_cache
+            ]
+            for future in tqdm(concurrent.futures.as_completed(futures), total=len(futures), smoothing=0):
+                future.result()  # raise exception if any
+
     def get_image_size(self, image_path):
         if image_path.endswith(".jxl") or image_path.endswith(".JXL"):
             return get_jxl_size(image_path)
@@ -1246,18 +1514,25 @@ class BaseDataset(torch.utils.data.Dataset):
         crop_top_lefts = []
         target_sizes_hw = []
         flippeds = []  # 変数名が微妙
+        color_augs = []
         text_encoder_outputs1_list = []
         text_encoder_outputs2_list = []
         text_encoder_pool2_list = []
+        network_multipliers = []
+
+        record = self.stage_stats.new_record() if self.stage_stats is not None else DatasetStageRecord(None)
 
         for image_key in bucket[image_index : image_index + bucket_batch_size]:
             image_info = self.image_data[image_key]
             subset = self.image_to_subset[image_key]
+            record.count("samples")
             loss_weights.append(
                 self.prior_loss_weight if image_info.is_reg else 1.0
             )  # in case of fine tuning, is_reg is always False
+            network_multipliers.append(subset.network_multiplier)
 
             flipped = subset.flip_aug and random.random() < 0.5  # not flipped or flipped with 50% chance
+            latents_crop_left_top = None  # set if random crop in latent space
 
             # image/latentsを処理する
             if image_info.latents is not None:  # cache_latents=Trueの場合
@@ -1271,6 +1546,8 @@ class BaseDataset(torch.utils.data.Dataset):
                     alpha_mask = None if image_info.alpha_mask is None else torch.flip(image_info.alpha_mask, [1])
 
                 image = None
+                record.count("latents_cache_hit")
+                record.lap("latents_load")
             elif image_info.latents_npz is not None:  # FineTuningDatasetまたはcache_latents_to_disk=Trueの場合
                 latents, original_size, crop_ltrb, flipped_latents, alpha_mask = load_latents_from_disk(image_info.latents_npz)
                 if flipped:
@@ -1282,53 +1559,87 @@ class BaseDataset(torch.utils.data.Dataset):
                     alpha_mask = torch.FloatTensor(alpha_mask)
 
                 image = None
+                record.count("latents_cache_hit")
+                if record.enabled:
+                    record.count("bytes_read", os.path.getsize(image_info.latents_npz))
+                record.lap("latents_load")
             else:
-                # 画像を読み込み、必要ならcropする
-                img, face_cx, face_cy, face_w, face_h = self.load_image_with_face_info(
-                    subset, image_info.absolute_path, subset.alpha_mask
-                )
-                im_h, im_w = img.shape[0:2]
-
-                if self.enable_bucket:
+                if image_info.resized_image_npy is not None:
+                    # リサイズ済みの画像をキャッシュから読み込み、cropのみ行う
+                    img = load_resized_image_from_disk(image_info.resized_image_npy)
+                    img, original_size, crop_ltrb = trim_and_resize_if_required(
+                        subset.random_crop, img, image_info.bucket_reso, image_info.resized_size, image_info.image_size
+                    )
+                    img = np.array(img)  # copy from memmap to modify in augmentation
+                    record.count("bytes_read", img.nbytes)  # only cropped area is read
+                    record.count("resized_image_cache_hit")
+                    record.lap("decode")
+                elif self.enable_bucket and self.fast_image_decode:
+                    # 必要な解像度に近いサイズで画像を読み込む（JPEGはDCT領域で縮小される）
+                    # load image at the size close to the required resolution (JPEG is downscaled in DCT domain)
+                    img, original_size = load_image_fast(image_info.absolute_path, subset.alpha_mask, image_info.resized_size)
+                    record.count("images_decoded")
+                    if record.enabled:
+                        record.count("bytes_read", os.path.getsize(image_info.absolute_path))
+                    record.lap("decode")
                     img, original_size, crop_ltrb = trim_and_resize_if_required(
-                        subset.random_crop, img, image_info.bucket_reso, image_info.resized_size
+                        subset.random_crop, img, image_info.bucket_reso, image_info.resized_size, original_size
                     )
+                    record.lap("crop_resize")
                 else:
-                    if face_cx > 0:  # 顔位置情報あり
-                        img = self.crop_target(subset, img, face_cx, face_cy, face_w, face_h)
-                    elif im_h > self.height or im_w > self.width:
-                        assert (
-                            subset.random_crop
-                        ), f"image too large, but cropping and bucketing are disabled / 画像サイズが大きいのでface_crop_aug_rangeかrandom_crop、またはbucketを有効にしてください: {image_info.absolute_path}"
-                        if im_h > self.height:
-                            p = random.randint(0, im_h - self.height)
-                            img = img[p : p + self.height]
-                        if im_w > self.width:
-                            p = random.randint(0, im_w - self.width)
-                            img = img[:, p : p + self.width]
-
+                    # 画像を読み込み、必要ならcropする
+                    img, face_cx, face_cy, face_w, face_h = self.load_image_with_face_info(
+                        subset, image_info.absolute_path, subset.alpha_mask
+                    )
                     im_h, im_w = img.shape[0:2]
-                    assert (
-                        im_h == self.height and im_w == self.width
-                    ), f"image size is small / 画像サイズが小さいようです: {image_info.absolute_path}"
+                    record.count("images_decoded")
+                    if record.enabled:
+                        record.count("bytes_read", os.path.getsize(image_info.absolute_path))
+                    record.lap("decode")
+
+                    if self.enable_bucket:
+                        img, original_size, crop_ltrb = trim_and_resize_if_required(
+                            subset.random_crop, img, image_info.bucket_reso, image_info.resized_size
+                        )
+                    else:
+                        if face_cx > 0:  # 顔位置情報あり
+                            img = self.crop_target(subset, img, face_cx, face_cy, face_w, face_h)
+                        elif im_h > self.height or im_w > self.width:
+                            assert (
+                                subset.random_crop
+                            ), f"image too large, but cropping and bucketing are disabled / 画像サイズが大きいのでface_crop_aug_rangeかrandom_crop、またはbucketを有効にしてください: {image_info.absolute_path}"
+                            if im_h > self.height:
+                                p = random.randint(0, im_h - self.height)
+                                img = img[p : p + self.height]
+                            if im_w > self.width:
+                                p = random.randint(0, im_w - self.width)
+                                img = img[:, p : p + self.width]
+
+                        im_h, im_w = img.shape[0:2]
+                        assert (
+                            im_h == self.height and im_w == self.width
+                        ), f"image size is small / 画像サイズが小さいようです: {image_info.absolute_path}"
 
-                    original_size = [im_w, im_h]
-                    crop_ltrb = (0, 0, 0, 0)
+                        original_size = [im_w, im_h]
+                        crop_ltrb = (0, 0, 0, 0)
+                    record.lap("crop_resize")
 
-                # augmentation
-                aug = self.aug_helper.get_augmentor(subset.color_aug)
+                # augmentation: color_aug and flip are done on the device if image_transforms_on_device is enabled
+                aug = self.aug_helper.get_augmentor(subset.color_aug) if not self.image_transforms_on_device else None
                 if aug is not None:
                     # augment RGB channels only
                     img_rgb = img[:, :, :3]
                     img_rgb = aug(image=img_rgb)["image"]
                     img[:, :, :3] = img_rgb
 
-                if flipped:
+                if flipped and not self.image_transforms_on_device:
                     img = img[:, ::-1, :].copy()  # copy to avoid negative stride problem
 
                 if subset.alpha_mask:
                     if img.shape[2] == 4:
                         alpha_mask = img[:, :, 3]  # [H,W]
+                        if flipped and self.image_transforms_on_device:
+                            alpha_mask = alpha_mask[:, ::-1]  # image is flipped on the device, but alpha mask is flipped here
                         alpha_mask = alpha_mask.astype(np.float32) / 255.0  # 0.0~1.0
                         alpha_mask = torch.FloatTensor(alpha_mask)
                     else:
@@ -1339,16 +1650,34 @@ class BaseDataset(torch.utils.data.Dataset):
                 img = img[:, :, :3]  # remove alpha channel
 
                 latents = None
-                image = self.image_transforms(img)  # -1.0~1.0のtorch.Tensorになる
+                if self.image_transforms_on_device:
+                    # uint8 HWC tensor, 1/4 size of float tensor to transfer from workers
+                    image = torch.from_numpy(np.ascontiguousarray(img))
+                else:
+                    image = self.image_transforms(img)  # -1.0~1.0のtorch.Tensorになる
                 del img
+                record.count("latents_cache_miss")
+                record.lap("augmentation")
+
+            if latents is not None and self.latent_random_crop and subset.random_crop:
+                bucket_latents_size = (image_info.bucket_reso[1] // 8, image_info.bucket_reso[0] // 8)
+                if tuple(latents.shape[1:3]) != bucket_latents_size:
+                    latents, alpha_mask, latents_crop_left_top = random_crop_latents(latents, alpha_mask, image_info.bucket_reso)
 
             images.append(image)
             latents_list.append(latents)
             alpha_mask_list.append(alpha_mask)
 
-            target_size = (image.shape[2], image.shape[1]) if image is not None else (latents.shape[2] * 8, latents.shape[1] * 8)
+            if image is None:
+                target_size = (latents.shape[2] * 8, latents.shape[1] * 8)
+            elif self.image_transforms_on_device:
+                target_size = (image.shape[1], image.shape[0])  # HWC
+            else:
+                target_size = (image.shape[2], image.shape[1])
 
-            if not flipped:
+            if latents_crop_left_top is not None:
+                crop_left_top = latents_crop_left_top  # already in flipped image if flipped
+            elif not flipped:
                 crop_left_top = (crop_ltrb[0], crop_ltrb[1])
             else:
                 # crop_ltrb[2] is right, so target_size[0] - crop_ltrb[2] is left in flipped image
@@ -1358,6 +1687,7 @@ class BaseDataset(torch.utils.data.Dataset):
             crop_top_lefts.append((int(crop_left_top[1]), int(crop_left_top[0])))
             target_sizes_hw.append((int(target_size[1]), int(target_size[0])))
             flippeds.append(flipped)
+            color_augs.append(subset.color_aug)
 
             # captionとtext encoder outputを処理する
             caption = image_info.caption  # default
@@ -1366,6 +1696,7 @@ class BaseDataset(torch.utils.data.Dataset):
                 text_encoder_outputs2_list.append(image_info.text_encoder_outputs2)
                 text_encoder_pool2_list.append(image_info.text_encoder_pool2)
                 captions.append(caption)
+                record.count("te_outputs_cache_hit")
             elif image_info.text_encoder_outputs_npz is not None:
                 text_encoder_outputs1, text_encoder_outputs2, text_encoder_pool2 = load_text_encoder_outputs_from_disk(
                     image_info.text_encoder_outputs_npz
@@ -1374,8 +1705,14 @@ class BaseDataset(torch.utils.data.Dataset):
                 text_encoder_outputs2_list.append(text_encoder_outputs2)
                 text_encoder_pool2_list.append(text_encoder_pool2)
                 captions.append(caption)
+                record.count("te_outputs_cache_hit")
+                if record.enabled:
+                    record.count("bytes_read", os.path.getsize(image_info.text_encoder_outputs_npz))
+                record.lap("te_outputs_load")
             else:
                 caption = self.process_caption(subset, image_info.caption)
+                record.count("te_outputs_cache_miss")
+                record.lap("process_caption")
                 if self.XTI_layers:
                     caption_layer = []
                     for layer in self.XTI_layers:
@@ -1388,6 +1725,7 @@ class BaseDataset(torch.utils.data.Dataset):
                     captions.append(caption)
 
                 if not self.token_padding_disabled:  # this option might be omitted in future
+                    tokenizer_calls = self.tokenizer_calls
                     if self.XTI_layers:
                         token_caption = self.get_input_ids(caption_layer, self.tokenizers[0])
                     else:
@@ -1400,6 +1738,8 @@ class BaseDataset(torch.utils.data.Dataset):
                         else:
                             token_caption2 = self.get_input_ids(caption, self.tokenizers[1])
                         input_ids2_list.append(token_caption2)
+                    record.count("tokenizer_calls", self.tokenizer_calls - tokenizer_calls)
+                    record.lap("tokenize")
 
         example = {}
         example["loss_weights"] = torch.FloatTensor(loss_weights)
@@ -1417,6 +1757,15 @@ class BaseDataset(torch.utils.data.Dataset):
             else:
                 example["input_ids"] = torch.stack(input_ids_list)
                 example["input_ids2"] = torch.stack(input_ids2_list) if len(self.tokenizers) > 1 else None
+
+                if self.dynamic_token_chunks and not self.XTI_layers:
+                    # batch内の最長のcaptionに必要なchunk数まで切り詰める / trim to the number of chunks needed by the longest caption in the batch
+                    num_chunks = count_token_chunks(example["input_ids"], self.tokenizers[0])
+                    if example["input_ids2"] is not None:
+                        num_chunks = max(num_chunks, count_token_chunks(example["input_ids2"], self.tokenizers[1]))
+                    example["input_ids"] = example["input_ids"][:, :num_chunks]
+                    if example["input_ids2"] is not None:
+                        example["input_ids2"] = example["input_ids2"][:, :num_chunks]
             example["text_encoder_outputs1_list"] = None
             example["text_encoder_outputs2_list"] = None
             example["text_encoder_pool2_list"] = None
@@ -1437,22 +1786,18 @@ class BaseDataset(torch.utils.data.Dataset):
         elif any(none_or_not):
             for i in range(len(alpha_mask_list)):
                 if alpha_mask_list[i] is None:
-                    if images[i] is not None:
-                        alpha_mask_list[i] = torch.ones((images[i].shape[1], images[i].shape[2]), dtype=torch.float32)
-                    else:
-                        alpha_mask_list[i] = torch.ones(
-                            (latents_list[i].shape[1] * 8, latents_list[i].shape[2] * 8), dtype=torch.float32
-                        )
+                    alpha_mask_list[i] = torch.ones(target_sizes_hw[i], dtype=torch.float32)
             example["alpha_masks"] = torch.stack(alpha_mask_list)
         else:
             example["alpha_masks"] = torch.stack(alpha_mask_list)
 
         if images[0] is not None:
             images = torch.stack(images)
-            images = images.to(memory_format=torch.contiguous_format).float()
+            if not self.image_transforms_on_device:
+                images = images.to(memory_format=torch.contiguous_format).float()
         else:
             images = None
-        example["images"] = images
+        example["images"] = images  # uint8 B,H,W,C if image_transforms_on_device, else float B,C,H,W
 
         example["latents"] = torch.stack(latents_list) if latents_list[0] is not None else None
         example["captions"] = captions
@@ -1461,11 +1806,16 @@ class BaseDataset(torch.utils.data.Dataset):
         example["crop_top_lefts"] = torch.stack([torch.LongTensor(x) for x in crop_top_lefts])
         example["target_sizes_hw"] = torch.stack([torch.LongTensor(x) for x in target_sizes_hw])
         example["flippeds"] = flippeds
+        example["color_augs"] = color_augs
 
-        example["network_multipliers"] = torch.FloatTensor([self.network_multiplier] * len(captions))
+        example["network_multipliers"] = torch.FloatTensor(network_multipliers)
 
         if self.debug_dataset:
             example["image_keys"] = bucket[image_index : image_index + self.batch_size]
+
+        record.lap("collate")
+        if self.stage_stats is not None:
+            self.stage_stats.add(record)
         return example
 
     def get_item_for_caching(self, bucket, bucket_batch_size, image_index):
@@ -2032,6 +2382,7 @@ class ControlNetDataset(BaseDataset):
                 subset.caption_suffix,
                 subset.token_warmup_min,
                 subset.token_warmup_step,
+                subset.network_multiplier,
             )
             db_subsets.append(db_subset)
 
@@ -2104,9 +2455,27 @@ class ControlNetDataset(BaseDataset):
         self.bucket_manager = self.dreambooth_dataset_delegate.bucket_manager
         self.buckets_indices = self.dreambooth_dataset_delegate.buckets_indices
 
+    def pretokenize_captions(self):
+        self.dreambooth_dataset_delegate.pretokenize_captions()
+
     def cache_latents(self, vae, vae_batch_size=1, cache_to_disk=False, is_main_process=True):
         return self.dreambooth_dataset_delegate.cache_latents(vae, vae_batch_size, cache_to_disk, is_main_process)
 
+    def cache_resized_images(self, max_workers=None, is_main_process=True):
+        return self.dreambooth_dataset_delegate.cache_resized_images(max_workers, is_main_process)
+
+    def enable_fast_image_decode(self):
+        self.dreambooth_dataset_delegate.enable_fast_image_decode()
+
+    def enable_latent_random_crop(self):
+        self.dreambooth_dataset_delegate.enable_latent_random_crop()
+
+    def enable_stage_stats(self, stage_stats: "DatasetStageStats"):
+        self.dreambooth_dataset_delegate.enable_stage_stats(stage_stats)
+
+    def enable_dynamic_token_chunks(self, group_by_caption_length=False):
+        self.dreambooth_dataset_delegate.enable_dynamic_token_chunks(group_by_caption_length)
+
     def __len__(self):
         return self.dreambooth_dataset_delegate.__len__()
 
@@ -2206,6 +2575,11 @@ class DatasetGroup(torch.utils.data.ConcatDataset):
             print(f"[Dataset {i}]")
             dataset.cache_text_encoder_outputs(tokenizers, text_encoders, device, weight_dtype, cache_to_disk, is_main_process)
 
+    def cache_resized_images(self, max_workers=None, is_main_process=True):
+        for i, dataset in enumerate(self.datasets):
+            print(f"[Dataset {i}]")
+            dataset.cache_resized_images(max_workers, is_main_process)
+
     def set_caching_mode(self, caching_mode):
         for dataset in self.datasets:
             dataset.set_caching_mode(caching_mode)
@@ -2236,6 +2610,22 @@ class DatasetGroup(torch.utils.data.ConcatDataset):
         for dataset in self.datasets:
             dataset.disable_token_padding()
 
+    def enable_fast_image_decode(self):
+        for dataset in self.datasets:
+            dataset.enable_fast_image_decode()
+
+    def enable_latent_random_crop(self):
+        for dataset in self.datasets:
+            dataset.enable_latent_random_crop()
+
+    def enable_stage_stats(self, stage_stats: "DatasetStageStats"):
+        for dataset in self.datasets:
+            dataset.enable_stage_stats(stage_stats)
+
+    def enable_dynamic_token_chunks(self, group_by_caption_length=False):
+        for dataset in self.datasets:
+            dataset.enable_dynamic_token_chunks(group_by_caption_length)
+
 
 def is_disk_cached_latents_is_expected(reso, npz_path: str, flip_aug: bool, alpha_mask: bool):
     expected_latents_size = (reso[1] // 8, reso[0] // 8)  # bucket_resoはWxHなので注意
@@ -2351,8 +2741,11 @@ def debug_dataset(train_dataset, show_input_ids=False):
                 if example["images"] is not None:
                     im = example["images"][j]
                     print(f"image size: {im.size()}")
-                    im = ((im.numpy() + 1.0) * 127.5).astype(np.uint8)
-                    im = np.transpose(im, (1, 2, 0))  # c,H,W -> H,W,c
+                    if im.dtype == torch.uint8:
+                        im = im.numpy()  # H,W,c, flip and color_aug are not applied yet
+                    else:
+                        im = ((im.numpy() + 1.0) * 127.5).astype(np.uint8)
+                        im = np.transpose(im, (1, 2, 0))  # c,H,W -> H,W,c
                     im = im[:, :, ::-1]  # RGB -> BGR (OpenCV)
 
                     if "conditioning_images" in example:
@@ -2504,12 +2897,41 @@ def load_image(image_path, alpha=False):
         raise e
 
 
-# 画像を読み込む。戻り値はnumpy.ndarray,(original width, original height),(crop left, crop top, crop right, crop bottom)
-def trim_and_resize_if_required(
-    random_crop: bool, image: np.ndarray, reso, resized_size: Tuple[int, int]
-) -> Tuple[np.ndarray, Tuple[int, int], Tuple[int, int, int, int]]:
+def load_image_fast(image_path, alpha=False, target_size: Optional[Tuple[int, int]] = None) -> Tuple[np.ndarray, Tuple[int, int]]:
+    r"""
+    faster version of load_image. returns the image and the original size (width, height) of the image.
+    JPEG is decoded with DCT scaling (Image.draft) to the smallest size not smaller than target_size,
+    so the returned image may be smaller than the original size. PNG and BMP without alpha are decoded with cv2.
+    """
+    ext = os.path.splitext(image_path)[1].lower()
+    if not alpha and ext in CV2_FAST_DECODE_EXTENSIONS:
+        # np.fromfile for non-ascii path on Windows. ignore EXIF orientation as same as PIL
+        img = cv2.imdecode(np.fromfile(image_path, np.uint8), cv2.IMREAD_COLOR | cv2.IMREAD_IGNORE_ORIENTATION)
+        if img is not None:
+            img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB, dst=img)  # in-place conversion, no extra buffer
+            return img, (img.shape[1], img.shape[0])
+        # fallback to PIL if cv2 cannot decode
+
+    try:
+        with Image.open(image_path) as image:
+            original_size = image.size
+            if target_size is not None:
+                image.draft(image.mode, tuple(target_size))  # JPEG only, no effect for other formats
+            if alpha:
+                if not image.mode == "RGBA":
+                    image = image.convert("RGBA")
+            else:
+                if not image.mode == "RGB":
+                    image = image.convert("RGB")
+            img = np.array(image, np.uint8)
+            return img, original_size
+    except (IOError, OSError) as e:
+        print(f"Error loading file: {image_path}")
+        raise e
+
+
+def resize_image_if_required(image: np.ndarray, resized_size: Tuple[int, int]) -> np.ndarray:
     image_height, image_width = image.shape[0:2]
-    original_size = (image_width, image_height)  # size before resize
 
     if image_width != resized_size[0] or image_height != resized_size[1]:
         # リサイズする
@@ -2518,6 +2940,27 @@ def trim_and_resize_if_required(
         else:
             image = pil_resize(image, resized_size)
 
+    return image
+
+
+# 画像を読み込む。戻り値はnumpy.ndarray,(original width, original height),(crop left, crop top, crop right, crop bottom)
+# original_sizeを指定した場合、imageはoriginal_sizeの画像をリサイズ済みのものとして扱う
+# if original_size is specified, image is treated as already resized from the image of original_size
+def trim_and_resize_if_required(
+    random_crop: bool,
+    image: np.ndarray,
+    reso,
+    resized_size: Tuple[int, int],
+    original_size: Optional[Tuple[int, int]] = None,
+) -> Tuple[np.ndarray, Tuple[int, int], Tuple[int, int, int, int]]:
+    if original_size is None:
+        image_height, image_width = image.shape[0:2]
+        original_size = (image_width, image_height)  # size before resize
+    else:
+        original_size = tuple(original_size)
+
+    image = resize_image_if_required(image, resized_size)
+
     image_height, image_width = image.shape[0:2]
 
     if image_width > reso[0]:
@@ -2540,8 +2983,91 @@ def trim_and_resize_if_required(
     return image, original_size, crop_ltrb
 
 
+def count_token_chunks(input_ids: torch.Tensor, tokenizer) -> int:
+    r"""
+    input_ids (n,77) または (b,n,77) のうち、captionを含むchunkの数（batch内の最大、最低1）を返す
+    returns the number of chunks containing the caption in input_ids (n,77) or (b,n,77), max in the batch and at least 1
+    """
+    # <BOS> の次が <EOS> か <PAD> のchunkは空。空のchunkは常に後ろにある
+    # the chunk is empty if the token after <BOS> is <EOS> or <PAD>. empty chunks are always at the end
+    second_tokens = input_ids[..., 1]
+    used = (second_tokens != tokenizer.eos_token_id) & (second_tokens != tokenizer.pad_token_id)
+    return max(1, int(used.sum(dim=-1).max()))
+
+
+def random_crop_latents(
+    latents: torch.Tensor, alpha_mask: Optional[torch.Tensor], reso: Tuple[int, int]
+) -> Tuple[torch.Tensor, Optional[torch.Tensor], Tuple[int, int]]:
+    r"""
+    latentsをreso（WxH、ピクセル単位）のサイズに8ピクセル単位でrandom cropする。alpha_maskも同じ位置でcropする
+    random crop latents (C,H,W) to reso (WxH in pixels) at multiples of 8 pixels. alpha_mask (H*8,W*8) is cropped at the same position
+    returns cropped latents, cropped alpha_mask and (crop left, crop top) in pixels
+    """
+    crop_w, crop_h = reso[0] // 8, reso[1] // 8
+    latents_h, latents_w = latents.shape[1:3]
+    left = random.randint(0, latents_w - crop_w)
+    top = random.randint(0, latents_h - crop_h)
+    latents = latents[:, top : top + crop_h, left : left + crop_w]
+    if alpha_mask is not None:
+        alpha_mask = alpha_mask[top * 8 : (top + crop_h) * 8, left * 8 : (left + crop_w) * 8]
+    return latents, alpha_mask, (left * 8, top * 8)
+
+
+def is_disk_cached_resized_image_is_expected(image_path: str, npy_path: str, resized_size: Tuple[int, int], alpha_mask: bool):
+    if not os.path.exists(npy_path):
+        return False
+
+    # 元画像が更新されていたらキャッシュは無効 / cache is invalid if the source image is updated
+    if os.path.getmtime(npy_path) < os.path.getmtime(image_path):
+        return False
+
+    try:
+        image = np.load(npy_path, mmap_mode="r")  # read header only
+        expected_shape = (resized_size[1], resized_size[0], 4 if alpha_mask else 3)  # resized_sizeはWxHなので注意
+        if image.dtype != np.uint8 or image.shape != expected_shape:
+            return False
+    except Exception as e:
+        print(f"Error loading file: {npy_path}")
+        raise e
+
+    return True
+
+
+def load_resized_image_from_disk(npy_path: str) -> np.ndarray:
+    # memmapで読み込むので、cropした部分のみ実際に読み込まれる。書き換える場合はコピーすること
+    # loaded as memmap, so only cropped area is actually read. copy it before modifying
+    return np.load(npy_path, mmap_mode="r")
+
+
+def save_resized_image_to_disk(npy_path: str, image: np.ndarray):
+    # 書き込み途中のファイルを読まないように一時ファイルに書いてからrenameする
+    # write to temporary file and rename it, to avoid reading incomplete file
+    tmp_path = npy_path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        np.save(f, np.ascontiguousarray(image, dtype=np.uint8))
+    os.replace(tmp_path, npy_path)
+
+
+def cache_resized_image(info: ImageInfo, use_alpha_mask: bool, fast_decode: bool = False) -> None:
+    r"""
+    requires info to have: absolute_path, resized_size, resized_image_npy
+    """
+    if fast_decode:
+        image, _ = load_image_fast(info.absolute_path, use_alpha_mask, info.resized_size)
+    else:
+        image = load_image(info.absolute_path, use_alpha_mask)
+    image = resize_image_if_required(image, info.resized_size)
+    save_resized_image_to_disk(info.resized_image_npy, image)
+
+
 def cache_batch_latents(
-    vae: AutoencoderKL, cache_to_disk: bool, image_infos: List[ImageInfo], flip_aug: bool, use_alpha_mask: bool, random_crop: bool
+    vae: AutoencoderKL,
+    cache_to_disk: bool,
+    image_infos: List[ImageInfo],
+    flip_aug: bool,
+    use_alpha_mask: bool,
+    random_crop: bool,
+    cache_reso: Optional[Tuple[int, int]] = None,
 ) -> None:
     r"""
     requires image_infos to have: absolute_path, bucket_reso, resized_size, latents_npz
@@ -2551,13 +3077,18 @@ def cache_batch_latents(
     if cache_to_disk is False, set info.latents
         latents_flipped is also set if flip_aug is True
     latents_original_size and latents_crop_ltrb are also set
+    if cache_reso is specified, images are center-trimmed to cache_reso instead of bucket_reso (for random crop in latent space)
     """
     images = []
     alpha_masks: List[np.ndarray] = []
     for info in image_infos:
         image = load_image(info.absolute_path, use_alpha_mask) if info.image is None else np.array(info.image, np.uint8)
         # TODO 画像のメタデータが壊れていて、メタデータから割り当てたbucketと実際の画像サイズが一致しない場合があるのでチェック追加要
-        image, original_size, crop_ltrb = trim_and_resize_if_required(random_crop, image, info.bucket_reso, info.resized_size)
+        if cache_reso is None:
+            image, original_size, crop_ltrb = trim_and_resize_if_required(random_crop, image, info.bucket_reso, info.resized_size)
+        else:
+            image, original_size, _ = trim_and_resize_if_required(False, image, cache_reso, info.resized_size)
+            crop_ltrb = BucketManager.get_crop_ltrb(info.bucket_reso, original_size)  # not used if cropped in latent space
 
         info.latents_original_size = original_size
         info.latents_crop_ltrb = crop_ltrb
@@ -2725,23 +3256,266 @@ def calculate_sha256(filename):
         return "IsADirectory"
 
 
+MODEL_HASH_CACHE_LOCK = threading.Lock()
+
+
+def calculate_model_hashes_with_cache(filename: str, cache_file: Optional[str] = None) -> Tuple[str, str]:
+    r"""
+    model_hashとcalculate_sha256の結果を返す。cache_fileを指定した場合は、絶対パス、サイズ、更新日時、inodeをキーとしてJSONファイルにキャッシュする
+    returns the results of model_hash and calculate_sha256. if cache_file is specified, they are cached in the JSON file,
+    keyed by absolute path, size, mtime and inode. the cache file can be shared by multiple scripts and runs
+    """
+    if cache_file is None or not os.path.isfile(filename):
+        return model_hash(filename), calculate_sha256(filename)
+
+    key = os.path.abspath(filename)
+    st = os.stat(filename)
+    signature = [st.st_size, st.st_mtime_ns, st.st_ino]
+
+    def load_cache():
+        if not os.path.exists(cache_file):
+            return {}
+        try:
+            with open(cache_file, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"failed to load model hash cache, ignored / モデルのハッシュのキャッシュを読み込めませんでした。無視します: {cache_file}, {e}")
+            return {}
+
+    with MODEL_HASH_CACHE_LOCK:
+        entry = load_cache().get(key)
+    if entry is not None and entry.get("signature") == signature:
+        print(f"use cached model hashes / キャッシュされたモデルのハッシュを使用します: {filename}")
+        return entry["model_hash"], entry["sha256"]
+
+    print(f"calculating model hashes / モデルのハッシュを計算します: {filename}")
+    legacy_hash = model_hash(filename)
+    sha256 = calculate_sha256(filename)
+
+    with MODEL_HASH_CACHE_LOCK:
+        cache = load_cache()  # reload to merge entries written by other processes
+        cache[key] = {"signature": signature, "model_hash": legacy_hash, "sha256": sha256}
+        cache_dir = os.path.dirname(os.path.abspath(cache_file))
+        os.makedirs(cache_dir, exist_ok=True)
+        with tempfile.NamedTemporaryFile("w", encoding="utf-8", dir=cache_dir, delete=False) as f:
+            json.dump(cache, f, indent=2)
+        os.replace(f.name, cache_file)
+
+    return legacy_hash, sha256
+
+
+def submit_model_hashes_calculation(filename: str, cache_file: Optional[str] = None) -> concurrent.futures.Future:
+    # バックグラウンドのスレッドでハッシュを計算する / calculate model hashes in a background thread
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="model_hash")
+    future = executor.submit(calculate_model_hashes_with_cache, filename, cache_file)
+    executor.shutdown(wait=False)
+    return future
+
+
 def precalculate_safetensors_hashes(tensors, metadata):
     """Precalculate the model hashes needed by sd-webui-additional-networks to
     save time on indexing the model later."""
 
-    # Because writing user metadata to the file can change the result of
-    # sd_models.model_hash(), only retain the training metadata for purposes of
-    # calculating the hash, as they are meant to be immutable
-    metadata = {k: v for k, v in metadata.items() if k.startswith("ss_")}
+    # tensorを一つずつハッシュするので、ファイル全体をメモリ上にシリアライズしない
+    # tensors are hashed one by one, the whole file is not serialized in memory
+    return stream_safetensors_with_hashes(tensors, metadata, None)
+
+
+def save_safetensors_with_hashes(tensors: Dict[str, torch.Tensor], file: str, metadata: Optional[Dict[str, str]]) -> Tuple[str, str]:
+    r"""
+    safetensorsファイルを一度だけ書き出し、書き出しながらsd-webui-additional-networks用のハッシュを計算してmetadataに格納する
+    write safetensors file in one pass, calculating the hashes for sd-webui-additional-networks while writing.
+    the hashes are stored to sshs_model_hash and sshs_legacy_hash of the header and metadata
+    """
+    if metadata is None:
+        metadata = {}
+    with open(file, "wb") as f:
+        model_hash, legacy_hash = stream_safetensors_with_hashes(tensors, metadata, f)
+    metadata["sshs_model_hash"] = model_hash
+    metadata["sshs_legacy_hash"] = legacy_hash
+    return model_hash, legacy_hash
+
 
-    bytes = safetensors.torch.save(tensors, metadata)
-    b = BytesIO(bytes)
+def check_safetensors_writer() -> None:
+    r"""
+    stream_safetensors_with_hashesの出力がsafetensors.torch.saveと同じレイアウトであることを確認する。非ASCIIのmetadataとdtypeの混在したtensorを使う
+    check that stream_safetensors_with_hashes writes the same layout as safetensors.torch.save, with non-ASCII metadata and mixed dtypes.
+    the order of metadata keys in the header is not defined by safetensors, so the headers are compared after parsing
+    """
+    tensors = {
+        "a": torch.ones(3, dtype=torch.float16),
+        "b": torch.ones(3, dtype=torch.bfloat16),
+        "c": torch.arange(3, dtype=torch.float64),
+        "d": torch.arange(3, dtype=torch.int64),
+        "e": torch.ones(2, 2, dtype=torch.float32),
+        "f": torch.zeros(5, dtype=torch.uint8),
+        "g": torch.zeros(5, dtype=torch.bool),
+    }
+    metadata = {"ss_output_name": "学習済みモデル", "ss_tag_frequency": json.dumps({"データ": {"タグ": 1}}, ensure_ascii=False)}
+
+    buffer = BytesIO()
+    model_hash, legacy_hash = stream_safetensors_with_hashes(tensors, metadata, buffer)
+    metadata = {**metadata, "sshs_model_hash": model_hash, "sshs_legacy_hash": legacy_hash}
+    written = buffer.getvalue()
+    expected = safetensors.torch.save(tensors, metadata)
+
+    assert len(written) == len(expected), f"file size mismatch: {len(written)} != {len(expected)}"
+    header_size = int.from_bytes(expected[:8], "little")
+    assert written[:8] == expected[:8], "header size mismatch"
+    assert json.loads(written[8 : 8 + header_size]) == json.loads(expected[8 : 8 + header_size]), "header mismatch"
+    assert written[8 + header_size :] == expected[8 + header_size :], "tensor data mismatch"
+
+
+SAFETENSORS_DTYPES = {
+    torch.float64: "F64",
+    torch.float32: "F32",
+    torch.float16: "F16",
+    torch.bfloat16: "BF16",
+    torch.int64: "I64",
+    torch.int32: "I32",
+    torch.int16: "I16",
+    torch.int8: "I8",
+    torch.uint8: "U8",
+    torch.bool: "BOOL",
+}
+if hasattr(torch, "float8_e4m3fn"):
+    SAFETENSORS_DTYPES[torch.float8_e4m3fn] = "F8_E4M3"
+    SAFETENSORS_DTYPES[torch.float8_e5m2] = "F8_E5M2"
+
+TORCH_DTYPES_FROM_SAFETENSORS = {v: k for k, v in SAFETENSORS_DTYPES.items()}
+
+# safetensorsのDtype enumの順序。書き出し時はこの降順、次に名前順に並べられる / order of Dtype enum of safetensors, tensors are written in descending order, then by name
+SAFETENSORS_DTYPE_ORDER = ["BOOL", "U8", "I8", "F8_E5M2", "F8_E4M3", "I16", "U16", "F16", "BF16", "I32", "U32", "F32", "F64", "I64", "U64"]
+
+ADDNET_LEGACY_HASH_RANGE = (0x100000, 0x110000)
+
+
+def build_safetensors_header(metadata: Optional[Dict[str, str]], entries: List[Tuple[str, torch.dtype, List[int], int, int]]) -> bytes:
+    header = {}
+    if metadata:
+        header["__metadata__"] = {k: str(v) for k, v in metadata.items()}
+    for name, dtype, shape, begin, end in entries:
+        header[name] = {"dtype": SAFETENSORS_DTYPES[dtype], "shape": list(shape), "data_offsets": [begin, end]}
+    header_bytes = json.dumps(header, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+    # safetensorsと同じく8バイト境界にスペースでpaddingする / pad with spaces to 8 bytes boundary like safetensors
+    return header_bytes + b" " * ((8 - len(header_bytes) % 8) % 8)
+
+
+def stream_safetensors_with_hashes(tensors: Dict[str, torch.Tensor], metadata: Dict[str, str], f=None) -> Tuple[str, str]:
+    r"""
+    tensorを一つずつsafetensors形式でfに書き出しながら、addnetのハッシュを計算する。fがNoneの場合はハッシュのみ計算する
+    write tensors to f in safetensors format one by one, calculating the addnet hashes. only calculate the hashes if f is None.
+    model hash is SHA256 of the tensor section. legacy hash is SHA256 of 0x100000~0x10FFFF of the file with ss_* metadata only,
+    because writing user metadata to the file can change the result of sd_models.model_hash()
+    tensors are ordered like safetensors: descending order of its dtype enum, then by name
+    """
+    names = sorted(tensors.keys(), key=lambda k: (-SAFETENSORS_DTYPE_ORDER.index(SAFETENSORS_DTYPES[tensors[k].dtype]), k))
+    entries = []
+    offset = 0
+    for name in names:
+        tensor = tensors[name]
+        size = tensor.numel() * tensor.element_size()
+        entries.append((name, tensor.dtype, tensor.shape, offset, offset + size))
+        offset += size
+
+    # legacy hashは学習時のmetadataのみを含むファイルのオフセットで計算する / legacy hash uses offsets in the file with ss_* metadata only
+    ss_metadata = {k: v for k, v in metadata.items() if k.startswith("ss_")}
+    ss_header = build_safetensors_header(ss_metadata, entries)
+    ss_prefix = len(ss_header).to_bytes(8, "little") + ss_header
+
+    legacy_sha256 = hashlib.sha256()
+    legacy_begin, legacy_end = ADDNET_LEGACY_HASH_RANGE
+
+    def update_legacy_hash(position: int, data: memoryview):
+        begin = max(position, legacy_begin)
+        end = min(position + len(data), legacy_end)
+        if begin < end:
+            legacy_sha256.update(data[begin - position : end - position])
+
+    update_legacy_hash(0, memoryview(ss_prefix))
+
+    # hashes are not known yet, write placeholders of the same length and rewrite the header later
+    header_metadata = dict(metadata)
+    header_metadata["sshs_model_hash"] = "0" * 64
+    header_metadata["sshs_legacy_hash"] = "0" * 8
+    if f is not None:
+        header = build_safetensors_header(header_metadata, entries)
+        f.write(len(header).to_bytes(8, "little"))
+        f.write(header)
+
+    model_sha256 = hashlib.sha256()
+    position = len(ss_prefix)
+    for name in names:
+        data = tensor_to_bytes_view(tensors[name])
+        model_sha256.update(data)
+        update_legacy_hash(position, data)
+        position += len(data)
+        if f is not None:
+            f.write(data)
+
+    model_hash = model_sha256.hexdigest()
+    legacy_hash = legacy_sha256.hexdigest()[0:8]
+
+    if f is not None:
+        header_metadata["sshs_model_hash"] = model_hash
+        header_metadata["sshs_legacy_hash"] = legacy_hash
+        final_header = build_safetensors_header(header_metadata, entries)
+        assert len(final_header) == len(header), "internal error, header size is changed"
+        f.seek(8)
+        f.write(final_header)
+        f.seek(0, os.SEEK_END)
 
-    model_hash = addnet_hash_safetensors(b)
-    legacy_hash = addnet_hash_legacy(b)
     return model_hash, legacy_hash
 
 
+def save_safetensors_streaming(
+    file: str,
+    entries: List[Tuple[str, torch.dtype, List[int]]],
+    compute_tensor: Callable[[str], torch.Tensor],
+    metadata: Optional[Dict[str, str]] = None,
+    max_workers: int = 1,
+):
+    r"""
+    ヘッダを先に書き、tensorを一つずつ計算しながらsafetensors形式で書き出す。全体をメモリに載せない
+    write the header first, then compute tensors one by one and write them in safetensors format, without holding the whole model.
+    entries: list of (name, dtype, shape) in the order of writing. compute_tensor(name) must return the tensor with the dtype and shape.
+    if max_workers > 1, tensors are computed in a thread pool and at most 2 * max_workers tensors are held at the same time
+    """
+    header_entries = []
+    offset = 0
+    for name, dtype, shape in entries:
+        size = math.prod(shape) * torch.tensor([], dtype=dtype).element_size()
+        header_entries.append((name, dtype, shape, offset, offset + size))
+        offset += size
+    header = build_safetensors_header(metadata, header_entries)
+
+    with open(file, "wb") as f:
+        f.write(len(header).to_bytes(8, "little"))
+        f.write(header)
+
+        def write(entry, tensor: torch.Tensor):
+            name, dtype, shape = entry
+            assert tensor.dtype == dtype and list(tensor.shape) == list(shape), f"unexpected tensor: {name}, {tensor.dtype}, {tensor.shape}"
+            f.write(tensor_to_bytes_view(tensor))
+
+        if max_workers <= 1:
+            for entry in tqdm(entries):
+                write(entry, compute_tensor(entry[0]))
+            return
+
+        # 書き出し順を保つため、先頭から順に結果を待つ / wait for the results in order to keep the order of writing
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            pending = collections.deque()
+            for entry in tqdm(entries):
+                pending.append((entry, executor.submit(compute_tensor, entry[0])))
+                if len(pending) >= 2 * max_workers:
+                    head_entry, head_future = pending.popleft()
+                    write(head_entry, head_future.result())
+            while pending:
+                entry, future = pending.popleft()
+                write(entry, future.result())
+
+
 def addnet_hash_legacy(b):
     """Old model hash used by sd-webui-additional-networks for .safetensors format files"""
     m = hashlib.sha256()
@@ -3025,6 +3799,12 @@ def add_sd_models_arguments(parser: argparse.ArgumentParser):
         default=None,
         help="directory for caching Tokenizer (for offline training) / Tokenizerをキャッシュするディレクトリ（ネット接続なしでの学習のため）",
     )
+    parser.add_argument(
+        "--converted_model_cache_dir",
+        type=str,
+        default=None,
+        help="directory for caching models converted from StableDiffusion checkpoint (SD1.x/2.x) to speed up loading / StableDiffusionのcheckpoint（SD1.x/2.x）から変換したモデルをキャッシュして読み込みを高速化するディレクトリ",
+    )
 
 
 def add_optimizer_arguments(parser: argparse.ArgumentParser):
@@ -3352,6 +4132,11 @@ def add_training_arguments(parser: argparse.ArgumentParser, support_dreambooth:
         default=None,
         help="use output of nth layer from back of text encoder (n>=1) / text encoderの後ろからn番目の層の出力を用いる（nは1以上）",
     )
+    parser.add_argument(
+        "--clip_skip_early_exit",
+        action="store_true",
+        help="with clip_skip, do not run the unused last layers of text encoder (the result is the same) / clip_skip指定時にtext encoderの使わない後ろの層を実行しない（結果は同じ）",
+    )
     parser.add_argument(
         "--logging_dir",
         type=str,
@@ -3711,6 +4496,11 @@ def verify_training_args(args: argparse.Namespace):
             "cache_latents_to_disk is enabled, so cache_latents is also enabled / cache_latents_to_diskが有効なため、cache_latentsを有効にします"
         )
 
+    if getattr(args, "cache_resized_images", False) and args.cache_latents:
+        print(
+            "cache_resized_images has no effect because latents are cached / latentをキャッシュするため、cache_resized_imagesは無効です"
+        )
+
     # noise_offset, perlin_noise, multires_noise_iterations cannot be enabled at the same time
     # # Listを使って数えてもいいけど並べてしまえ
     # if args.noise_offset is not None and args.multires_noise_iterations is not None:
@@ -3860,6 +4650,36 @@ def add_dataset_arguments(
         action="store_true",
         help="cache latents to disk to reduce VRAM usage (augmentations must be disabled) / VRAM削減のためにlatentをディスクにcacheする（augmentationは使用不可）",
     )
+    parser.add_argument(
+        "--latent_random_crop",
+        action="store_true",
+        help="cache latents of uncropped images and do random_crop in latent space at multiples of 8 pixels, to use random_crop with cache_latents. requires enable_bucket"
+        + " / cropしていない画像のlatentをキャッシュし、latent空間で8ピクセル単位でrandom_cropを行う。cache_latentsとrandom_cropを併用できる。enable_bucketが必要",
+    )
+    parser.add_argument(
+        "--dynamic_token_chunks",
+        action="store_true",
+        help="with max_token_length, pad input_ids only to the number of 75-token chunks needed by the longest caption in the batch"
+        + " / max_token_length指定時に、batch内の最長のcaptionに必要な75トークンのchunk数までだけinput_idsをpaddingする",
+    )
+    parser.add_argument(
+        "--group_by_caption_length",
+        action="store_true",
+        help="with dynamic_token_chunks, make batches of captions with the same number of chunks in each bucket"
+        + " / dynamic_token_chunks指定時に、bucketごとにchunk数が同じcaptionでbatchを作る",
+    )
+    parser.add_argument(
+        "--fast_image_decode",
+        action="store_true",
+        help="decode images faster when latents are not cached: JPEG is downscaled in DCT domain to near the bucket size, PNG/BMP are decoded with OpenCV. requires enable_bucket"
+        + " / latentをキャッシュしない場合に画像を高速に読み込む。JPEGはDCT領域でbucketのサイズ付近まで縮小し、PNG/BMPはOpenCVで読み込む。enable_bucketが必要",
+    )
+    parser.add_argument(
+        "--cache_resized_images",
+        action="store_true",
+        help="cache images resized to each bucket to disk as uint8 arrays, used when latents are not cached (e.g. color_aug or random_crop). requires enable_bucket"
+        + " / bucketごとにリサイズした画像をuint8配列としてディスクにキャッシュする。latentをキャッシュしない場合（color_aug、random_crop等）に使用される。enable_bucketが必要",
+    )
     parser.add_argument(
         "--enable_bucket",
         action="store_true",
@@ -4674,8 +5494,20 @@ def _load_target_model(args: argparse.Namespace, weight_dtype, device="cpu", une
     load_stable_diffusion_format = os.path.isfile(name_or_path)  # determine SD or Diffusers
     if load_stable_diffusion_format:
         print(f"load StableDiffusion checkpoint: {name_or_path}")
+        converted_model_cache_dir = None
+        if getattr(args, "converted_model_cache_dir", None) is not None:
+            # ソースのsha256をキーにする。ハッシュ自体もキャッシュする / the sha256 of the source is the key. the hash itself is cached too
+            hash_cache_file = getattr(args, "model_hash_cache", None) or os.path.join(args.converted_model_cache_dir, "model_hashes.json")
+            _, source_hash = calculate_model_hashes_with_cache(name_or_path, hash_cache_file)
+            converted_model_cache_dir = model_util.get_converted_model_cache_dir(
+                args.converted_model_cache_dir, source_hash, args.v2, unet_use_linear_projection_in_v2
+            )
         text_encoder, vae, unet = model_util.load_models_from_stable_diffusion_checkpoint(
-            args.v2, name_or_path, device, unet_use_linear_projection_in_v2=unet_use_linear_projection_in_v2
+            args.v2,
+            name_or_path,
+            device,
+            unet_use_linear_projection_in_v2=unet_use_linear_projection_in_v2,
+            converted_model_cache_dir=converted_model_cache_dir,
         )
     else:
         # Diffusers model is loaded to CPU
@@ -4745,17 +5577,49 @@ def patch_accelerator_for_fp16_training(accelerator):
     accelerator.scaler._unscale_grads_ = _unscale_grads_replacer
 
 
+def get_hidden_states_with_early_exit(
+    text_encoder: CLIPTextModel,
+    input_ids: torch.Tensor,
+    clip_skip: int,
+    final_layer_norm: bool = True,
+    accelerator: Optional[Accelerator] = None,
+):
+    r"""
+    hidden_states[-clip_skip]（final_layer_normを指定した場合は適用後）を返す。使わない後ろの層は実行せず、全層のhidden_statesも保持しない
+    returns hidden_states[-clip_skip] (with final_layer_norm if specified) without running the unused last layers
+    and without keeping the hidden states of all layers. the result is identical to the full forward
+    """
+    unwrapped_text_encoder = text_encoder if accelerator is None else accelerator.unwrap_model(text_encoder)
+    text_model = unwrapped_text_encoder.text_model
+    org_layers = text_model.encoder.layers
+    org_final_layer_norm = text_model.final_layer_norm
+
+    # 層を一時的に切り詰めて、最後の層の出力（final_layer_norm適用後）をlast_hidden_stateとして得る
+    # truncate the layers temporarily, and get the output of the last layer (with final_layer_norm) as last_hidden_state
+    text_model.encoder.layers = org_layers[: len(org_layers) - clip_skip + 1]
+    if not final_layer_norm:
+        text_model.final_layer_norm = torch.nn.Identity()
+    try:
+        return text_encoder(input_ids)[0]
+    finally:
+        text_model.encoder.layers = org_layers
+        text_model.final_layer_norm = org_final_layer_norm
+
+
 def get_hidden_states(args: argparse.Namespace, input_ids, tokenizer, text_encoder, weight_dtype=None):
     # with no_token_padding, the length is not max length, return result immediately
     if input_ids.size()[-1] != tokenizer.model_max_length:
         return text_encoder(input_ids)[0]
 
-    # input_ids: b,n,77
+    # input_ids: b,n,77. n may be smaller than max_token_length // 75 with dynamic_token_chunks
     b_size = input_ids.size()[0]
+    n_chunks = input_ids.size()[1] if input_ids.dim() == 3 else 1
     input_ids = input_ids.reshape((-1, tokenizer.model_max_length))  # batch_size*3, 77
 
     if args.clip_skip is None:
         encoder_hidden_states = text_encoder(input_ids)[0]
+    elif args.clip_skip_early_exit:
+        encoder_hidden_states = get_hidden_states_with_early_exit(text_encoder, input_ids, args.clip_skip)
     else:
         enc_out = text_encoder(input_ids, output_hidden_states=True, return_dict=True)
         encoder_hidden_states = enc_out["hidden_states"][-args.clip_skip]
@@ -4768,7 +5632,7 @@ def get_hidden_states(args: argparse.Namespace, input_ids, tokenizer, text_encod
         if args.v2:
             # v2: <BOS>...<EOS> <PAD> ... の三連を <BOS>...<EOS> <PAD> ... へ戻す　正直この実装でいいのかわからん
             states_list = [encoder_hidden_states[:, 0].unsqueeze(1)]  # <BOS>
-            for i in range(1, args.max_token_length, tokenizer.model_max_length):
+            for i in range(1, n_chunks * tokenizer.model_max_length, tokenizer.model_max_length):
                 chunk = encoder_hidden_states[:, i : i + tokenizer.model_max_length - 2]  # <BOS> の後から 最後の前まで
                 if i > 0:
                     for j in range(len(chunk)):
@@ -4780,7 +5644,7 @@ def get_hidden_states(args: argparse.Namespace, input_ids, tokenizer, text_encod
         else:
             # v1: <BOS>...<EOS> の三連を <BOS>...<EOS> へ戻す
             states_list = [encoder_hidden_states[:, 0].unsqueeze(1)]  # <BOS>
-            for i in range(1, args.max_token_length, tokenizer.model_max_length):
+            for i in range(1, n_chunks * tokenizer.model_max_length, tokenizer.model_max_length):
                 states_list.append(
                     encoder_hidden_states[:, i : i + tokenizer.model_max_length - 2]
                 )  # <BOS> の後から <EOS> の前まで
@@ -4847,17 +5711,23 @@ def get_hidden_states_sdxl(
     text_encoder2: CLIPTextModelWithProjection,
     weight_dtype: Optional[str] = None,
     accelerator: Optional[Accelerator] = None,
+    clip_skip_early_exit: bool = False,
 ):
-    # input_ids: b,n,77 -> b*n, 77
+    # input_ids: b,n,77 -> b*n, 77. n may be smaller than max_token_length // 75 with dynamic_token_chunks
     b_size = input_ids1.size()[0]
+    n_size = 1 if max_token_length is None else input_ids1.size()[1]
     input_ids1 = input_ids1.reshape((-1, tokenizer1.model_max_length))  # batch_size*n, 77
     input_ids2 = input_ids2.reshape((-1, tokenizer2.model_max_length))  # batch_size*n, 77
 
     # text_encoder1
-    enc_out = text_encoder1(input_ids1, output_hidden_states=True, return_dict=True)
-    hidden_states1 = enc_out["hidden_states"][11]
+    if clip_skip_early_exit:
+        # 12層のうち11層目の出力 / output of the 11th layer of 12 layers
+        hidden_states1 = get_hidden_states_with_early_exit(text_encoder1, input_ids1, 2, False, accelerator)
+    else:
+        enc_out = text_encoder1(input_ids1, output_hidden_states=True, return_dict=True)
+        hidden_states1 = enc_out["hidden_states"][11]
 
-    # text_encoder2
+    # text_encoder2: poolに最後の層が必要なので全層を実行する / run all layers because the last layer is needed for pool
     enc_out = text_encoder2(input_ids2, output_hidden_states=True, return_dict=True)
     hidden_states2 = enc_out["hidden_states"][-2]  # penuultimate layer
 
@@ -4866,7 +5736,6 @@ def get_hidden_states_sdxl(
     pool2 = pool_workaround(unwrapped_text_encoder2, enc_out["last_hidden_state"], input_ids2, tokenizer2.eos_token_id)
 
     # b*n, 77, 768 or 1280 -> b, n*77, 768 or 1280
-    n_size = 1 if max_token_length is None else max_token_length // 75
     hidden_states1 = hidden_states1.reshape((b_size, -1, hidden_states1.shape[-1]))
     hidden_states2 = hidden_states2.reshape((b_size, -1, hidden_states2.shape[-1]))
 
@@ -4874,14 +5743,14 @@ def get_hidden_states_sdxl(
         # bs*3, 77, 768 or 1024
         # encoder1: <BOS>...<EOS> の三連を <BOS>...<EOS> へ戻す
         states_list = [hidden_states1[:, 0].unsqueeze(1)]  # <BOS>
-        for i in range(1, max_token_length, tokenizer1.model_max_length):
+        for i in range(1, n_size * tokenizer1.model_max_length, tokenizer1.model_max_length):
             states_list.append(hidden_states1[:, i : i + tokenizer1.model_max_length - 2])  # <BOS> の後から <EOS> の前まで
         states_list.append(hidden_states1[:, -1].unsqueeze(1))  # <EOS>
         hidden_states1 = torch.cat(states_list, dim=1)
 
         # v2: <BOS>...<EOS> <PAD> ... の三連を <BOS>...<EOS> <PAD> ... へ戻す　正直この実装でいいのかわからん
         states_list = [hidden_states2[:, 0].unsqueeze(1)]  # <BOS>
-        for i in range(1, max_token_length, tokenizer2.model_max_length):
+        for i in range(1, n_size * tokenizer2.model_max_length, tokenizer2.model_max_length):
             chunk = hidden_states2[:, i : i + tokenizer2.model_max_length - 2]  # <BOS> の後から 最後の前まで
             # this causes an error:
             # RuntimeError: one of the variables needed for gradient computation has been modified by an inplace operation
@@ -5097,7 +5966,7 @@ def save_and_remove_state_on_epoch_end(args: argparse.Namespace, accelerator, ep
             shutil.rmtree(state_dir_old)
 
 
-def save_and_remove_state_stepwise(args: argparse.Namespace, accelerator, step_no):
+def save_and_remove_state_stepwise(args: argparse.Namespace, accelerator, step_no, checkpointer: Optional["AsyncCheckpointer"] = None):
     model_name = default_if_none(args.output_name, DEFAULT_STEP_NAME)
 
     print("")
@@ -5105,11 +5974,8 @@ def save_and_remove_state_stepwise(args: argparse.Namespace, accelerator, step_n
     os.makedirs(args.output_dir, exist_ok=True)
 
     state_dir = os.path.join(args.output_dir, STEP_STATE_NAME.format(model_name, step_no))
-    accelerator.save_state(state_dir)
-    if args.save_state_to_huggingface:
-        print("uploading state to huggingface.")
-        huggingface_util.upload(args, state_dir, "/" + STEP_STATE_NAME.format(model_name, step_no))
 
+    state_dir_old = None
     last_n_steps = args.save_last_n_steps_state if args.save_last_n_steps_state else args.save_last_n_steps
     if last_n_steps is not None:
         # last_n_steps前のstep_noから、save_every_n_stepsの倍数のstep_noを計算して削除する
@@ -5118,9 +5984,36 @@ def save_and_remove_state_stepwise(args: argparse.Namespace, accelerator, step_n
 
         if remove_step_no > 0:
             state_dir_old = os.path.join(args.output_dir, STEP_STATE_NAME.format(model_name, remove_step_no))
-            if os.path.exists(state_dir_old):
-                print(f"removing old state: {state_dir_old}")
-                shutil.rmtree(state_dir_old)
+
+    upload_path = "/" + STEP_STATE_NAME.format(model_name, step_no) if args.save_state_to_huggingface else None
+
+    if checkpointer is None:
+        accelerator.save_state(state_dir)
+        finish_state_saving(args, None, state_dir, upload_path, state_dir_old)
+    else:
+        # ローカルの一時ディレクトリに保存し、出力先への移動、アップロード、古いstateの削除はバックグラウンドで行う
+        # save to local staging directory, and move to output_dir, upload and remove old state in background
+        staging_dir = tempfile.mkdtemp(prefix="state-", dir=getattr(args, "async_save_staging_dir", None))
+        accelerator.save_state(staging_dir)
+        checkpointer.submit(finish_state_saving, args, staging_dir, state_dir, upload_path, state_dir_old)
+
+
+def finish_state_saving(
+    args: argparse.Namespace, staging_dir: Optional[str], state_dir: str, upload_path: Optional[str], state_dir_old: Optional[str]
+):
+    if staging_dir is not None:
+        if os.path.exists(state_dir):
+            shutil.rmtree(state_dir)
+        shutil.move(staging_dir, state_dir)
+        print(f"\nstate saved: {state_dir}")
+
+    if upload_path is not None:
+        print("uploading state to huggingface.")
+        huggingface_util.upload(args, state_dir, upload_path)
+
+    if state_dir_old is not None and os.path.exists(state_dir_old):
+        print(f"removing old state: {state_dir_old}")
+        shutil.rmtree(state_dir_old)
 
 
 def save_state_on_train_end(args: argparse.Namespace, accelerator):
@@ -5731,3 +6624,395 @@ class LossRecorder:
     @property
     def moving_average(self) -> float:
         return self.loss_total / len(self.loss_list)
+
+
+class AsyncCheckpointer:
+    r"""
+    チェックポイントの書き出しをバックグラウンドのスレッドで行う。state_dictはpinned memoryにスナップショットしてから学習を続ける
+    write checkpoints in a background thread. state_dict is snapshotted to (pinned) CPU buffers, then training continues immediately.
+    jobs are executed in order by one thread, so rotation (removing old checkpoints) is done after the new one is written.
+    the number of in-flight state_dict saves is bounded by max_in_flight, other jobs (rotation, finishing states) are queued without waiting.
+    wait() must be called before exit to complete all saves
+    """
+
+    def __init__(self, max_in_flight: int = 1):
+        self.max_in_flight = max(1, max_in_flight)
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="checkpointer")
+        self.futures: collections.deque = collections.deque()  # state_dict saves, bounded by max_in_flight
+        self.jobs: collections.deque = collections.deque()  # other jobs, not bounded
+        self.free_buffers: List[Dict[str, torch.Tensor]] = []  # reused between saves
+        self.lock = threading.Lock()
+
+    def _remove_finished_jobs(self):
+        # 完了したジョブを取り除く。例外があればここで送出される / remove finished jobs. exceptions are raised here
+        while len(self.jobs) > 0 and self.jobs[0].done():
+            self.jobs.popleft().result()
+
+    def _wait_for_slot(self):
+        # 完了したものを取り除き、上限に達していれば最も古いものを待つ。例外があればここで送出される
+        # remove completed saves, and wait for the oldest save if the limit is reached. exceptions are raised here
+        self._remove_finished_jobs()
+        while len(self.futures) > 0 and (self.futures[0].done() or len(self.futures) >= self.max_in_flight):
+            self.futures.popleft().result()
+
+    def submit(self, fn, *args, **kwargs):
+        r"""
+        fnをバックグラウンドで呼び出す。先に投入された書き出しの後に実行されるが、書き出しの完了は待たない
+        call fn in background after the previously submitted saves, without waiting for a slot
+        """
+        self._remove_finished_jobs()
+        self.jobs.append(self.executor.submit(fn, *args, **kwargs))
+
+    def submit_state_dict(self, fn, state_dict: Dict[str, torch.Tensor], *args, **kwargs):
+        r"""
+        state_dictをCPUのバッファにコピーしてから、fn(copied_state_dict, *args, **kwargs)をバックグラウンドで呼び出す
+        copy state_dict to CPU buffers, and call fn(copied_state_dict, *args, **kwargs) in background
+        """
+        self._wait_for_slot()
+
+        with self.lock:
+            buffers = self.free_buffers.pop() if len(self.free_buffers) > 0 else {}
+        pin_memory = torch.cuda.is_available()
+        for key in list(buffers.keys()):
+            if key not in state_dict:
+                del buffers[key]
+        for key, value in state_dict.items():
+            buffer = buffers.get(key)
+            if buffer is None or buffer.shape != value.shape or buffer.dtype != value.dtype:
+                buffer = torch.empty(value.shape, dtype=value.dtype, device="cpu", pin_memory=pin_memory)
+                buffers[key] = buffer
+            buffer.copy_(value.detach(), non_blocking=pin_memory)
+
+        # copies are ordered before later updates of the parameters on the same stream, so only the writer waits for them
+        copy_done = None
+        if pin_memory:
+            copy_done = torch.cuda.Event()
+            copy_done.record()
+
+        def job():
+            try:
+                if copy_done is not None:
+                    copy_done.synchronize()
+                fn(buffers, *args, **kwargs)
+            finally:
+                with self.lock:
+                    self.free_buffers.append(buffers)
+
+        self.futures.append(self.executor.submit(job))
+
+    def wait(self):
+        while len(self.futures) > 0:
+            self.futures.popleft().result()
+        while len(self.jobs) > 0:
+            self.jobs.popleft().result()
+
+    def shutdown(self):
+        self.wait()
+        self.executor.shutdown(wait=True)
+
+
+class DeviceMetricAccumulator:
+    r"""
+    lossなどのメトリクスをデバイス上のtensorのまま貯めておき、interval回ごとにまとめてホストに転送する。.item()による毎ステップの同期を避ける
+    accumulate metrics as device tensors and transfer them to the host at once every `interval` steps, to avoid device sync by .item() every step.
+    records can be nested dicts, tensors in them are replaced with python floats by flush()
+    """
+
+    def __init__(self, interval: int = 1):
+        self.interval = max(1, interval)
+        self.pending: List[Tuple[dict, dict]] = []
+
+    def add(self, info: dict, record: dict) -> None:
+        self.pending.append((info, record))
+
+    def is_full(self) -> bool:
+        return len(self.pending) >= self.interval
+
+    @staticmethod
+    def _collect_tensors(record: dict, tensors: List[torch.Tensor]):
+        for value in record.values():
+            if isinstance(value, torch.Tensor):
+                tensors.append(value.detach().float().reshape(()))
+            elif isinstance(value, dict):
+                DeviceMetricAccumulator._collect_tensors(value, tensors)
+
+    @staticmethod
+    def _resolve_tensors(record: dict, values: List[float]) -> dict:
+        resolved = {}
+        for key, value in record.items():
+            if isinstance(value, torch.Tensor):
+                resolved[key] = values.pop()
+            elif isinstance(value, dict):
+                resolved[key] = DeviceMetricAccumulator._resolve_tensors(value, values)
+            else:
+                resolved[key] = value
+        return resolved
+
+    def flush(self) -> List[Tuple[dict, dict]]:
+        if len(self.pending) == 0:
+            return []
+
+        tensors = []
+        for _, record in self.pending:
+            self._collect_tensors(record, tensors)
+        values = torch.stack([t.to(tensors[0].device) for t in tensors]).cpu().tolist() if len(tensors) > 0 else []  # one sync
+
+        values.reverse()  # pop from the end is faster
+        results = []
+        for info, record in self.pending:
+            results.append((info, self._resolve_tensors(record, values)))
+        self.pending = []
+        return results
+
+
+class StepProfiler:
+    r"""
+    学習ステップの各フェーズの時間を計測する。lapを呼ぶと前回のlapからの時間がそのフェーズの時間になる
+    measure time of each phase of training steps. lap(name) records the time since the previous lap as the phase `name`.
+    wall time is measured by perf_counter, device time by CUDA events. the events are read in later steps once query() reports
+    they are complete, so profiling does not add a device sync per step
+    """
+
+    PERCENTILES = [50, 90, 99]
+
+    def __init__(
+        self,
+        enabled: bool,
+        device: torch.device,
+        window: int = 100,
+        trace_file: Optional[str] = None,
+        trace_steps: Optional[Tuple[int, int]] = None,
+    ):
+        self.enabled = enabled
+        self.use_cuda_events = enabled and device.type == "cuda" and torch.cuda.is_available()
+        self.trace_file = trace_file if enabled else None
+        self.trace_steps = trace_steps if trace_steps is not None else (10, 20)
+
+        self.wall_times: Dict[str, collections.deque] = {}
+        self.device_times: Dict[str, collections.deque] = {}
+        self.window = window
+        self.trace_events = []
+
+        self.step = None
+        self.step_start_time = None
+        self.last_lap_time = None
+        self.last_step_end_time = None
+        self.laps = []  # (name, start, end, start event, end event)
+        self.last_event = None
+        self.pending_events: collections.deque = collections.deque()  # (last event of the step, [(name, start, end, trace args)])
+
+    def _record(self, times: Dict[str, collections.deque], name: str, value: float):
+        if name not in times:
+            times[name] = collections.deque(maxlen=self.window)
+        times[name].append(value)
+
+    def _new_event(self):
+        event = torch.cuda.Event(enable_timing=True)
+        event.record()
+        return event
+
+    def start_step(self, step: int):
+        if not self.enabled:
+            return
+        now = time.perf_counter()
+        self.step = step
+        self.laps = []
+        if self.last_step_end_time is not None:
+            # 前のステップの終わりからbatchが来るまでの時間 / time from the end of previous step to the arrival of the batch
+            self.laps.append(("dataloader_wait", self.last_step_end_time, now, None, None))
+        self.step_start_time = now
+        self.last_lap_time = now
+        self.last_event = self._new_event() if self.use_cuda_events else None
+
+    def lap(self, name: str):
+        if not self.enabled or self.step is None:
+            return
+        now = time.perf_counter()
+        event = self._new_event() if self.use_cuda_events else None
+        self.laps.append((name, self.last_lap_time, now, self.last_event, event))
+        self.last_lap_time = now
+        self.last_event = event
+
+    def end_step(self):
+        if not self.enabled or self.step is None:
+            return
+        self.lap("sync_and_log")
+
+        device_laps = []
+        for name, start, end, start_event, end_event in self.laps:
+            self._record(self.wall_times, name, (end - start) * 1000.0)
+
+            args = None
+            if self.trace_file is not None and self.trace_steps[0] <= self.step <= self.trace_steps[1]:
+                args = {"step": self.step}  # device_ms is added when the events are resolved
+                self.trace_events.append(
+                    {"name": name, "ph": "X", "ts": start * 1e6, "dur": (end - start) * 1e6, "pid": 0, "tid": 0, "args": args}
+                )
+            if start_event is not None and end_event is not None:
+                device_laps.append((name, start_event, end_event, args))
+
+        if self.last_event is not None:
+            self.pending_events.append((self.last_event, device_laps))
+        self.resolve_device_times()
+
+        self._record(self.wall_times, "step", (self.last_lap_time - self.step_start_time) * 1000.0)
+
+        if self.trace_file is not None and self.step == self.trace_steps[1]:
+            self.save_trace()
+
+        self.last_step_end_time = self.last_lap_time
+        self.step = None
+
+    def resolve_device_times(self, wait: bool = False):
+        # 完了したステップのイベントのみ読み取る。waitの場合は同期して残りをすべて読み取る
+        # read events of completed steps only. if wait, synchronize and read all remaining events
+        while len(self.pending_events) > 0:
+            last_event, device_laps = self.pending_events[0]
+            if wait:
+                last_event.synchronize()
+            elif not last_event.query():
+                break
+            self.pending_events.popleft()
+            for name, start_event, end_event, args in device_laps:
+                device_ms = start_event.elapsed_time(end_event)
+                self._record(self.device_times, name, device_ms)
+                if args is not None:
+                    args["device_ms"] = device_ms
+
+    @staticmethod
+    def _percentile(sorted_values: List[float], p: int) -> float:
+        index = min(len(sorted_values) - 1, max(0, math.ceil(p / 100 * len(sorted_values)) - 1))  # nearest rank
+        return sorted_values[index]
+
+    def get_logs(self) -> Dict[str, float]:
+        logs = {}
+        if not self.enabled:
+            return logs
+        for prefix, times in [("profile/wall", self.wall_times), ("profile/device", self.device_times)]:
+            for name, values in times.items():
+                sorted_values = sorted(values)
+                for p in self.PERCENTILES:
+                    logs[f"{prefix}/{name}_p{p}_ms"] = self._percentile(sorted_values, p)
+        return logs
+
+    def print_summary(self):
+        if not self.enabled or len(self.wall_times) == 0:
+            return
+        self.resolve_device_times(wait=True)
+        print(f"step time breakdown (last {self.window} steps, ms) / ステップ時間の内訳（直近{self.window}ステップ、ms）:")
+        for name, values in self.wall_times.items():
+            sorted_values = sorted(values)
+            line = f"  {name:>16}: " + ", ".join([f"p{p} {self._percentile(sorted_values, p):.1f}" for p in self.PERCENTILES])
+            if name in self.device_times:
+                device_values = sorted(self.device_times[name])
+                line += " / device " + ", ".join(
+                    [f"p{p} {self._percentile(device_values, p):.1f}" for p in self.PERCENTILES]
+                )
+            print(line)
+
+    def save_trace(self):
+        if self.trace_file is None or len(self.trace_events) == 0:
+            return
+        self.resolve_device_times(wait=True)
+        print(f"saving step trace / ステップのトレースを保存します: {self.trace_file}")
+        with open(self.trace_file, "w") as f:
+            json.dump({"traceEvents": self.trace_events, "displayTimeUnit": "ms"}, f)
+        self.trace_events = []
+        self.trace_file = None  # save only once
+
+
+class DatasetStageRecord:
+    r"""
+    __getitem__の1回分のステージごとの時間とカウンタ。stage_statsがNoneの場合は何もしない
+    timers and counters of one __getitem__ call. does nothing if stage_stats is None
+    """
+
+    def __init__(self, stage_stats: Optional["DatasetStageStats"]):
+        self.enabled = stage_stats is not None
+        if self.enabled:
+            self.index = stage_stats.index
+            self.values = [0.0] * len(stage_stats.keys)
+            self.last_time = time.perf_counter()
+
+    def lap(self, stage: str):
+        if not self.enabled:
+            return
+        now = time.perf_counter()
+        self.values[self.index["time/" + stage]] += now - self.last_time
+        self.last_time = now
+
+    def count(self, name: str, n: int = 1):
+        if self.enabled:
+            self.values[self.index[name]] += n
+
+
+class DatasetStageStats:
+    r"""
+    DataLoaderのworkerで集計した__getitem__のステージごとの時間とカウンタを、共有メモリ経由でメインプロセスに集める
+    collect per-stage timers and counters of __getitem__ from DataLoader workers to the main process via shared memory.
+    each worker (and the main process) adds to its own row of a torch shared memory tensor, so no lock is needed and the object
+    can be pickled to workers with the spawn start method. the counters are never reset in workers: the main process reports
+    the difference from the previous report
+    """
+
+    STAGES = [
+        "latents_load",
+        "decode",
+        "crop_resize",
+        "augmentation",
+        "te_outputs_load",
+        "process_caption",
+        "tokenize",
+        "collate",
+    ]
+    COUNTERS = [
+        "samples",
+        "bytes_read",
+        "images_decoded",
+        "latents_cache_hit",
+        "latents_cache_miss",
+        "resized_image_cache_hit",
+        "te_outputs_cache_hit",
+        "te_outputs_cache_miss",
+        "tokenizer_calls",
+    ]
+
+    def __init__(self, num_workers: int):
+        self.keys = ["time/" + stage for stage in self.STAGES] + self.COUNTERS
+        self.index = {key: i for i, key in enumerate(self.keys)}
+        # row 0 is the main process (num_workers=0), row i+1 is the worker i
+        self.values = torch.zeros((num_workers + 1, len(self.keys)), dtype=torch.float64).share_memory_()
+        self.last_values = torch.zeros(len(self.keys), dtype=torch.float64)
+
+    def new_record(self) -> DatasetStageRecord:
+        return DatasetStageRecord(self)
+
+    def add(self, record: DatasetStageRecord):
+        # 各workerは自分の行にのみ書き込む / each worker writes to its own row only
+        worker_info = torch.utils.data.get_worker_info()
+        row = 0 if worker_info is None else worker_info.id + 1
+        self.values[row] += torch.tensor(record.values, dtype=torch.float64)
+
+    def report_and_reset(self, epoch: int, verbose: bool = True) -> Dict[str, float]:
+        # 全プロセス（rank）で呼び出す。表示はverboseの場合のみ / call on every rank, print only if verbose
+        current_values = self.values.sum(dim=0)
+        values = (current_values - self.last_values).tolist()
+        self.last_values = current_values
+
+        logs = {}
+        for stage, value in zip(self.STAGES, values):
+            logs[f"dataset/time/{stage}"] = value
+        for name, value in zip(self.COUNTERS, values[len(self.STAGES) :]):
+            logs[f"dataset/{name}"] = value
+        if not verbose:
+            return logs
+
+        total_time = sum(values[: len(self.STAGES)])
+        print(f"dataset stage stats for epoch {epoch} / エポック{epoch}のデータセットのステージごとの統計:")
+        for stage, value in zip(self.STAGES, values):
+            if value > 0:
+                ratio = value / total_time * 100 if total_time > 0 else 0.0
+                print(f"  {stage:>16}: {value:.2f}s ({ratio:.1f}%)")
+        for name, value in zip(self.COUNTERS, values[len(self.STAGES) :]):
+            print(f"  {name:>16}: {int(value)}")
+        return logs
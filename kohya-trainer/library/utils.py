@@ -7,7 +7,6 @@ from typing import *
 from diffusers import EulerAncestralDiscreteScheduler
 import diffusers.schedulers.scheduling_euler_ancestral_discrete
 from diffusers.schedulers.scheduling_euler_ancestral_discrete import EulerAncestralDiscreteSchedulerOutput
-import cv2
 from PIL import Image
 import numpy as np
 
@@ -16,6 +15,15 @@ def fire_in_thread(f, *args, **kwargs):
     threading.Thread(target=f, args=args, kwargs=kwargs).start()
 
 
+def tensor_to_bytes_view(tensor: torch.Tensor) -> memoryview:
+    r"""
+    tensorの生のバイト列（safetensorsと同じlittle endian、C連続）を返す。CPU上の連続したtensorならコピーしない
+    returns raw bytes of the tensor (little endian and C-contiguous, same as safetensors). no copy if the tensor is contiguous on CPU
+    """
+    t = tensor.detach().cpu().contiguous()
+    return memoryview(t.reshape(-1).view(torch.uint8).numpy())
+
+
 def add_logging_arguments(parser):
     parser.add_argument(
         "--console_log_level",
@@ -83,22 +91,10 @@ def setup_logging(args=None, log_level=None, reset=False):
 
 
 def pil_resize(image, size, interpolation=Image.LANCZOS):
-    has_alpha = image.shape[2] == 4 if len(image.shape) == 3 else False
-
-    if has_alpha:
-        pil_image = Image.fromarray(cv2.cvtColor(image, cv2.COLOR_BGRA2RGBA))
-    else:
-        pil_image = Image.fromarray(cv2.cvtColor(image, cv2.COLOR_BGR2RGB))
-
+    # resizing is done per channel, so the channel order (RGB or BGR) is kept as is without conversion
+    pil_image = Image.fromarray(image)
     resized_pil = pil_image.resize(size, interpolation)
-
-    # Convert back to cv2 format
-    if has_alpha:
-        resized_cv2 = cv2.cvtColor(np.array(resized_pil), cv2.COLOR_RGBA2BGRA)
-    else:
-        resized_cv2 = cv2.cvtColor(np.array(resized_pil), cv2.COLOR_RGB2BGR)
-
-    return resized_cv2
+    return np.array(resized_pil)
 
 
 # TODO make inf_utils.py
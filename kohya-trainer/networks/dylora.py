@@ -78,6 +78,16 @@ class DyLoRAModule(torch.nn.Module):
         self.org_module.forward = self.forward
         del self.org_module
 
+    def get_multiplier(self, lx):
+        # サンプルごとのmultiplier（tensor）はbatch次元でbroadcastする。Text Encoderではサンプルがchunk数だけ繰り返されている
+        # per-sample multipliers (tensor) are broadcast over the batch dimension. for Text Encoder, each sample is repeated for the chunks
+        if not isinstance(self.multiplier, torch.Tensor):
+            return self.multiplier
+        multiplier = self.multiplier.to(lx.dtype)
+        if lx.size(0) != multiplier.size(0):
+            multiplier = multiplier.repeat_interleave(lx.size(0) // multiplier.size(0))
+        return multiplier.view(-1, *([1] * (lx.dim() - 1)))
+
     def forward(self, x):
         result = self.org_forward(x)
 
@@ -115,7 +125,7 @@ class DyLoRAModule(torch.nn.Module):
                 ab = ab.transpose(1, 2).reshape(ab.size(0), -1, *x.size()[2:])  # (N, H*W, C) -> (N, C, H, W)
 
         # 最後の項は、低rankをより大きくするためのスケーリング（じゃないかな）
-        result = result + ab * self.scale * math.sqrt(self.lora_dim / (trainable_rank + self.unit))
+        result = result + ab * self.get_multiplier(ab) * self.scale * math.sqrt(self.lora_dim / (trainable_rank + self.unit))
 
         # NOTE weightに加算してからlinear/conv2dを呼んだほうが速いかも
         return result
@@ -507,17 +517,12 @@ class DyLoRANetwork(torch.nn.Module):
                 state_dict[key] = v
 
         if os.path.splitext(file)[1] == ".safetensors":
-            from safetensors.torch import save_file
             from library import train_util
 
-            # Precalculate model hashes to save time on indexing
+            # Calculate model hashes while writing the file once, to save time on indexing
             if metadata is None:
                 metadata = {}
-            model_hash, legacy_hash = train_util.precalculate_safetensors_hashes(state_dict, metadata)
-            metadata["sshs_model_hash"] = model_hash
-            metadata["sshs_legacy_hash"] = legacy_hash
-
-            save_file(state_dict, file, metadata)
+            train_util.save_safetensors_with_hashes(state_dict, file, metadata)
         else:
             torch.save(state_dict, file)
 
@@ -3,14 +3,18 @@
 # Thanks to cloneofsimo!
 
 import argparse
+import concurrent.futures
 import json
 import os
 import time
 import torch
+from safetensors import safe_open
 from safetensors.torch import load_file, save_file
 from tqdm import tqdm
-from library import sai_model_spec, model_util, sdxl_model_util
+from library import sai_model_spec, model_util, sdxl_model_util, train_util
 import lora
+from merge_lora import create_lora_name_to_checkpoint_key, create_sdxl_lora_name_to_checkpoint_key
+from resize_lora import svd_batched
 from library.utils import setup_logging
 setup_logging()
 import logging
@@ -32,6 +36,132 @@ def save_to_file(file_name, model, state_dict, dtype):
         torch.save(model, file_name)
 
 
+def build_lora_metadata(save_to, dim, conv_dim, v2, sdxl, v_parameterization, model_version, no_metadata):
+    # minimum metadata
+    net_kwargs = {}
+    if conv_dim is not None:
+        net_kwargs["conv_dim"] = str(conv_dim)
+        net_kwargs["conv_alpha"] = str(float(conv_dim))
+
+    metadata = {
+        "ss_v2": str(v2),
+        "ss_base_model_version": model_version,
+        "ss_network_module": "networks.lora",
+        "ss_network_dim": str(dim),
+        "ss_network_alpha": str(float(dim)),
+        "ss_network_args": json.dumps(net_kwargs),
+    }
+
+    if not no_metadata:
+        title = os.path.splitext(os.path.basename(save_to))[0]
+        sai_metadata = sai_model_spec.build_metadata(None, v2, v_parameterization, sdxl, True, False, time.time(), title=title)
+        metadata.update(sai_metadata)
+    return metadata
+
+
+def extract_lora_streaming(
+    model_org, model_tuned, dim, v2, sdxl, conv_dim, device, load_dtype, save_dtype, clamp_quantile, min_diff, max_workers
+):
+    r"""
+    二つのcheckpointをsafe_openで開き、LoRAの対象のweightごとに差分を計算してSVDする。差分はすぐに解放するので、モデル全体をメモリに載せない
+    open two checkpoints with safe_open, and compute the diff and its SVD for each target weight of LoRA.
+    each diff is freed immediately, so the whole models are not loaded
+    """
+    with safe_open(model_org, framework="pt") as f_org, safe_open(model_tuned, framework="pt") as f_tuned:
+        # text encoderのkeyの形式が異なる場合があるので、それぞれのcheckpointでmapを作る
+        # create maps for each checkpoint because the format of text encoder keys may be different
+        if sdxl:
+            lora_name_to_key_org = create_sdxl_lora_name_to_checkpoint_key(list(f_org.keys()), conv_dim is not None)
+            lora_name_to_key_tuned = create_sdxl_lora_name_to_checkpoint_key(list(f_tuned.keys()), conv_dim is not None)
+        else:
+            lora_name_to_key_org = create_lora_name_to_checkpoint_key(v2, list(f_org.keys()), conv_dim is not None)
+            lora_name_to_key_tuned = create_lora_name_to_checkpoint_key(v2, list(f_tuned.keys()), conv_dim is not None)
+
+        lora_names = [name for name in lora_name_to_key_org.keys() if name in lora_name_to_key_tuned]
+        if v2:
+            # Diffusers形式のSD2のText Encoderは23層で、open clipの最後の層は使わない
+            # Text Encoder of SD2 in Diffusers format has 23 layers, the last layer of open clip is not used
+            lora_names = [name for name in lora_names if "_text_model_encoder_layers_23_" not in name]
+
+        def get_weight(f, lora_name_to_key, lora_name):
+            key, index, num_chunks = lora_name_to_key[lora_name]
+            if num_chunks == 1:
+                weight = f.get_tensor(key)
+            else:
+                tensor_slice = f.get_slice(key)
+                chunk_size = tensor_slice.get_shape()[0] // num_chunks
+                weight = tensor_slice[index * chunk_size : (index + 1) * chunk_size]
+            if load_dtype is not None:
+                weight = weight.to(load_dtype)
+            return weight
+
+        def extract(lora_name):
+            with torch.no_grad():
+                weight_org = get_weight(f_org, lora_name_to_key_org, lora_name)
+                weight_tuned = get_weight(f_tuned, lora_name_to_key_tuned, lora_name)
+                if device:
+                    weight_org = weight_org.to(device)
+                    weight_tuned = weight_tuned.to(device)
+                mat = weight_tuned.to(torch.float) - weight_org.to(torch.float)  # calc by float
+                del weight_org, weight_tuned
+                max_diff = float(torch.max(torch.abs(mat)))
+
+                conv2d = len(mat.size()) == 4
+                kernel_size = None if not conv2d else mat.size()[2:4]
+                conv2d_3x3 = conv2d and kernel_size != (1, 1)
+
+                rank = dim if not conv2d_3x3 else conv_dim
+                out_dim, in_dim = mat.size()[0:2]
+                rank = min(rank, in_dim, out_dim)  # LoRA rank cannot exceed the original dim
+
+                U, S, Vh = torch.linalg.svd(mat.flatten(start_dim=1), full_matrices=False)
+                del mat
+
+                U = U[:, :rank]
+                S = S[:rank]
+                U = U @ torch.diag(S)
+
+                Vh = Vh[:rank, :]
+
+                dist = torch.cat([U.flatten(), Vh.flatten()])
+                hi_val = torch.quantile(dist, clamp_quantile)
+                low_val = -hi_val
+
+                U = U.clamp(low_val, hi_val)
+                Vh = Vh.clamp(low_val, hi_val)
+
+                if conv2d:
+                    U = U.reshape(out_dim, rank, 1, 1)
+                    Vh = Vh.reshape(rank, in_dim, kernel_size[0], kernel_size[1])
+
+                U = U.to("cpu", dtype=save_dtype).contiguous()
+                Vh = Vh.to("cpu", dtype=save_dtype).contiguous()
+            return U, Vh, max_diff
+
+        # 同時に読み込む差分はmax_workers個まで / at most max_workers diffs are loaded at the same time
+        print("calculating by svd")
+        lora_sd = {}
+        text_encoder_max_diff = 0.0
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for lora_name, (up_weight, down_weight, max_diff) in zip(
+                lora_names, tqdm(executor.map(extract, lora_names), total=len(lora_names))
+            ):
+                if lora_name.startswith(lora.LoRANetwork.LORA_PREFIX_TEXT_ENCODER):
+                    text_encoder_max_diff = max(text_encoder_max_diff, max_diff)
+                lora_sd[lora_name + ".lora_up.weight"] = up_weight
+                lora_sd[lora_name + ".lora_down.weight"] = down_weight
+                lora_sd[lora_name + ".alpha"] = torch.tensor(down_weight.size()[0])
+
+    # Text Encoder might be same
+    if text_encoder_max_diff > min_diff:
+        print(f"Text encoder is different. {text_encoder_max_diff} > {min_diff}")
+    else:
+        print("Text encoder is same. Extract U-Net only.")
+        lora_sd = {k: v for k, v in lora_sd.items() if not k.startswith(lora.LoRANetwork.LORA_PREFIX_TEXT_ENCODER)}
+
+    return lora_sd
+
+
 def svd(
     model_org=None,
     model_tuned=None,
@@ -49,6 +179,8 @@ def svd(
     load_precision=None,
     load_original_model_to=None,
     load_tuned_model_to=None,
+    max_workers=1,
+    streaming=False,
 ):
     def str_to_dtype(p):
         if p == "float":
@@ -67,6 +199,34 @@ def svd(
     save_dtype = str_to_dtype(save_precision)
     work_device = "cpu"
 
+    if streaming:
+        assert model_util.is_safetensors(model_org) and model_util.is_safetensors(
+            model_tuned
+        ), "streaming mode supports safetensors only / ストリーミングモードはsafetensorsのみ対応しています"
+
+        lora_sd = extract_lora_streaming(
+            model_org, model_tuned, dim, v2, sdxl, conv_dim, device, load_dtype, save_dtype, clamp_quantile, min_diff, max_workers
+        )
+
+        if sdxl:
+            model_version = sdxl_model_util.MODEL_VERSION_SDXL_BASE_V1_0
+        else:
+            model_version = model_util.get_model_version_str_for_sd1_sd2(v2, v_parameterization)
+        metadata = build_lora_metadata(save_to, dim, conv_dim, v2, sdxl, v_parameterization, model_version, no_metadata)
+
+        dir_name = os.path.dirname(save_to)
+        if dir_name and not os.path.exists(dir_name):
+            os.makedirs(dir_name, exist_ok=True)
+
+        if save_dtype is not None:
+            lora_sd = {k: v.to(save_dtype) for k, v in lora_sd.items()}
+        if model_util.is_safetensors(save_to):
+            train_util.save_safetensors_with_hashes(lora_sd, save_to, metadata)
+        else:
+            torch.save(lora_sd, save_to)
+        print(f"LoRA weights are saved to: {save_to}")
+        return
+
     # load models
     if not sdxl:
         print(f"loading original SD model : {model_org}")
@@ -170,34 +330,31 @@ def svd(
 
     # make LoRA with svd
     print("calculating by svd")
-    lora_weights = {}
-    with torch.no_grad():
-        for lora_name, mat in tqdm(list(diffs.items())):
-            if args.device:
-                mat = mat.to(args.device)
-            mat = mat.to(torch.float)  # calc by float
 
-            # if conv_dim is None, diffs do not include LoRAs for conv2d-3x3
-            conv2d = len(mat.size()) == 4
-            kernel_size = None if not conv2d else mat.size()[2:4]
-            conv2d_3x3 = conv2d and kernel_size != (1, 1)
+    # 形状の同じモジュールをまとめてSVDする / decompose modules with the same shape together
+    svd_inputs = {}
+    module_sizes = {}
+    for lora_name, mat in diffs.items():
+        # floatへの変換はsvd_batchedでバッチごとに行う / converted to float for each batch in svd_batched
+        # if conv_dim is None, diffs do not include LoRAs for conv2d-3x3
+        conv2d = len(mat.size()) == 4
+        kernel_size = None if not conv2d else mat.size()[2:4]
+        conv2d_3x3 = conv2d and kernel_size != (1, 1)
 
-            rank = dim if not conv2d_3x3 or conv_dim is None else conv_dim
-            out_dim, in_dim = mat.size()[0:2]
+        rank = dim if not conv2d_3x3 or conv_dim is None else conv_dim
+        out_dim, in_dim = mat.size()[0:2]
+        rank = min(rank, in_dim, out_dim)  # LoRA rank cannot exceed the original dim
 
-            if device:
-                mat = mat.to(device)
+        svd_inputs[lora_name] = (mat.flatten(start_dim=1), None, rank)
+        module_sizes[lora_name] = mat.size()
+    del diffs
 
-            # print(lora_name, mat.size(), mat.device, rank, in_dim, out_dim)
-            rank = min(rank, in_dim, out_dim)  # LoRA rank cannot exceed the original dim
-
-            if conv2d:
-                if conv2d_3x3:
-                    mat = mat.flatten(start_dim=1)
-                else:
-                    mat = mat.squeeze()
+    lora_weights = {}
+    with torch.no_grad():
+        svd_results = svd_batched(svd_inputs, "full", device, max_workers)
 
-            U, S, Vh = torch.linalg.svd(mat)
+        for lora_name, (_, _, rank) in svd_inputs.items():
+            U, S, Vh = svd_results.pop(lora_name)
 
             U = U[:, :rank]
             S = S[:rank]
@@ -212,9 +369,10 @@ def svd(
             U = U.clamp(low_val, hi_val)
             Vh = Vh.clamp(low_val, hi_val)
 
-            if conv2d:
-                U = U.reshape(out_dim, rank, 1, 1)
-                Vh = Vh.reshape(rank, in_dim, kernel_size[0], kernel_size[1])
+            module_size = module_sizes[lora_name]
+            if len(module_size) == 4:
+                U = U.reshape(module_size[0], rank, 1, 1)
+                Vh = Vh.reshape(rank, module_size[1], module_size[2], module_size[3])
 
             U = U.to(work_device, dtype=save_dtype).contiguous()
             Vh = Vh.to(work_device, dtype=save_dtype).contiguous()
@@ -239,25 +397,7 @@ def svd(
     if dir_name and not os.path.exists(dir_name):
         os.makedirs(dir_name, exist_ok=True)
 
-    # minimum metadata
-    net_kwargs = {}
-    if conv_dim is not None:
-        net_kwargs["conv_dim"] = str(conv_dim)
-        net_kwargs["conv_alpha"] = str(float(conv_dim))
-
-    metadata = {
-        "ss_v2": str(v2),
-        "ss_base_model_version": model_version,
-        "ss_network_module": "networks.lora",
-        "ss_network_dim": str(dim),
-        "ss_network_alpha": str(float(dim)),
-        "ss_network_args": json.dumps(net_kwargs),
-    }
-
-    if not no_metadata:
-        title = os.path.splitext(os.path.basename(save_to))[0]
-        sai_metadata = sai_model_spec.build_metadata(None, v2, v_parameterization, sdxl, True, False, time.time(), title=title)
-        metadata.update(sai_metadata)
+    metadata = build_lora_metadata(save_to, dim, conv_dim, v2, sdxl, v_parameterization, model_version, no_metadata)
 
     lora_network_save.save_weights(save_to, save_dtype, metadata)
     print(f"LoRA weights are saved to: {save_to}")
@@ -349,6 +489,18 @@ def setup_parser() -> argparse.ArgumentParser:
         default=None,
         help="location to load tuned model, cpu or cuda, cuda:0, etc, default is cpu, only for SDXL / 派生モデル読み込み先、cpuまたはcuda、cuda:0など、省略時はcpu、SDXLのみ有効",
     )
+    parser.add_argument(
+        "--max_workers",
+        type=int,
+        default=1,
+        help="number of threads to decompose batches of modules in parallel / モジュールのバッチを並列に分解するスレッド数",
+    )
+    parser.add_argument(
+        "--streaming",
+        action="store_true",
+        help="read both models tensor by tensor and extract LoRA without loading the whole models (safetensors only) / "
+        + "モデル全体を読み込まずにtensorごとに読み込んでLoRAを抽出する（safetensorsのみ）",
+    )
 
     return parser
 
@@ -81,15 +81,33 @@ class LoRAModule(torch.nn.Module):
         self.dropout = dropout
         self.rank_dropout = rank_dropout
         self.module_dropout = module_dropout
+        self.group: Optional["LoRAModuleGroup"] = None  # set if grouped with the modules sharing the input
 
     def apply_to(self):
         self.org_forward = self.org_module.forward
         self.org_module.forward = self.forward
         del self.org_module
 
+    def get_multiplier(self, lx):
+        # サンプルごとのmultiplier（tensor）はbatch次元でbroadcastする。Text Encoderではサンプルがchunk数だけ繰り返されている
+        # per-sample multipliers (tensor) are broadcast over the batch dimension. for Text Encoder, each sample is repeated for the chunks
+        if not isinstance(self.multiplier, torch.Tensor):
+            return self.multiplier
+        multiplier = self.multiplier.to(lx.dtype)
+        if lx.size(0) != multiplier.size(0):
+            multiplier = multiplier.repeat_interleave(lx.size(0) // multiplier.size(0))
+        return multiplier.view(-1, *([1] * (lx.dim() - 1)))
+
     def forward(self, x):
         org_forwarded = self.org_forward(x)
 
+        # grouped execution: dropouts are applied per module, so they are not supported
+        if self.group is not None and not (
+            self.training and (self.dropout is not None or self.rank_dropout is not None or self.module_dropout is not None)
+        ):
+            lx = self.group.get_lora_output(self, x)
+            return org_forwarded + lx * self.get_multiplier(lx) * self.scale
+
         # module dropout
         if self.module_dropout is not None and self.training:
             if torch.rand(1) < self.module_dropout:
@@ -118,7 +136,52 @@ class LoRAModule(torch.nn.Module):
 
         lx = self.lora_up(lx)
 
-        return org_forwarded + lx * self.multiplier * scale
+        return org_forwarded + lx * self.get_multiplier(lx) * scale
+
+
+class LoRAModuleGroup:
+    """
+    同じ入力を持つLoRAModule（to_q/to_k/to_vなど）をまとめて計算する。downは重みを連結して一回のmatmul、upはrankと出力次元が同じなら一回のbmmになる
+    computes LoRA modules sharing the input (to_q/to_k/to_v etc.) together: down projections are concatenated into one matmul,
+    up projections are one bmm if the ranks and out_features match, otherwise separate matmuls for each slice.
+    the weights and the state dict of each module are not changed
+    """
+
+    def __init__(self, loras: List[LoRAModule]):
+        self.loras = loras
+        self.out_features = [lora.lora_up.out_features for lora in loras]
+        self.ranks = [lora.lora_down.out_features for lora in loras]
+        self.uniform = len(set(self.out_features)) == 1 and len(set(self.ranks)) == 1
+        self.input = None
+        self.outputs = {}
+
+    def get_lora_output(self, lora: LoRAModule, x):
+        # 同じ入力で計算済みなら、その結果を返す / return the result computed beforehand for the same input
+        if self.input is x and lora.lora_name in self.outputs:
+            output = self.outputs.pop(lora.lora_name)
+            if len(self.outputs) == 0:
+                self.input = None  # release the reference
+            return output
+
+        # 最初に呼ばれたmoduleで、グループ全体をまとめて計算する / compute the whole group at the first call
+        # 入力が異なった場合（想定外の使われ方）も、毎回まとめて計算し直すので結果は正しい
+        # if the inputs differ (unexpected usage), the result is still correct because the group is computed again
+        down_weight = torch.cat([l.lora_down.weight for l in self.loras], dim=0)
+        lx = torch.nn.functional.linear(x, down_weight)
+        if self.uniform:
+            # (num_loras, batch, rank) @ (num_loras, rank, out_features)
+            num_loras, rank = len(self.loras), self.ranks[0]
+            lx = lx.reshape(-1, num_loras, rank).transpose(0, 1)
+            up_weight = torch.stack([l.lora_up.weight for l in self.loras]).transpose(1, 2)
+            lx = torch.bmm(lx, up_weight)
+            outputs = [o.reshape(*x.shape[:-1], self.out_features[0]) for o in lx.unbind(0)]
+        else:
+            lxs = lx.split(self.ranks, dim=-1)
+            outputs = [torch.nn.functional.linear(lx_i, l.lora_up.weight) for lx_i, l in zip(lxs, self.loras)]
+
+        self.input = x
+        self.outputs = {l.lora_name: o for l, o in zip(self.loras, outputs) if l is not lora}
+        return outputs[self.loras.index(lora)]
 
 
 class LoRAInfModule(LoRAModule):
@@ -202,18 +265,18 @@ class LoRAInfModule(LoRAModule):
         # pre-calculated weight
         if len(down_weight.size()) == 2:
             # linear
-            weight = self.multiplier * (up_weight @ down_weight) * self.scale
+            weight = multiplier * (up_weight @ down_weight) * self.scale
         elif down_weight.size()[2:4] == (1, 1):
             # conv2d 1x1
             weight = (
-                self.multiplier
+                multiplier
                 * (up_weight.squeeze(3).squeeze(2) @ down_weight.squeeze(3).squeeze(2)).unsqueeze(2).unsqueeze(3)
                 * self.scale
             )
         else:
             # conv2d 3x3
             conved = torch.nn.functional.conv2d(down_weight.permute(1, 0, 2, 3), up_weight).permute(1, 0, 2, 3)
-            weight = self.multiplier * conved * self.scale
+            weight = multiplier * conved * self.scale
 
         return weight
 
@@ -386,6 +449,104 @@ class LoRAInfModule(LoRAModule):
         return out
 
 
+class LoRAMultiAdapter:
+    """
+    同じモジュールに適用された複数のLoRAInfModuleをまとめて計算する。downとupをrank方向に連結し、multiplier*scaleをrankごとに掛けるので、
+    LoRAの数によらずdownとupの二回のmatmulになる。各LoRAのmultiplierとenabledはそのまま使える（パッチし直す必要はない）
+    computes multiple LoRAInfModules applied to the same module together. down and up weights are concatenated in the rank dimension,
+    and multiplier*scale is applied for each rank, so it takes two matmuls regardless of the number of LoRAs.
+    multiplier and enabled of each LoRA work as is, without re-patching
+    """
+
+    def __init__(self, org_module: torch.nn.Module, loras: List[LoRAInfModule]):
+        self.org_module = org_module
+        self.loras = loras
+        self.base_forward = loras[0].org_forward  # forward of the original module
+        self.chained_forward = loras[-1].forward  # forward of the chain of the LoRAs, for regional LoRA etc.
+        self.is_conv2d = isinstance(loras[0].lora_down, torch.nn.Conv2d)
+
+        self.down_weight = None
+        self.up_weight = None
+        self.scales = None
+        self.scales_key = None
+
+    def apply_to(self):
+        self.org_module.forward = self.forward
+
+    def prepare_weights(self):
+        # LoRAの重みは推論中に変わらないので、最初のforwardで一度だけ連結する / LoRA weights don't change in inference, concatenate once
+        self.down_weight = torch.cat([lora.lora_down.weight for lora in self.loras], dim=0)
+        self.up_weight = torch.cat([lora.lora_up.weight for lora in self.loras], dim=1)
+
+    def get_scales(self):
+        key = tuple(lora.multiplier * lora.scale if lora.enabled else 0.0 for lora in self.loras)
+        if key != self.scales_key:
+            scales = [torch.full((lora.lora_dim,), k) for lora, k in zip(self.loras, key)]
+            self.scales = torch.cat(scales).to(self.down_weight.device, dtype=self.down_weight.dtype)
+            if self.is_conv2d:
+                self.scales = self.scales.view(1, -1, 1, 1)
+            self.scales_key = key
+        return self.scales
+
+    def forward(self, x):
+        # regional LoRAやsub promptの処理は各LoRAで行う / regional LoRA and sub prompts are processed by each LoRA
+        for lora in self.loras:
+            if lora.enabled and lora.network is not None and lora.network.sub_prompt_index is not None:
+                if lora.regional or lora.use_sub_prompt:
+                    return self.chained_forward(x)
+
+        if not any(lora.enabled for lora in self.loras):
+            return self.base_forward(x)  # e.g. network_pre_calc
+
+        if self.down_weight is None:
+            self.prepare_weights()
+        scales = self.get_scales()
+
+        if self.is_conv2d:
+            lora_down = self.loras[0].lora_down
+            lx = torch.nn.functional.conv2d(x, self.down_weight, None, lora_down.stride, lora_down.padding)
+            lx = torch.nn.functional.conv2d(lx * scales, self.up_weight)
+        else:
+            lx = torch.nn.functional.linear(x, self.down_weight)
+            lx = torch.nn.functional.linear(lx * scales, self.up_weight)
+        return self.base_forward(x) + lx
+
+
+def apply_multi_adapters(networks: List["LoRANetwork"]) -> int:
+    r"""
+    複数のLoRANetworkが同じモジュールに適用されている場合、LoRAMultiAdapterでまとめて計算するようにする。適用したモジュール数を返す
+    if multiple LoRANetworks are applied to the same module, compute them together with LoRAMultiAdapter. returns the number of the modules
+    """
+    loras_for_module: Dict[int, List[LoRAInfModule]] = {}
+    org_modules: Dict[int, torch.nn.Module] = {}
+    for network in networks:
+        if not isinstance(network, LoRANetwork):
+            continue
+        for lora in network.text_encoder_loras + network.unet_loras:
+            if not isinstance(lora, LoRAInfModule):
+                continue
+            org_module = lora.org_module_ref[0]
+            loras_for_module.setdefault(id(org_module), []).append(lora)
+            org_modules[id(org_module)] = org_module
+
+    num_modules = 0
+    for key, loras in loras_for_module.items():
+        if len(loras) < 2:
+            continue
+
+        # 他のnetworkが間にパッチしている場合は対象外にする / skip if other networks are patched in between
+        org_module = org_modules[key]
+        is_chain = org_module.forward == loras[-1].forward
+        for prev, lora in zip(loras[:-1], loras[1:]):
+            is_chain = is_chain and lora.org_forward == prev.forward
+        if not is_chain:
+            continue
+
+        LoRAMultiAdapter(org_module, loras).apply_to()
+        num_modules += 1
+    return num_modules
+
+
 def parse_block_lr_kwargs(is_sdxl: bool, nw_kwargs: Dict) -> Optional[List[float]]:
     down_lr_weight = nw_kwargs.get("down_lr_weight", None)
     mid_lr_weight = nw_kwargs.get("mid_lr_weight", None)
@@ -493,6 +654,11 @@ def create_network(
         is_sdxl=is_sdxl,
     )
 
+    # q/k/vなど同じ入力を持つmoduleをまとめて計算する / compute the modules sharing the input such as q/k/v together
+    grouped_lora = kwargs.get("grouped_lora", None)
+    if grouped_lora is not None and str(grouped_lora).lower() in ["1", "true", "yes"]:
+        network.set_grouped_lora(True)
+
     loraplus_lr_ratio = kwargs.get("loraplus_lr_ratio", None)
     loraplus_unet_lr_ratio = kwargs.get("loraplus_unet_lr_ratio", None)
     loraplus_text_encoder_lr_ratio = kwargs.get("loraplus_text_encoder_lr_ratio", None)
@@ -874,6 +1040,9 @@ class LoRANetwork(torch.nn.Module):
     LORA_PREFIX_TEXT_ENCODER1 = "lora_te1"
     LORA_PREFIX_TEXT_ENCODER2 = "lora_te2"
 
+    # 同じ入力を持つmoduleの名前の末尾 / suffixes of the names of the modules sharing the input
+    SHARED_INPUT_SUFFIXES = ["_to_q", "_to_k", "_to_v", "_q_proj", "_k_proj", "_v_proj"]
+
     def __init__(
         self,
         text_encoder: Union[List[CLIPTextModel], CLIPTextModel],
@@ -914,10 +1083,12 @@ class LoRANetwork(torch.nn.Module):
         self.dropout = dropout
         self.rank_dropout = rank_dropout
         self.module_dropout = module_dropout
+        self.max_norm_groups = None  # modules grouped by shape for apply_max_norm_regularization
 
         self.loraplus_lr_ratio = None
         self.loraplus_unet_lr_ratio = None
         self.loraplus_text_encoder_lr_ratio = None
+        self.grouped_lora = False
 
         if modules_dim is not None:
             print(f"create LoRA network from weights")
@@ -1094,6 +1265,36 @@ class LoRANetwork(torch.nn.Module):
             lora.apply_to()
             self.add_module(lora.lora_name, lora)
 
+        if self.grouped_lora:
+            self.group_loras_sharing_input()
+
+    def set_grouped_lora(self, grouped_lora):
+        self.grouped_lora = grouped_lora
+
+    def group_loras_sharing_input(self):
+        # 名前から同じ入力を持つmoduleを探す。cross attentionのto_qはto_k/to_vと入力が異なる
+        # find the modules sharing the input by the names. to_q of cross attention has a different input from to_k/to_v
+        groups: Dict[str, List[LoRAModule]] = {}
+        for lora in self.text_encoder_loras + self.unet_loras:
+            if type(lora) != LoRAModule or not isinstance(lora.lora_down, torch.nn.Linear):
+                continue
+            for suffix in LoRANetwork.SHARED_INPUT_SUFFIXES:
+                if lora.lora_name.endswith(suffix):
+                    prefix = lora.lora_name[: -len(suffix)]
+                    if not (suffix == "_to_q" and prefix.endswith("_attn2")):
+                        groups.setdefault(prefix, []).append(lora)
+                    break
+
+        num_grouped = 0
+        for loras in groups.values():
+            if len(loras) < 2:
+                continue
+            group = LoRAModuleGroup(loras)
+            for lora in loras:
+                lora.group = group
+            num_grouped += len(loras)
+        print(f"grouped LoRA modules sharing the input: {num_grouped} modules")
+
     # マージできるかどうかを返す
     def is_mergeable(self):
         return True
@@ -1265,17 +1466,12 @@ class LoRANetwork(torch.nn.Module):
                 state_dict[key] = v
 
         if os.path.splitext(file)[1] == ".safetensors":
-            from safetensors.torch import save_file
             from library import train_util
 
-            # Precalculate model hashes to save time on indexing
+            # Calculate model hashes while writing the file once, to save time on indexing
             if metadata is None:
                 metadata = {}
-            model_hash, legacy_hash = train_util.precalculate_safetensors_hashes(state_dict, metadata)
-            metadata["sshs_model_hash"] = model_hash
-            metadata["sshs_legacy_hash"] = legacy_hash
-
-            save_file(state_dict, file, metadata)
+            train_util.save_safetensors_with_hashes(state_dict, file, metadata)
         else:
             torch.save(state_dict, file)
 
@@ -1330,25 +1526,38 @@ class LoRANetwork(torch.nn.Module):
         self.mask_dic = mask_dic
 
     def backup_weights(self):
-        # 重みのバックアップを行う
+        # 元の重みは複製せず、マージした差分をリストア時に再計算して差し引く
+        # the original weights are not cloned: the merged deltas are recomputed and subtracted on restore
         loras: List[LoRAInfModule] = self.text_encoder_loras + self.unet_loras
         for lora in loras:
             org_module = lora.org_module_ref[0]
-            if not hasattr(org_module, "_lora_org_weight"):
-                sd = org_module.state_dict()
-                org_module._lora_org_weight = sd["weight"].detach().clone()
-                org_module._lora_restored = True
+            if not hasattr(org_module, "_lora_merged"):
+                org_module._lora_merged = []
 
     def restore_weights(self):
-        # 重みのリストアを行う
+        # 重みのリストアを行う。マージした順と逆順に差分を差し引き、丸め誤差で戻らない要素だけ記録した元の値で補正する
+        # restore weights: subtract the deltas in reverse order of merging, and correct only the elements
+        # which do not round-trip (fp16/bf16 rounding) with the recorded original values
         loras: List[LoRAInfModule] = self.text_encoder_loras + self.unet_loras
         for lora in loras:
             org_module = lora.org_module_ref[0]
-            if not org_module._lora_restored:
-                sd = org_module.state_dict()
-                sd["weight"] = org_module._lora_org_weight
-                org_module.load_state_dict(sd)
-                org_module._lora_restored = True
+            merged = getattr(org_module, "_lora_merged", None)
+            if not merged:
+                continue
+
+            sd = org_module.state_dict()
+            weight = sd["weight"]
+            while merged:
+                merged_lora, multiplier, fix_indices, fix_values = merged.pop()
+                if fix_indices is None and fix_values is not None:
+                    weight = fix_values  # the whole original weight is kept
+                    continue
+                lora_weight = merged_lora.get_weight(multiplier).to(weight.device, dtype=weight.dtype)
+                weight = weight - lora_weight
+                if fix_indices is not None:
+                    weight.view(-1)[fix_indices.long()] = fix_values
+            sd["weight"] = weight
+            org_module.load_state_dict(sd)
 
     def pre_calculation(self):
         # 事前計算を行う
@@ -1361,50 +1570,103 @@ class LoRANetwork(torch.nn.Module):
             lora_weight = lora.get_weight().to(org_weight.device, dtype=org_weight.dtype)
             sd["weight"] = org_weight + lora_weight
             assert sd["weight"].shape == org_weight.shape
+
+            # 差分を差し引いても元に戻らない要素だけ元の値を保持する（通常はごく一部）
+            # keep the original values only for the elements which do not round-trip (usually very few)
+            # 元に戻らない要素が多く、全体を保持する方が小さい場合は全体を保持する
+            # keep the whole weight if it is smaller than the sparse fixes (many elements do not round-trip)
+            mismatch = (sd["weight"] - lora_weight != org_weight).reshape(-1).nonzero().squeeze(1)
+            index_dtype = torch.int32 if org_weight.numel() < 2**31 else torch.int64
+            index_size = torch.tensor([], dtype=index_dtype).element_size()
+            if mismatch.numel() == 0:
+                fix_indices, fix_values = None, None
+            elif mismatch.numel() * (index_size + org_weight.element_size()) >= org_weight.numel() * org_weight.element_size():
+                fix_indices, fix_values = None, org_weight.clone()
+            else:
+                fix_indices, fix_values = mismatch.to(index_dtype), org_weight.reshape(-1)[mismatch]
+
             org_module.load_state_dict(sd)
 
-            org_module._lora_restored = False
+            if not hasattr(org_module, "_lora_merged"):
+                org_module._lora_merged = []
+            org_module._lora_merged.append((lora, lora.multiplier, fix_indices, fix_values))
             lora.enabled = False
 
     def apply_max_norm_regularization(self, max_norm_value, device):
-        downkeys = []
-        upkeys = []
-        alphakeys = []
-        norms = []
-        keys_scaled = 0
-
-        state_dict = self.state_dict()
-        for key in state_dict.keys():
-            if "lora_down" in key and "weight" in key:
-                downkeys.append(key)
-                upkeys.append(key.replace("lora_down", "lora_up"))
-                alphakeys.append(key.replace("lora_down.weight", "alpha"))
-
-        for i in range(len(downkeys)):
-            down = state_dict[downkeys[i]].to(device)
-            up = state_dict[upkeys[i]].to(device)
-            alpha = state_dict[alphakeys[i]].to(device)
-            dim = down.shape[0]
-            scale = alpha / dim
-
-            if up.shape[2:] == (1, 1) and down.shape[2:] == (1, 1):
-                updown = (up.squeeze(2).squeeze(2) @ down.squeeze(2).squeeze(2)).unsqueeze(2).unsqueeze(3)
-            elif up.shape[2:] == (3, 3) or down.shape[2:] == (3, 3):
-                updown = torch.nn.functional.conv2d(down.permute(1, 0, 2, 3), up).permute(1, 0, 2, 3)
-            else:
-                updown = up @ down
-
-            updown *= scale
-
-            norm = updown.norm().clamp(min=max_norm_value / 2)
-            desired = torch.clamp(norm, max=max_norm_value)
-            ratio = desired.cpu() / norm.cpu()
-            sqrt_ratio = ratio**0.5
-            if ratio != 1:
-                keys_scaled += 1
-                state_dict[upkeys[i]] *= sqrt_ratio
-                state_dict[downkeys[i]] *= sqrt_ratio
-            scalednorm = updown.norm() * ratio
-            norms.append(scalednorm.item())
-
-        return keys_scaled, sum(norms) / len(norms), max(norms)
+        r"""
+        up@downのFrobeniusノルムを r x r のGram行列から計算する: ||U D||^2 = sum((U^T U) * (D D^T))
+        同じ形状のモジュールはまとめてbmmで計算し、結果の取得時に一回だけ同期する
+        the Frobenius norm of up@down is calculated from r x r Gram matrices: ||U D||^2 = sum((U^T U) * (D D^T)).
+        modules with the same shape are batched with bmm, and it synchronizes only once to get the results
+        """
+        if self.max_norm_groups is None:
+            groups = {}
+            for lora in self.text_encoder_loras + self.unet_loras:
+                key = (tuple(lora.lora_up.weight.shape), tuple(lora.lora_down.weight.shape))
+                groups.setdefault(key, []).append(lora)
+            self.max_norm_groups = list(groups.values())
+
+        all_norms = []
+        all_ratios = []
+        with torch.no_grad():
+            for loras in self.max_norm_groups:
+                ups = torch.stack([lora.lora_up.weight for lora in loras]).to(device, dtype=torch.float32)
+                downs = torch.stack([lora.lora_down.weight for lora in loras]).to(device, dtype=torch.float32)
+                alphas = torch.stack([lora.alpha for lora in loras]).to(device, dtype=torch.float32)
+
+                # conv2d: up (out, r, 1, 1), down (r, in, kh, kw) -> U (out, r), D (r, in*kh*kw)
+                num_modules, out_dim, dim = ups.shape[:3]
+                ups = ups.reshape(num_modules, out_dim, dim)
+                downs = downs.reshape(num_modules, dim, -1)
+                scales = alphas / dim
+
+                gram_up = torch.bmm(ups.transpose(1, 2), ups)
+                gram_down = torch.bmm(downs, downs.transpose(1, 2))
+                norms = (gram_up * gram_down).sum(dim=(1, 2)).clamp(min=0).sqrt() * scales
+
+                clamped_norms = norms.clamp(min=max_norm_value / 2)
+                ratios = clamped_norms.clamp(max=max_norm_value) / clamped_norms
+                sqrt_ratios = ratios.sqrt()
+                for lora, sqrt_ratio in zip(loras, sqrt_ratios):
+                    lora.lora_up.weight.mul_(sqrt_ratio.to(lora.lora_up.weight.device, dtype=lora.lora_up.weight.dtype))
+                    lora.lora_down.weight.mul_(sqrt_ratio.to(lora.lora_down.weight.device, dtype=lora.lora_down.weight.dtype))
+
+                all_norms.append(norms * ratios)
+                all_ratios.append(ratios)
+
+            norms = torch.cat(all_norms)
+            ratios = torch.cat(all_ratios)
+            keys_scaled, mean_norm, max_norm = torch.stack([(ratios != 1).sum().float(), norms.mean(), norms.max()]).tolist()
+
+        return int(keys_scaled), mean_norm, max_norm
+
+
+def check_restore_weights():
+    r"""
+    マージ、multiplierの変更、リストアで元の重みに正確に戻ることを確認する（gen_img.pyでプロンプトごとにmultiplierを変える場合と同じ手順）
+    check that merging, changing the multiplier and restoring returns exactly the original weights (same steps as changing the multiplier per prompt in gen_img.py)
+    """
+    import types
+
+    torch.manual_seed(0)
+    for dtype in [torch.float16, torch.bfloat16, torch.float32]:
+        org_module = torch.nn.Linear(64, 32, bias=False).to(dtype)
+        org_weight = org_module.weight.detach().clone()
+
+        # 同じmoduleに二つのnetworkをマージする / merge two networks to the same module
+        networks = []
+        for i in range(2):
+            lora = LoRAInfModule(f"lora_unet_check_{i}", org_module, multiplier=0.75, lora_dim=4, alpha=1)
+            torch.nn.init.normal_(lora.lora_up.weight)
+            networks.append(types.SimpleNamespace(text_encoder_loras=[], unet_loras=[lora]))
+
+        for network in networks:
+            LoRANetwork.backup_weights(network)
+            LoRANetwork.pre_calculation(network)
+        assert not torch.equal(org_module.weight, org_weight), f"weights are not merged for {dtype}"
+
+        for network in networks:
+            LoRANetwork.set_multiplier(network, 0.25)
+        for network in networks:
+            LoRANetwork.restore_weights(network)
+        assert torch.equal(org_module.weight, org_weight), f"weights are not restored exactly for {dtype}"
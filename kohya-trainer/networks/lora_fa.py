@@ -104,6 +104,16 @@ class LoRAModule(torch.nn.Module):
         self.org_module.forward = self.forward
         del self.org_module
 
+    def get_multiplier(self, lx):
+        # サンプルごとのmultiplier（tensor）はbatch次元でbroadcastする。Text Encoderではサンプルがchunk数だけ繰り返されている
+        # per-sample multipliers (tensor) are broadcast over the batch dimension. for Text Encoder, each sample is repeated for the chunks
+        if not isinstance(self.multiplier, torch.Tensor):
+            return self.multiplier
+        multiplier = self.multiplier.to(lx.dtype)
+        if lx.size(0) != multiplier.size(0):
+            multiplier = multiplier.repeat_interleave(lx.size(0) // multiplier.size(0))
+        return multiplier.view(-1, *([1] * (lx.dim() - 1)))
+
     def forward(self, x):
         org_forwarded = self.org_forward(x)
 
@@ -135,7 +145,7 @@ class LoRAModule(torch.nn.Module):
 
         lx = self.lora_up(lx)
 
-        return org_forwarded + lx * self.multiplier * scale
+        return org_forwarded + lx * self.get_multiplier(lx) * scale
 
 
 class LoRAInfModule(LoRAModule):
@@ -219,18 +229,18 @@ class LoRAInfModule(LoRAModule):
         # pre-calculated weight
         if len(down_weight.size()) == 2:
             # linear
-            weight = self.multiplier * (up_weight @ down_weight) * self.scale
+            weight = multiplier * (up_weight @ down_weight) * self.scale
         elif down_weight.size()[2:4] == (1, 1):
             # conv2d 1x1
             weight = (
-                self.multiplier
+                multiplier
                 * (up_weight.squeeze(3).squeeze(2) @ down_weight.squeeze(3).squeeze(2)).unsqueeze(2).unsqueeze(3)
                 * self.scale
             )
         else:
             # conv2d 3x3
             conved = torch.nn.functional.conv2d(down_weight.permute(1, 0, 2, 3), up_weight).permute(1, 0, 2, 3)
-            weight = self.multiplier * conved * self.scale
+            weight = multiplier * conved * self.scale
 
         return weight
 
@@ -802,6 +812,7 @@ class LoRANetwork(torch.nn.Module):
         self.dropout = dropout
         self.rank_dropout = rank_dropout
         self.module_dropout = module_dropout
+        self.max_norm_groups = None  # modules grouped by shape for apply_max_norm_regularization
 
         if modules_dim is not None:
             print(f"create LoRA network from weights")
@@ -1106,17 +1117,12 @@ class LoRANetwork(torch.nn.Module):
                 state_dict[key] = v
 
         if os.path.splitext(file)[1] == ".safetensors":
-            from safetensors.torch import save_file
             from library import train_util
 
-            # Precalculate model hashes to save time on indexing
+            # Calculate model hashes while writing the file once, to save time on indexing
             if metadata is None:
                 metadata = {}
-            model_hash, legacy_hash = train_util.precalculate_safetensors_hashes(state_dict, metadata)
-            metadata["sshs_model_hash"] = model_hash
-            metadata["sshs_legacy_hash"] = legacy_hash
-
-            save_file(state_dict, file, metadata)
+            train_util.save_safetensors_with_hashes(state_dict, file, metadata)
         else:
             torch.save(state_dict, file)
 
@@ -1164,25 +1170,38 @@ class LoRANetwork(torch.nn.Module):
         self.mask_dic = mask_dic
 
     def backup_weights(self):
-        # 重みのバックアップを行う
+        # 元の重みは複製せず、マージした差分をリストア時に再計算して差し引く
+        # the original weights are not cloned: the merged deltas are recomputed and subtracted on restore
         loras: List[LoRAInfModule] = self.text_encoder_loras + self.unet_loras
         for lora in loras:
             org_module = lora.org_module_ref[0]
-            if not hasattr(org_module, "_lora_org_weight"):
-                sd = org_module.state_dict()
-                org_module._lora_org_weight = sd["weight"].detach().clone()
-                org_module._lora_restored = True
+            if not hasattr(org_module, "_lora_merged"):
+                org_module._lora_merged = []
 
     def restore_weights(self):
-        # 重みのリストアを行う
+        # 重みのリストアを行う。マージした順と逆順に差分を差し引き、丸め誤差で戻らない要素だけ記録した元の値で補正する
+        # restore weights: subtract the deltas in reverse order of merging, and correct only the elements
+        # which do not round-trip (fp16/bf16 rounding) with the recorded original values
         loras: List[LoRAInfModule] = self.text_encoder_loras + self.unet_loras
         for lora in loras:
             org_module = lora.org_module_ref[0]
-            if not org_module._lora_restored:
-                sd = org_module.state_dict()
-                sd["weight"] = org_module._lora_org_weight
-                org_module.load_state_dict(sd)
-                org_module._lora_restored = True
+            merged = getattr(org_module, "_lora_merged", None)
+            if not merged:
+                continue
+
+            sd = org_module.state_dict()
+            weight = sd["weight"]
+            while merged:
+                merged_lora, multiplier, fix_indices, fix_values = merged.pop()
+                if fix_indices is None and fix_values is not None:
+                    weight = fix_values  # the whole original weight is kept
+                    continue
+                lora_weight = merged_lora.get_weight(multiplier).to(weight.device, dtype=weight.dtype)
+                weight = weight - lora_weight
+                if fix_indices is not None:
+                    weight.view(-1)[fix_indices.long()] = fix_values
+            sd["weight"] = weight
+            org_module.load_state_dict(sd)
 
     def pre_calculation(self):
         # 事前計算を行う
@@ -1195,50 +1214,103 @@ class LoRANetwork(torch.nn.Module):
             lora_weight = lora.get_weight().to(org_weight.device, dtype=org_weight.dtype)
             sd["weight"] = org_weight + lora_weight
             assert sd["weight"].shape == org_weight.shape
+
+            # 差分を差し引いても元に戻らない要素だけ元の値を保持する（通常はごく一部）
+            # keep the original values only for the elements which do not round-trip (usually very few)
+            # 元に戻らない要素が多く、全体を保持する方が小さい場合は全体を保持する
+            # keep the whole weight if it is smaller than the sparse fixes (many elements do not round-trip)
+            mismatch = (sd["weight"] - lora_weight != org_weight).reshape(-1).nonzero().squeeze(1)
+            index_dtype = torch.int32 if org_weight.numel() < 2**31 else torch.int64
+            index_size = torch.tensor([], dtype=index_dtype).element_size()
+            if mismatch.numel() == 0:
+                fix_indices, fix_values = None, None
+            elif mismatch.numel() * (index_size + org_weight.element_size()) >= org_weight.numel() * org_weight.element_size():
+                fix_indices, fix_values = None, org_weight.clone()
+            else:
+                fix_indices, fix_values = mismatch.to(index_dtype), org_weight.reshape(-1)[mismatch]
+
             org_module.load_state_dict(sd)
 
-            org_module._lora_restored = False
+            if not hasattr(org_module, "_lora_merged"):
+                org_module._lora_merged = []
+            org_module._lora_merged.append((lora, lora.multiplier, fix_indices, fix_values))
             lora.enabled = False
 
     def apply_max_norm_regularization(self, max_norm_value, device):
-        downkeys = []
-        upkeys = []
-        alphakeys = []
-        norms = []
-        keys_scaled = 0
-
-        state_dict = self.state_dict()
-        for key in state_dict.keys():
-            if "lora_down" in key and "weight" in key:
-                downkeys.append(key)
-                upkeys.append(key.replace("lora_down", "lora_up"))
-                alphakeys.append(key.replace("lora_down.weight", "alpha"))
-
-        for i in range(len(downkeys)):
-            down = state_dict[downkeys[i]].to(device)
-            up = state_dict[upkeys[i]].to(device)
-            alpha = state_dict[alphakeys[i]].to(device)
-            dim = down.shape[0]
-            scale = alpha / dim
-
-            if up.shape[2:] == (1, 1) and down.shape[2:] == (1, 1):
-                updown = (up.squeeze(2).squeeze(2) @ down.squeeze(2).squeeze(2)).unsqueeze(2).unsqueeze(3)
-            elif up.shape[2:] == (3, 3) or down.shape[2:] == (3, 3):
-                updown = torch.nn.functional.conv2d(down.permute(1, 0, 2, 3), up).permute(1, 0, 2, 3)
-            else:
-                updown = up @ down
-
-            updown *= scale
-
-            norm = updown.norm().clamp(min=max_norm_value / 2)
-            desired = torch.clamp(norm, max=max_norm_value)
-            ratio = desired.cpu() / norm.cpu()
-            sqrt_ratio = ratio**0.5
-            if ratio != 1:
-                keys_scaled += 1
-                state_dict[upkeys[i]] *= sqrt_ratio
-                state_dict[downkeys[i]] *= sqrt_ratio
-            scalednorm = updown.norm() * ratio
-            norms.append(scalednorm.item())
-
-        return keys_scaled, sum(norms) / len(norms), max(norms)
+        r"""
+        up@downのFrobeniusノルムを r x r のGram行列から計算する: ||U D||^2 = sum((U^T U) * (D D^T))
+        同じ形状のモジュールはまとめてbmmで計算し、結果の取得時に一回だけ同期する
+        the Frobenius norm of up@down is calculated from r x r Gram matrices: ||U D||^2 = sum((U^T U) * (D D^T)).
+        modules with the same shape are batched with bmm, and it synchronizes only once to get the results
+        """
+        if self.max_norm_groups is None:
+            groups = {}
+            for lora in self.text_encoder_loras + self.unet_loras:
+                key = (tuple(lora.lora_up.weight.shape), tuple(lora.lora_down.weight.shape))
+                groups.setdefault(key, []).append(lora)
+            self.max_norm_groups = list(groups.values())
+
+        all_norms = []
+        all_ratios = []
+        with torch.no_grad():
+            for loras in self.max_norm_groups:
+                ups = torch.stack([lora.lora_up.weight for lora in loras]).to(device, dtype=torch.float32)
+                downs = torch.stack([lora.lora_down.weight for lora in loras]).to(device, dtype=torch.float32)
+                alphas = torch.stack([lora.alpha for lora in loras]).to(device, dtype=torch.float32)
+
+                # conv2d: up (out, r, 1, 1), down (r, in, kh, kw) -> U (out, r), D (r, in*kh*kw)
+                num_modules, out_dim, dim = ups.shape[:3]
+                ups = ups.reshape(num_modules, out_dim, dim)
+                downs = downs.reshape(num_modules, dim, -1)
+                scales = alphas / dim
+
+                gram_up = torch.bmm(ups.transpose(1, 2), ups)
+                gram_down = torch.bmm(downs, downs.transpose(1, 2))
+                norms = (gram_up * gram_down).sum(dim=(1, 2)).clamp(min=0).sqrt() * scales
+
+                clamped_norms = norms.clamp(min=max_norm_value / 2)
+                ratios = clamped_norms.clamp(max=max_norm_value) / clamped_norms
+                sqrt_ratios = ratios.sqrt()
+                for lora, sqrt_ratio in zip(loras, sqrt_ratios):
+                    lora.lora_up.weight.mul_(sqrt_ratio.to(lora.lora_up.weight.device, dtype=lora.lora_up.weight.dtype))
+                    lora.lora_down.weight.mul_(sqrt_ratio.to(lora.lora_down.weight.device, dtype=lora.lora_down.weight.dtype))
+
+                all_norms.append(norms * ratios)
+                all_ratios.append(ratios)
+
+            norms = torch.cat(all_norms)
+            ratios = torch.cat(all_ratios)
+            keys_scaled, mean_norm, max_norm = torch.stack([(ratios != 1).sum().float(), norms.mean(), norms.max()]).tolist()
+
+        return int(keys_scaled), mean_norm, max_norm
+
+
+def check_restore_weights():
+    r"""
+    マージ、multiplierの変更、リストアで元の重みに正確に戻ることを確認する（gen_img.pyでプロンプトごとにmultiplierを変える場合と同じ手順）
+    check that merging, changing the multiplier and restoring returns exactly the original weights (same steps as changing the multiplier per prompt in gen_img.py)
+    """
+    import types
+
+    torch.manual_seed(0)
+    for dtype in [torch.float16, torch.bfloat16, torch.float32]:
+        org_module = torch.nn.Linear(64, 32, bias=False).to(dtype)
+        org_weight = org_module.weight.detach().clone()
+
+        # 同じmoduleに二つのnetworkをマージする / merge two networks to the same module
+        networks = []
+        for i in range(2):
+            lora = LoRAInfModule(f"lora_unet_check_{i}", org_module, multiplier=0.75, lora_dim=4, alpha=1)
+            torch.nn.init.normal_(lora.lora_up.weight)
+            networks.append(types.SimpleNamespace(text_encoder_loras=[], unet_loras=[lora]))
+
+        for network in networks:
+            LoRANetwork.backup_weights(network)
+            LoRANetwork.pre_calculation(network)
+        assert not torch.equal(org_module.weight, org_weight), f"weights are not merged for {dtype}"
+
+        for network in networks:
+            LoRANetwork.set_multiplier(network, 0.25)
+        for network in networks:
+            LoRANetwork.restore_weights(network)
+        assert torch.equal(org_module.weight, org_weight), f"weights are not restored exactly for {dtype}"
@@ -1,11 +1,15 @@
 import math
 import argparse
 import os
+import re
 import time
 import torch
+from accelerate import init_empty_weights
+from safetensors import safe_open
 from safetensors.torch import load_file, save_file
-from library import sai_model_spec, train_util
+from library import sai_model_spec, sdxl_original_unet, train_util
 import library.model_util as model_util
+from library.original_unet import UNet2DConditionModel
 import lora
 from library.utils import setup_logging
 setup_logging()
@@ -113,6 +117,205 @@ def merge_to_sd_model(text_encoder, unet, models, ratios, merge_dtype):
                 module.weight = torch.nn.Parameter(weight)
 
 
+# open clip形式（SD2、SDXLのText Encoder 2）のweightと、対応するLoRAのモジュール名（q/k/vは一つのweightに結合されている）
+# weights in open clip format (SD2, Text Encoder 2 of SDXL) and corresponding LoRA module names (q/k/v are fused into one weight)
+OPEN_CLIP_TO_LORA_MODULES = {
+    "attn.in_proj_weight": ["self_attn_q_proj", "self_attn_k_proj", "self_attn_v_proj"],
+    "attn.out_proj.weight": ["self_attn_out_proj"],
+    "mlp.c_fc.weight": ["mlp_fc1"],
+    "mlp.c_proj.weight": ["mlp_fc2"],
+}
+
+
+def create_text_encoder_lora_name_to_checkpoint_key(checkpoint_keys, checkpoint_prefix, lora_prefix):
+    r"""
+    Text EncoderのLoRAのモジュール名から (checkpointのkey, 結合されたweight内の位置, 結合数) へのmapを作る
+    create a map from LoRA module names of the Text Encoder to (checkpoint key, index in the fused weight, number of fused weights)
+    """
+    lora_name_to_key = {}
+    for key in checkpoint_keys:
+        if not key.startswith(checkpoint_prefix):
+            continue
+        name = key[len(checkpoint_prefix) :]
+
+        m = re.match(r"(?:text_model\.)?encoder\.layers\.(\d+)\.((?:self_attn|mlp)\.\w+)\.weight$", name)
+        if m:
+            lora_name = f"{lora_prefix}_text_model_encoder_layers_{m.group(1)}_{m.group(2).replace('.', '_')}"
+            lora_name_to_key[lora_name] = (key, 0, 1)
+            continue
+
+        m = re.match(r"transformer\.resblocks\.(\d+)\.(.+)$", name)
+        if m and m.group(2) in OPEN_CLIP_TO_LORA_MODULES:
+            module_names = OPEN_CLIP_TO_LORA_MODULES[m.group(2)]
+            for i, module_name in enumerate(module_names):
+                lora_name = f"{lora_prefix}_text_model_encoder_layers_{m.group(1)}_{module_name}"
+                lora_name_to_key[lora_name] = (key, i, len(module_names))
+    return lora_name_to_key
+
+
+def create_unet_lora_name_to_checkpoint_key(unet, key_map=None, include_conv2d_3x3=True):
+    r"""
+    U-NetのLoRAのモジュール名から (checkpointのkey, 0, 1) へのmapを作る。unetはmeta device上に作ったものでよい
+    key_mapはU-Netのstate_dictのkeyからcheckpointのkey（model.diffusion_model.以下）への変換
+    create a map from LoRA module names of the U-Net to (checkpoint key, 0, 1). unet can be created on the meta device.
+    key_map converts the keys of the U-Net state_dict to the checkpoint keys (after model.diffusion_model.)
+    """
+    prefix = lora.LoRANetwork.LORA_PREFIX_UNET
+    target_replace_modules = list(lora.LoRANetwork.UNET_TARGET_REPLACE_MODULE)
+    if include_conv2d_3x3:
+        target_replace_modules += lora.LoRANetwork.UNET_TARGET_REPLACE_MODULE_CONV2D_3X3
+
+    lora_name_to_key = {}
+    for name, module in unet.named_modules():
+        if module.__class__.__name__ in target_replace_modules:
+            for child_name, child_module in module.named_modules():
+                if child_module.__class__.__name__ == "Linear" or child_module.__class__.__name__ == "Conv2d":
+                    lora_name = prefix + "." + name + "." + child_name
+                    lora_name = lora_name.replace(".", "_")
+                    key = name + "." + child_name + ".weight"
+                    if key_map is not None:
+                        key = key_map[key]
+                    lora_name_to_key[lora_name] = ("model.diffusion_model." + key, 0, 1)
+    return lora_name_to_key
+
+
+def create_lora_name_to_checkpoint_key(v2, checkpoint_keys, include_conv2d_3x3=True):
+    # Diffusers形式のU-Netをmeta device上に作り、keyをSD形式に変換する / create Diffusers U-Net on the meta device and convert keys to SD format
+    with init_empty_weights():
+        unet = UNet2DConditionModel(**model_util.create_unet_diffusers_config(v2))
+    unet_keys = [k for k, _ in unet.named_parameters()]
+    key_map = {v: k for k, v in model_util.convert_unet_state_dict_to_sd(False, {k: k for k in unet_keys}).items()}
+
+    lora_name_to_key = create_unet_lora_name_to_checkpoint_key(unet, key_map, include_conv2d_3x3)
+    checkpoint_prefix = "cond_stage_model.model." if v2 else "cond_stage_model.transformer."
+    lora_name_to_key.update(
+        create_text_encoder_lora_name_to_checkpoint_key(checkpoint_keys, checkpoint_prefix, lora.LoRANetwork.LORA_PREFIX_TEXT_ENCODER)
+    )
+    return lora_name_to_key
+
+
+def create_sdxl_lora_name_to_checkpoint_key(checkpoint_keys, include_conv2d_3x3=True):
+    # U-Netのkeyはcheckpointと同じ / keys of U-Net are same to the checkpoint
+    with init_empty_weights():
+        unet = sdxl_original_unet.SdxlUNet2DConditionModel()
+    lora_name_to_key = create_unet_lora_name_to_checkpoint_key(unet, None, include_conv2d_3x3)
+    lora_name_to_key.update(
+        create_text_encoder_lora_name_to_checkpoint_key(
+            checkpoint_keys, "conditioner.embedders.0.transformer.", lora.LoRANetwork.LORA_PREFIX_TEXT_ENCODER1
+        )
+    )
+    lora_name_to_key.update(
+        create_text_encoder_lora_name_to_checkpoint_key(
+            checkpoint_keys, "conditioner.embedders.1.model.", lora.LoRANetwork.LORA_PREFIX_TEXT_ENCODER2
+        )
+    )
+    return lora_name_to_key
+
+
+def collect_lora_deltas(lora_sd, ratio, lora_name_to_key, deltas, get_extra_scale=None):
+    r"""
+    LoRAの各モジュールの up, down, scale を、適用先のcheckpointのkeyごとにdeltasにまとめる
+    collect up, down and scale of each LoRA module into deltas, grouped by the checkpoint key to apply.
+    get_extra_scale(key) returns an additional scale for the lora_down key, such as block weights
+    """
+    for key in lora_sd.keys():
+        if "lora_down" in key:
+            up_key = key.replace("lora_down", "lora_up")
+            alpha_key = key[: key.index("lora_down")] + "alpha"
+
+            module_name = ".".join(key.split(".")[:-2])  # remove trailing ".lora_down.weight"
+            if module_name not in lora_name_to_key:
+                print(f"no module found for LoRA weight: {key}")
+                continue
+
+            down_weight = lora_sd[key]
+            up_weight = lora_sd[up_key]
+
+            dim = down_weight.size()[0]
+            alpha = float(lora_sd.get(alpha_key, dim))
+            scale = alpha / dim
+            if get_extra_scale is not None:
+                scale *= get_extra_scale(key)
+
+            checkpoint_key, index, num_chunks = lora_name_to_key[module_name]
+            deltas.setdefault(checkpoint_key, []).append((index, num_chunks, up_weight, down_weight, ratio * scale))
+    return deltas
+
+
+def apply_lora_deltas(weight, lora_deltas):
+    r"""
+    同じweightに対する複数のLoRAの差分を、rank方向に結合して一度の計算でweightに加える
+    add the deltas of multiple LoRAs for the same weight at once, by concatenating them in the rank dimension
+    """
+    deltas_by_index = {}
+    for index, num_chunks, up_weight, down_weight, scale in lora_deltas:
+        deltas_by_index.setdefault((index, num_chunks), []).append((up_weight, down_weight, scale))
+
+    for (index, num_chunks), items in deltas_by_index.items():
+        chunk_size = weight.size()[0] // num_chunks
+        target = weight.narrow(0, index * chunk_size, chunk_size)
+
+        up_weights = [up_weight.to(weight.device, dtype=weight.dtype) * scale for up_weight, _, scale in items]
+        down_weights = [down_weight.to(weight.device, dtype=weight.dtype) for _, down_weight, _ in items]
+
+        if len(down_weights[0].size()) == 4 and down_weights[0].size()[2:4] != (1, 1):
+            # conv2d 3x3
+            up_weight = torch.cat(up_weights, dim=1)
+            down_weight = torch.cat(down_weights, dim=0)
+            delta = torch.nn.functional.conv2d(down_weight.permute(1, 0, 2, 3), up_weight).permute(1, 0, 2, 3)
+        else:
+            # linear or conv2d 1x1, also handles linear projection mismatch
+            up_weight = torch.cat([w.flatten(1) for w in up_weights], dim=1)
+            down_weight = torch.cat([w.flatten(1) for w in down_weights], dim=0)
+            delta = up_weight @ down_weight
+
+        target += delta.reshape(target.size())
+    return weight
+
+
+def merge_lora_deltas_streaming(sd_model, save_to, deltas, merge_dtype, save_dtype, metadata, max_workers):
+    r"""
+    元のモデルのtensorを一つずつ読み込み、LoRAの差分をまとめて加えて書き出す。モデル全体をメモリに載せない
+    read tensors of the base model one by one, add all LoRA deltas for each tensor at once and write it, without loading the whole model
+    """
+    with safe_open(sd_model, framework="pt") as f:
+        checkpoint_keys = list(f.keys())
+        entries = []
+        for key in checkpoint_keys:
+            tensor_slice = f.get_slice(key)
+            dtype = train_util.TORCH_DTYPES_FROM_SAFETENSORS[tensor_slice.get_dtype()]
+            if dtype.is_floating_point and save_dtype is not None:
+                dtype = save_dtype
+            entries.append((key, dtype, tensor_slice.get_shape()))
+        save_dtypes = {key: dtype for key, dtype, _ in entries}
+
+        for key in set(deltas.keys()) - set(checkpoint_keys):
+            print(f"no weight found in SD model for LoRA: {key}")
+
+        def compute_tensor(key):
+            tensor = f.get_tensor(key)
+            if key in deltas:
+                tensor = apply_lora_deltas(tensor.to(merge_dtype), deltas[key])
+            return tensor.to(save_dtypes[key]).contiguous()
+
+        train_util.save_safetensors_streaming(save_to, entries, compute_tensor, metadata, max_workers)
+
+
+def merge_to_sd_model_streaming(v2, sd_model, save_to, models, ratios, merge_dtype, save_dtype, metadata, max_workers):
+    with safe_open(sd_model, framework="pt") as f:
+        checkpoint_keys = list(f.keys())
+    lora_name_to_key = create_lora_name_to_checkpoint_key(v2, checkpoint_keys)
+
+    deltas = {}
+    for model, ratio in zip(models, ratios):
+        print(f"loading: {model}")
+        lora_sd, _ = load_state_dict(model, merge_dtype)
+        collect_lora_deltas(lora_sd, ratio, lora_name_to_key, deltas)
+
+    print(f"merging and saving SD model to: {save_to}")
+    merge_lora_deltas_streaming(sd_model, save_to, deltas, merge_dtype, save_dtype, metadata, max_workers)
+
+
 def merge_lora_models(models, ratios, merge_dtype, concat=False, shuffle=False):
     base_alphas = {}  # alpha for merged model
     base_dims = {}
@@ -242,11 +445,16 @@ def merge(args):
         save_dtype = merge_dtype
 
     if args.sd_model is not None:
-        print(f"loading SD model: {args.sd_model}")
+        if args.streaming:
+            assert model_util.is_safetensors(args.sd_model) and model_util.is_safetensors(
+                args.save_to
+            ), "streaming mode supports safetensors only / ストリーミングモードはsafetensorsのみ対応しています"
+        else:
+            print(f"loading SD model: {args.sd_model}")
 
-        text_encoder, vae, unet = model_util.load_models_from_stable_diffusion_checkpoint(args.v2, args.sd_model)
+            text_encoder, vae, unet = model_util.load_models_from_stable_diffusion_checkpoint(args.v2, args.sd_model)
 
-        merge_to_sd_model(text_encoder, unet, args.models, args.ratios, merge_dtype)
+            merge_to_sd_model(text_encoder, unet, args.models, args.ratios, merge_dtype)
 
         if args.no_metadata:
             sai_metadata = None
@@ -271,10 +479,15 @@ def merge(args):
                     "Cannot determine if model is for v-prediction, so save metadata as v-prediction / modelがv-prediction用か否か不明なため、仮にv-prediction用としてmetadataを保存します"
                 )
 
-        print(f"saving SD model to: {args.save_to}")
-        model_util.save_stable_diffusion_checkpoint(
-            args.v2, args.save_to, text_encoder, unet, args.sd_model, 0, 0, sai_metadata, save_dtype, vae
-        )
+        if args.streaming:
+            merge_to_sd_model_streaming(
+                args.v2, args.sd_model, args.save_to, args.models, args.ratios, merge_dtype, save_dtype, sai_metadata, args.max_workers
+            )
+        else:
+            print(f"saving SD model to: {args.save_to}")
+            model_util.save_stable_diffusion_checkpoint(
+                args.v2, args.save_to, text_encoder, unet, args.sd_model, 0, 0, sai_metadata, save_dtype, vae
+            )
     else:
         state_dict, metadata, v2 = merge_lora_models(args.models, args.ratios, merge_dtype, args.concat, args.shuffle)
 
@@ -349,6 +562,18 @@ def setup_parser() -> argparse.ArgumentParser:
         help="shuffle lora weight./ "
         + "LoRAの重みをシャッフルする",
     )
+    parser.add_argument(
+        "--streaming",
+        action="store_true",
+        help="merge LoRA into SD model tensor by tensor without loading the whole model (safetensors only) / "
+        + "モデル全体を読み込まずにtensorごとにLoRAをマージする（safetensorsのみ）",
+    )
+    parser.add_argument(
+        "--max_workers",
+        type=int,
+        default=4,
+        help="number of threads to merge tensors in streaming mode / ストリーミングモードでtensorをマージするスレッド数",
+    )
     
     return parser
 
@@ -83,10 +83,12 @@ class OFTModule(torch.nn.Module):
             self.I = self.I.to(block_Q.device)
         I = self.I
         block_R = torch.matmul(I + block_Q, (I - block_Q).float().inverse())
-        block_R_weighted = self.multiplier * (block_R - I) + I
+        block_R_weighted = multiplier * (block_R - I) + I
         return block_R_weighted
 
     def forward(self, x, scale=None):
+        if isinstance(self.multiplier, torch.Tensor):
+            return self.forward_with_multipliers(x)
         if self.multiplier == 0.0:
             return self.org_forward(x)
         org_module = self.org_module[0]
@@ -109,6 +111,33 @@ class OFTModule(torch.nn.Module):
             result = F.linear(x, RW.to(org_dtype), org_module.bias)
         return result
 
+    def forward_with_multipliers(self, x):
+        # R = multiplier * (R1 - I) + I なので、出力は W x + multiplier * (R1 - I) W x になる。multiplierはbatch次元でbroadcastする
+        # R = multiplier * (R1 - I) + I, so the output is W x + multiplier * (R1 - I) W x. multipliers are broadcast over the batch dimension
+        org_module = self.org_module[0]
+        org_dtype = x.dtype
+
+        R = self.get_weight(1.0).to(torch.float32)
+        R = R - self.I
+        W = org_module.weight.to(torch.float32)
+
+        if len(W.shape) == 4:  # Conv2d
+            W_reshaped = einops.rearrange(W, "(k n) ... -> k n ...", k=self.num_blocks, n=self.block_size)
+            RW = torch.einsum("k n m, k n ... -> k m ...", R, W_reshaped)
+            RW = einops.rearrange(RW, "k m ... -> (k m) ...")
+            delta = F.conv2d(x, RW.to(org_dtype), None, org_module.stride, org_module.padding, org_module.dilation, org_module.groups)
+        else:  # Linear
+            W_reshaped = einops.rearrange(W, "(k n) m -> k n m", k=self.num_blocks, n=self.block_size)
+            RW = torch.einsum("k n m, k n p -> k m p", R, W_reshaped)
+            RW = einops.rearrange(RW, "k m p -> (k m) p")
+            delta = F.linear(x, RW.to(org_dtype))
+
+        multiplier = self.multiplier.to(org_dtype)
+        if delta.size(0) != multiplier.size(0):
+            multiplier = multiplier.repeat_interleave(delta.size(0) // multiplier.size(0))
+        multiplier = multiplier.view(-1, *([1] * (delta.dim() - 1)))
+        return self.org_forward(x) + delta * multiplier
+
 
 class OFTInfModule(OFTModule):
     def __init__(
@@ -407,17 +436,12 @@ class OFTNetwork(torch.nn.Module):
                 state_dict[key] = v
 
         if os.path.splitext(file)[1] == ".safetensors":
-            from safetensors.torch import save_file
             from library import train_util
 
-            # Precalculate model hashes to save time on indexing
+            # Calculate model hashes while writing the file once, to save time on indexing
             if metadata is None:
                 metadata = {}
-            model_hash, legacy_hash = train_util.precalculate_safetensors_hashes(state_dict, metadata)
-            metadata["sshs_model_hash"] = model_hash
-            metadata["sshs_legacy_hash"] = legacy_hash
-
-            save_file(state_dict, file, metadata)
+            train_util.save_safetensors_with_hashes(state_dict, file, metadata)
         else:
             torch.save(state_dict, file)
 
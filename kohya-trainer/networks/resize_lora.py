@@ -4,6 +4,7 @@
 
 import os
 import argparse
+import concurrent.futures
 import torch
 from safetensors.torch import load_file, save_file, safe_open
 from tqdm import tqdm
@@ -20,6 +21,9 @@ logger = logging.getLogger(__name__)
 
 MIN_SV = 1e-6
 
+SVD_BACKENDS = ["full", "lowrank", "randomized"]
+SVD_BATCH_MAX_NUMEL = 2**25  # max number of elements of stacked matrices in one batched SVD
+
 # Model save and load functions
 
 
@@ -77,31 +81,98 @@ def index_sv_ratio(S, target):
     return index
 
 
-# Modified from Kohaku-blueleaf's extract/merge functions
-def extract_conv(weight, lora_rank, dynamic_method, dynamic_param, device, scale=1):
-    out_size, in_size, kernel_size, _ = weight.size()
-    U, S, Vh = torch.linalg.svd(weight.reshape(out_size, -1).to(device))
-
-    param_dict = rank_resize(S, lora_rank, dynamic_method, dynamic_param, scale)
-    lora_rank = param_dict["new_rank"]
-
-    U = U[:, :lora_rank]
-    S = S[:lora_rank]
-    U = U @ torch.diag(S)
-    Vh = Vh[:lora_rank, :]
-
-    param_dict["lora_down"] = Vh.reshape(lora_rank, in_size, kernel_size, kernel_size).cpu()
-    param_dict["lora_up"] = U.reshape(out_size, lora_rank, 1, 1).cpu()
-    del U, S, Vh, weight
-    return param_dict
-
-
-def extract_linear(weight, lora_rank, dynamic_method, dynamic_param, device, scale=1):
-    out_size, in_size = weight.size()
+# SVD functions
+
+
+def svd_factored(up, down):
+    r"""
+    W = up @ down のSVDを、Wを作らずに計算する。upとdown^TをQR分解し、r x r の小さな行列だけをSVDする
+    compute SVD of W = up @ down without building W: QR of up and down^T, then SVD of the small r x r core matrix.
+    up: (..., out, r), down: (..., r, in). returns U (..., out, k), S (..., k), Vh (..., k, in), k = min(r, out, in)
+    """
+    Qu, Ru = torch.linalg.qr(up)
+    Qd, Rd = torch.linalg.qr(down.mT)
+    Uc, S, Vhc = torch.linalg.svd(Ru @ Rd.mT, full_matrices=False)
+    return Qu @ Uc, S, Vhc @ Qd.mT
+
+
+def svd_of_product(up, down, svd_backend="full", rank=None, oversample=8, niter=2):
+    r"""
+    up @ down（2次元、またはそのバッチ）のSVDを計算する。downがNoneの場合はup自体を分解する
+    compute SVD of up @ down (2D or batch of them). if down is None, up itself is decomposed.
+    full: exact SVD of the merged matrix
+    lowrank: exact SVD from the factors, rank(up @ down) <= r. falls back to full if r is not smaller than the matrix
+    randomized: torch.svd_lowrank with oversampling and power iterations, only top (rank + oversample) components are returned
+    """
+    if down is None:
+        weight = up
+    elif svd_backend == "lowrank" and up.size()[-1] < min(up.size()[-2], down.size()[-1]):
+        return svd_factored(up, down)
+    else:
+        weight = up @ down
+
+    if svd_backend == "randomized" and rank is not None:
+        q = min(rank + oversample, weight.size()[-2], weight.size()[-1])
+        U, S, V = torch.svd_lowrank(weight, q=q, niter=niter)
+        return U, S, V.mT
+    return torch.linalg.svd(weight, full_matrices=False)
+
+
+def svd_batched(inputs, svd_backend="full", device=None, max_workers=1):
+    r"""
+    形状の同じ行列をまとめてスタックし、バッチ処理でSVDを行う。メモリを抑えるためSVD_BATCH_MAX_NUMEL要素ごとに分割する
+    stack matrices with the same shape and compute SVD in batches, split by SVD_BATCH_MAX_NUMEL elements to bound memory.
+    inputs: dict of name -> (up, down, rank), the matrix is up @ down, or up itself if down is None.
+    returns dict of name -> (U[:, :rank], S, Vh[:rank]) on CPU. S is not truncated
+    """
+    buckets = {}
+    for name, (up, down, rank) in inputs.items():
+        key = (tuple(up.size()), None if down is None else tuple(down.size()), up.dtype, rank)
+        buckets.setdefault(key, []).append(name)
+
+    batches = []
+    for (up_size, down_size, _, rank), names in buckets.items():
+        numel = up_size[0] * (up_size[1] if down_size is None else down_size[1])
+        batch_size = max(1, SVD_BATCH_MAX_NUMEL // numel)
+        for i in range(0, len(names), batch_size):
+            batches.append((names[i : i + batch_size], rank))
+
+    def decompose(batch):
+        names, rank = batch
+        with torch.no_grad():
+            # 入力はfp16/bf16のままでよい。バッチごとにfloatで計算する / inputs may be fp16/bf16, each batch is calculated by float
+            up = torch.stack([inputs[name][0] for name in names])
+            down = None if inputs[names[0]][1] is None else torch.stack([inputs[name][1] for name in names])
+            up = up.to(device or up.device, dtype=torch.float)
+            down = down.to(device or down.device, dtype=torch.float) if down is not None else None
+
+            U, S, Vh = svd_of_product(up, down, svd_backend, rank)
+            return names, U[..., :rank].cpu(), S.cpu(), Vh[..., :rank, :].cpu()
+
+    # バッチごとに独立なのでスレッドで並列に処理する / batches are independent, so they are processed in threads
+    results = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for names, U, S, Vh in tqdm(executor.map(decompose, batches), total=len(batches)):
+            for i, name in enumerate(names):
+                results[name] = (U[i], S[i], Vh[i])
+    return results
+
+
+def svd_reconstruction_error(weight, up, down):
+    r"""
+    rank k の近似 up @ down と、厳密なSVDによる rank k の近似との相対誤差を返す
+    returns relative error between the rank k approximation up @ down and the rank k approximation by exact SVD
+    """
+    k = up.size()[1]
+    U, S, Vh = torch.linalg.svd(weight, full_matrices=False)
+    exact = (U[:, :k] * S[:k]) @ Vh[:k]
+    return float(torch.linalg.norm(up @ down - exact) / torch.linalg.norm(exact).clamp(min=1e-12))
 
-    U, S, Vh = torch.linalg.svd(weight.to(device))
 
-    param_dict = rank_resize(S, lora_rank, dynamic_method, dynamic_param, scale)
+# Modified from Kohaku-blueleaf's extract/merge functions
+def extract_from_svd(U, S, Vh, lora_down_size, lora_up_size, lora_rank, dynamic_method, dynamic_param, scale=1):
+    # linear and conv2d: U, S, Vh are SVD of up @ down flattened to 2D
+    param_dict = rank_resize(S, min(lora_rank, len(S)), dynamic_method, dynamic_param, scale)
     lora_rank = param_dict["new_rank"]
 
     U = U[:, :lora_rank]
@@ -109,42 +180,11 @@ def extract_linear(weight, lora_rank, dynamic_method, dynamic_param, device, sca
     U = U @ torch.diag(S)
     Vh = Vh[:lora_rank, :]
 
-    param_dict["lora_down"] = Vh.reshape(lora_rank, in_size).cpu()
-    param_dict["lora_up"] = U.reshape(out_size, lora_rank).cpu()
-    del U, S, Vh, weight
+    param_dict["lora_down"] = Vh.reshape(lora_rank, *lora_down_size[1:])
+    param_dict["lora_up"] = U.reshape(lora_up_size[0], lora_rank, *lora_up_size[2:])
     return param_dict
 
 
-def merge_conv(lora_down, lora_up, device):
-    in_rank, in_size, kernel_size, k_ = lora_down.shape
-    out_size, out_rank, _, _ = lora_up.shape
-    assert in_rank == out_rank and kernel_size == k_, f"rank {in_rank} {out_rank} or kernel {kernel_size} {k_} mismatch"
-
-    lora_down = lora_down.to(device)
-    lora_up = lora_up.to(device)
-
-    merged = lora_up.reshape(out_size, -1) @ lora_down.reshape(in_rank, -1)
-    weight = merged.reshape(out_size, in_size, kernel_size, kernel_size)
-    del lora_up, lora_down
-    return weight
-
-
-def merge_linear(lora_down, lora_up, device):
-    in_rank, in_size = lora_down.shape
-    out_size, out_rank = lora_up.shape
-    assert in_rank == out_rank, f"rank {in_rank} {out_rank} mismatch"
-
-    lora_down = lora_down.to(device)
-    lora_up = lora_up.to(device)
-
-    weight = lora_up @ lora_down
-    del lora_up, lora_down
-    return weight
-
-
-# Calculate new rank
-
-
 def rank_resize(S, rank, dynamic_method, dynamic_param, scale=1):
     param_dict = {}
 
@@ -191,11 +231,24 @@ def rank_resize(S, rank, dynamic_method, dynamic_param, scale=1):
     return param_dict
 
 
-def resize_lora_model(lora_sd, new_rank, new_conv_rank, save_dtype, device, dynamic_method, dynamic_param, verbose):
+def resize_lora_model(
+    lora_sd,
+    new_rank,
+    new_conv_rank,
+    save_dtype,
+    device,
+    dynamic_method,
+    dynamic_param,
+    verbose,
+    svd_backend="full",
+    check_accuracy=False,
+    max_workers=1,
+):
     network_alpha = None
     network_dim = None
     verbose_str = "\n"
     fro_list = []
+    svd_errors = []
 
     # Extract loaded lora dim and alpha
     for key, value in lora_sd.items():
@@ -215,77 +268,79 @@ def resize_lora_model(lora_sd, new_rank, new_conv_rank, save_dtype, device, dyna
             f"Dynamically determining new alphas and dims based off {dynamic_method}: {dynamic_param}, max rank is {new_rank}"
         )
 
-    lora_down_weight = None
-    lora_up_weight = None
-
     o_lora_sd = lora_sd.copy()
-    block_down_name = None
-    block_up_name = None
-
-    with torch.no_grad():
-        for key, value in tqdm(lora_sd.items()):
-            weight_name = None
-            if "lora_down" in key:
-                block_down_name = key.rsplit(".lora_down", 1)[0]
-                weight_name = key.rsplit(".", 1)[-1]
-                lora_down_weight = value
-            else:
-                continue
-
-            # find corresponding lora_up and alpha
-            block_up_name = block_down_name
-            lora_up_weight = lora_sd.get(block_up_name + ".lora_up." + weight_name, None)
-            lora_alpha = lora_sd.get(block_down_name + ".alpha", None)
-
-            weights_loaded = lora_down_weight is not None and lora_up_weight is not None
-
-            if weights_loaded:
-
-                conv2d = len(lora_down_weight.size()) == 4
-                if lora_alpha is None:
-                    scale = 1.0
-                else:
-                    scale = lora_alpha / lora_down_weight.size()[0]
-
-                if conv2d:
-                    full_weight_matrix = merge_conv(lora_down_weight, lora_up_weight, device)
-                    param_dict = extract_conv(full_weight_matrix, new_conv_rank, dynamic_method, dynamic_param, device, scale)
-                else:
-                    full_weight_matrix = merge_linear(lora_down_weight, lora_up_weight, device)
-                    param_dict = extract_linear(full_weight_matrix, new_rank, dynamic_method, dynamic_param, device, scale)
-
-                if verbose:
-                    max_ratio = param_dict["max_ratio"]
-                    sum_retained = param_dict["sum_retained"]
-                    fro_retained = param_dict["fro_retained"]
-                    if not np.isnan(fro_retained):
-                        fro_list.append(float(fro_retained))
-
-                    verbose_str += f"{block_down_name:75} | "
-                    verbose_str += (
-                        f"sum(S) retained: {sum_retained:.1%}, fro retained: {fro_retained:.1%}, max(S) ratio: {max_ratio:0.1f}"
-                    )
-
-                if verbose and dynamic_method:
-                    verbose_str += f", dynamic | dim: {param_dict['new_rank']}, alpha: {param_dict['new_alpha']}\n"
-                else:
-                    verbose_str += "\n"
-
-                new_alpha = param_dict["new_alpha"]
-                o_lora_sd[block_down_name + "." + "lora_down.weight"] = param_dict["lora_down"].to(save_dtype).contiguous()
-                o_lora_sd[block_up_name + "." + "lora_up.weight"] = param_dict["lora_up"].to(save_dtype).contiguous()
-                o_lora_sd[block_up_name + "." "alpha"] = torch.tensor(param_dict["new_alpha"]).to(save_dtype)
-
-                block_down_name = None
-                block_up_name = None
-                lora_down_weight = None
-                lora_up_weight = None
-                weights_loaded = False
-                del param_dict
+
+    # find corresponding lora_up and alpha for each lora_down
+    modules = []
+    for key, value in lora_sd.items():
+        if "lora_down" not in key:
+            continue
+        block_down_name = key.rsplit(".lora_down", 1)[0]
+        weight_name = key.rsplit(".", 1)[-1]
+        lora_up_weight = lora_sd.get(block_down_name + ".lora_up." + weight_name, None)
+        lora_alpha = lora_sd.get(block_down_name + ".alpha", None)
+        if lora_up_weight is not None:
+            modules.append((block_down_name, value, lora_up_weight, lora_alpha))
+
+    # 形状の同じモジュールをまとめてSVDする / decompose modules with the same shape together
+    svd_inputs = {}
+    for block_down_name, lora_down_weight, lora_up_weight, _ in modules:
+        conv2d = len(lora_down_weight.size()) == 4
+        svd_inputs[block_down_name] = (
+            lora_up_weight.flatten(1),
+            lora_down_weight.flatten(1),
+            new_conv_rank if conv2d else new_rank,
+        )
+    svd_results = svd_batched(svd_inputs, svd_backend, device, max_workers)
+
+    for block_down_name, lora_down_weight, lora_up_weight, lora_alpha in modules:
+        block_up_name = block_down_name
+
+        if lora_alpha is None:
+            scale = 1.0
+        else:
+            scale = lora_alpha / lora_down_weight.size()[0]
+
+        U, S, Vh = svd_results[block_down_name]
+        up, down, lora_rank = svd_inputs[block_down_name]
+        param_dict = extract_from_svd(
+            U, S, Vh, lora_down_weight.size(), lora_up_weight.size(), lora_rank, dynamic_method, dynamic_param, scale
+        )
+        if check_accuracy and svd_backend != "full":
+            svd_errors.append(
+                svd_reconstruction_error(up @ down, param_dict["lora_up"].flatten(1), param_dict["lora_down"].flatten(1))
+            )
+
+        if verbose:
+            max_ratio = param_dict["max_ratio"]
+            sum_retained = param_dict["sum_retained"]
+            fro_retained = param_dict["fro_retained"]
+            if not np.isnan(fro_retained):
+                fro_list.append(float(fro_retained))
+
+            verbose_str += f"{block_down_name:75} | "
+            verbose_str += (
+                f"sum(S) retained: {sum_retained:.1%}, fro retained: {fro_retained:.1%}, max(S) ratio: {max_ratio:0.1f}"
+            )
+
+        if verbose and dynamic_method:
+            verbose_str += f", dynamic | dim: {param_dict['new_rank']}, alpha: {param_dict['new_alpha']}\n"
+        else:
+            verbose_str += "\n"
+
+        new_alpha = param_dict["new_alpha"]
+        o_lora_sd[block_down_name + "." + "lora_down.weight"] = param_dict["lora_down"].to(save_dtype).contiguous()
+        o_lora_sd[block_up_name + "." + "lora_up.weight"] = param_dict["lora_up"].to(save_dtype).contiguous()
+        o_lora_sd[block_up_name + "." "alpha"] = torch.tensor(param_dict["new_alpha"]).to(save_dtype)
 
     if verbose:
         print(verbose_str)
         print(f"Average Frobenius norm retention: {np.mean(fro_list):.2%} | std: {np.std(fro_list):0.3f}")
+    if svd_errors:
+        print(
+            f"SVD accuracy check, relative error to exact SVD: max {np.max(svd_errors):.2e}, mean {np.mean(svd_errors):.2e}"
+            + f" / 厳密なSVDとの相対誤差: 最大 {np.max(svd_errors):.2e}, 平均 {np.mean(svd_errors):.2e}"
+        )
     print("resizing complete")
     return o_lora_sd, network_dim, new_alpha
 
@@ -312,6 +367,8 @@ def resize(args):
 
     if args.dynamic_method and not args.dynamic_param:
         raise Exception("If using dynamic_method, then dynamic_param is required")
+    if args.dynamic_method and args.svd_backend == "randomized":
+        raise Exception("randomized SVD backend cannot be used with dynamic_method, use lowrank instead")
 
     merge_dtype = str_to_dtype("float")  # matmul method above only seems to work in float32
     save_dtype = str_to_dtype(args.save_precision)
@@ -323,7 +380,17 @@ def resize(args):
 
     print("Resizing Lora...")
     state_dict, old_dim, new_alpha = resize_lora_model(
-        lora_sd, args.new_rank, args.new_conv_rank, save_dtype, args.device, args.dynamic_method, args.dynamic_param, args.verbose
+        lora_sd,
+        args.new_rank,
+        args.new_conv_rank,
+        save_dtype,
+        args.device,
+        args.dynamic_method,
+        args.dynamic_param,
+        args.verbose,
+        args.svd_backend,
+        args.check_svd_accuracy,
+        args.max_workers,
     )
 
     # update metadata
@@ -333,9 +400,21 @@ def resize(args):
     comment = metadata.get("ss_training_comment", "")
 
     if not args.dynamic_method:
-        conv_desc = "" if args.new_rank == args.new_conv_rank else f" (conv: {args.new_conv_rank})"
-        metadata["ss_training_comment"] = f"dimension is resized from {old_dim} to {args.new_rank}{conv_desc}; {comment}"
-        metadata["ss_network_dim"] = str(args.new_rank)
+        # new_rankが元のrankより大きい場合はrankが制限されるので、実際のrankを記録する
+        # record the actual ranks, because the rank is capped at the original rank if new_rank is larger
+        ranks = []
+        conv_ranks = []
+        for key, value in state_dict.items():
+            if key.endswith("lora_down.weight"):
+                conv2d_3x3 = len(value.size()) == 4 and value.size()[2:4] != (1, 1)
+                (conv_ranks if conv2d_3x3 else ranks).append(value.size()[0])
+        new_rank = max(ranks, default=args.new_rank)
+        new_conv_rank = max(conv_ranks, default=args.new_conv_rank)
+        if new_rank != args.new_rank or new_conv_rank != args.new_conv_rank:
+            print(f"rank is capped at the original rank: {new_rank} (conv: {new_conv_rank}) / rankは元のrankに制限されます")
+        conv_desc = "" if new_rank == new_conv_rank else f" (conv: {new_conv_rank})"
+        metadata["ss_training_comment"] = f"dimension is resized from {old_dim} to {new_rank}{conv_desc}; {comment}"
+        metadata["ss_network_dim"] = str(new_rank)
         metadata["ss_network_alpha"] = str(new_alpha)
     else:
         metadata["ss_training_comment"] = (
@@ -358,6 +437,28 @@ def resize(args):
     save_to_file(args.save_to, state_dict, metadata)
 
 
+def add_svd_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument(
+        "--svd_backend",
+        type=str,
+        default="full",
+        choices=SVD_BACKENDS,
+        help="SVD method: full (exact SVD of merged weights), lowrank (exact SVD from LoRA factors, fast), randomized (torch.svd_lowrank)"
+        + " / SVDの方法: full（マージした重みの厳密なSVD）、lowrank（LoRAの因子から厳密なSVD、高速）、randomized（torch.svd_lowrank）",
+    )
+    parser.add_argument(
+        "--check_svd_accuracy",
+        action="store_true",
+        help="compare results of lowrank/randomized SVD with exact SVD and show errors / lowrank/randomizedのSVDの結果を厳密なSVDと比較して誤差を表示する",
+    )
+    parser.add_argument(
+        "--max_workers",
+        type=int,
+        default=1,
+        help="number of threads to decompose batches of modules in parallel / モジュールのバッチを並列に分解するスレッド数",
+    )
+
+
 def setup_parser() -> argparse.ArgumentParser:
     parser = argparse.ArgumentParser()
 
@@ -401,6 +502,7 @@ def setup_parser() -> argparse.ArgumentParser:
         help="Specify dynamic resizing method, --new_rank is used as a hard limit for max rank",
     )
     parser.add_argument("--dynamic_param", type=float, default=None, help="Specify target for dynamic reduction")
+    add_svd_arguments(parser)
 
     return parser
 
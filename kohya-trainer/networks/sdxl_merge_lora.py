@@ -5,12 +5,14 @@ import os
 import time
 import concurrent.futures
 import torch
+from safetensors import safe_open
 from safetensors.torch import load_file, save_file
 from tqdm import tqdm
 from library import sai_model_spec, sdxl_model_util, train_util
 import library.model_util as model_util
 import lora
 import oft
+from merge_lora import collect_lora_deltas, create_sdxl_lora_name_to_checkpoint_key, merge_lora_deltas_streaming
 from svd_merge_lora import format_lbws, get_lbw_block_index, LAYER26
 from library.utils import setup_logging
 
@@ -234,6 +236,42 @@ def merge_to_sd_model(text_encoder1, text_encoder2, unet, models, ratios, lbws,
                 list(tqdm(executor.map(merge_to, lora_sd.keys()), total=len(lora_sd.keys())))
 
 
+def merge_to_sd_model_streaming(sd_model, save_to, models, ratios, lbws, merge_dtype, save_dtype, metadata, max_workers):
+    method = detect_method_from_training_model(models, merge_dtype)
+    assert method == "LoRA", "streaming mode supports LoRA only / ストリーミングモードはLoRAのみ対応しています"
+
+    if lbws:
+        lbws, _, LBW_TARGET_IDX = format_lbws(lbws)
+    else:
+        LBW_TARGET_IDX = []
+
+    with safe_open(sd_model, framework="pt") as f:
+        checkpoint_keys = list(f.keys())
+
+    lora_name_to_key = create_sdxl_lora_name_to_checkpoint_key(checkpoint_keys)
+
+    deltas = {}
+    for model, ratio, lbw in itertools.zip_longest(models, ratios, lbws):
+        print(f"loading: {model}")
+        lora_sd, _ = load_state_dict(model, merge_dtype)
+
+        get_extra_scale = None
+        if lbw:
+            lbw_weights = [1] * 26
+            for index, value in zip(LBW_TARGET_IDX, lbw):
+                lbw_weights[index] = value
+            print(f"lbw: {dict(zip(LAYER26.keys(), lbw_weights))}")
+
+            def get_extra_scale(key, lbw_weights=lbw_weights):
+                index = get_lbw_block_index(key, True)
+                return lbw_weights[index] if index in LBW_TARGET_IDX else 1  # keyがlbwの対象であれば、lbwの重みを掛ける
+
+        collect_lora_deltas(lora_sd, ratio, lora_name_to_key, deltas, get_extra_scale)
+
+    print(f"merging and saving SD model to: {save_to}")
+    merge_lora_deltas_streaming(sd_model, save_to, deltas, merge_dtype, save_dtype, metadata, max_workers)
+
+
 def merge_lora_models(models, ratios, lbws, merge_dtype, concat=False, shuffle=False):
     base_alphas = {}  # alpha for merged model
     base_dims = {}
@@ -396,18 +434,23 @@ def merge(args):
         save_dtype = merge_dtype
 
     if args.sd_model is not None:
-        print(f"loading SD model: {args.sd_model}")
+        if args.streaming:
+            assert model_util.is_safetensors(args.sd_model) and model_util.is_safetensors(
+                args.save_to
+            ), "streaming mode supports safetensors only / ストリーミングモードはsafetensorsのみ対応しています"
+        else:
+            print(f"loading SD model: {args.sd_model}")
 
-        (
-            text_model1,
-            text_model2,
-            vae,
-            unet,
-            logit_scale,
-            ckpt_info,
-        ) = sdxl_model_util.load_models_from_sdxl_checkpoint(sdxl_model_util.MODEL_VERSION_SDXL_BASE_V1_0, args.sd_model, "cpu")
+            (
+                text_model1,
+                text_model2,
+                vae,
+                unet,
+                logit_scale,
+                ckpt_info,
+            ) = sdxl_model_util.load_models_from_sdxl_checkpoint(sdxl_model_util.MODEL_VERSION_SDXL_BASE_V1_0, args.sd_model, "cpu")
 
-        merge_to_sd_model(text_model1, text_model2, unet, args.models, args.ratios, args.lbws, merge_dtype)
+            merge_to_sd_model(text_model1, text_model2, unet, args.models, args.ratios, args.lbws, merge_dtype)
 
         if args.no_metadata:
             sai_metadata = None
@@ -418,10 +461,23 @@ def merge(args):
                 None, False, False, True, False, False, time.time(), title=title, merged_from=merged_from
             )
 
-        print(f"saving SD model to: {args.save_to}")
-        sdxl_model_util.save_stable_diffusion_checkpoint(
-            args.save_to, text_model1, text_model2, unet, 0, 0, ckpt_info, vae, logit_scale, sai_metadata, save_dtype
-        )
+        if args.streaming:
+            merge_to_sd_model_streaming(
+                args.sd_model,
+                args.save_to,
+                args.models,
+                args.ratios,
+                args.lbws,
+                merge_dtype,
+                save_dtype,
+                sai_metadata,
+                args.max_workers,
+            )
+        else:
+            print(f"saving SD model to: {args.save_to}")
+            sdxl_model_util.save_stable_diffusion_checkpoint(
+                args.save_to, text_model1, text_model2, unet, 0, 0, ckpt_info, vae, logit_scale, sai_metadata, save_dtype
+            )
     else:
         state_dict, metadata = merge_lora_models(args.models, args.ratios, args.lbws, merge_dtype, args.concat, args.shuffle)
 
@@ -502,6 +558,18 @@ def setup_parser() -> argparse.ArgumentParser:
         action="store_true",
         help="shuffle lora weight./ " + "LoRAの重みをシャッフルする",
     )
+    parser.add_argument(
+        "--streaming",
+        action="store_true",
+        help="merge LoRA into SD model tensor by tensor without loading the whole model (safetensors only) / "
+        + "モデル全体を読み込まずにtensorごとにLoRAをマージする（safetensorsのみ）",
+    )
+    parser.add_argument(
+        "--max_workers",
+        type=int,
+        default=4,
+        help="number of threads to merge tensors in streaming mode / ストリーミングモードでtensorをマージするスレッド数",
+    )
 
     return parser
 
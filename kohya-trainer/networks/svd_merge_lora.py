@@ -10,6 +10,7 @@ from tqdm import tqdm
 from library import sai_model_spec, train_util
 import library.model_util as model_util
 import lora
+from resize_lora import add_svd_arguments, svd_batched, svd_reconstruction_error
 from library.utils import setup_logging
 
 setup_logging()
@@ -250,9 +251,42 @@ def format_lbws(lbws):
     return lbws, is_sdxl, LBW_TARGET_IDX
 
 
-def merge_lora_models(models, ratios, lbws, new_rank, new_conv_rank, device, merge_dtype):
+def extract_lora_module(U, S, Vh, out_dim, in_dim, kernel_size, new_rank):
+    r"""
+    マージした重みのSVDの結果から、rank new_rankのLoRAの up, down を作る
+    make up and down of LoRA of rank new_rank from the SVD of the merged weight
+    """
+    U = U[:, :new_rank]
+    S = S[:new_rank]
+    U = U @ torch.diag(S)
+
+    Vh = Vh[:new_rank, :]
+
+    if U.size()[1] < new_rank:
+        # 元のrankの合計がnew_rankより小さい場合は0で埋める / pad with zeros if the sum of ranks is smaller than new_rank
+        pad = new_rank - U.size()[1]
+        U = torch.nn.functional.pad(U, (0, pad))
+        Vh = torch.nn.functional.pad(Vh, (0, 0, 0, pad))
+
+    dist = torch.cat([U.flatten(), Vh.flatten()])
+    hi_val = torch.quantile(dist, CLAMP_QUANTILE)
+    low_val = -hi_val
+
+    U = U.clamp(low_val, hi_val)
+    Vh = Vh.clamp(low_val, hi_val)
+
+    if kernel_size is not None:
+        U = U.reshape(out_dim, new_rank, 1, 1)
+        Vh = Vh.reshape(new_rank, in_dim, kernel_size[0], kernel_size[1])
+
+    return U.contiguous(), Vh.contiguous()
+
+
+def merge_lora_models(
+    models, ratios, lbws, new_rank, new_conv_rank, device, merge_dtype, svd_backend="full", check_accuracy=False, max_workers=1
+):
     print(f"new rank: {new_rank}, new conv rank: {new_conv_rank}")
-    merged_sd = {}
+    merged_factors = {}  # lora_module_name -> (ups, downs), merged weight is sum(up @ down)
     v2 = None  # This is meaning LoRA Metadata v2, Not meaning SD2
     base_model = None
 
@@ -278,7 +312,7 @@ def merge_lora_models(models, ratios, lbws, new_rank, new_conv_rank, device, mer
                 lbw_weights[index] = value
             print(f"lbw: {dict(zip(LAYER26.keys(), lbw_weights))}")
 
-        # merge
+        # merge: W = sum(ratio * scale * U @ D) is kept as the factors
         print(f"merging...")
         for key in tqdm(list(lora_sd.keys())):
             if "lora_down" not in key:
@@ -290,28 +324,8 @@ def merge_lora_models(models, ratios, lbws, new_rank, new_conv_rank, device, mer
             network_dim = down_weight.size()[0]
 
             up_weight = lora_sd[lora_module_name + ".lora_up.weight"]
-            alpha = lora_sd.get(lora_module_name + ".alpha", network_dim)
-
-            in_dim = down_weight.size()[1]
-            out_dim = up_weight.size()[0]
-            conv2d = len(down_weight.size()) == 4
-            kernel_size = None if not conv2d else down_weight.size()[2:4]
-            # print(lora_module_name, network_dim, alpha, in_dim, out_dim, kernel_size)
-
-            # make original weight if not exist
-            if lora_module_name not in merged_sd:
-                weight = torch.zeros((out_dim, in_dim, *kernel_size) if conv2d else (out_dim, in_dim), dtype=merge_dtype)
-            else:
-                weight = merged_sd[lora_module_name]
-            if device:
-                weight = weight.to(device)
-
-            # merge to weight
-            if device:
-                up_weight = up_weight.to(device)
-                down_weight = down_weight.to(device)
-
-            # W <- W + U * D
+            alpha = float(lora_sd.get(lora_module_name + ".alpha", network_dim))
+
             scale = alpha / network_dim
 
             if lbw:
@@ -320,72 +334,55 @@ def merge_lora_models(models, ratios, lbws, new_rank, new_conv_rank, device, mer
                 if is_lbw_target:
                     scale *= lbw_weights[index]  # keyがlbwの対象であれば、lbwの重みを掛ける
 
-            if device:  # and isinstance(scale, torch.Tensor):
-                scale = scale.to(device)
-
-            if not conv2d:  # linear
-                weight = weight + ratio * (up_weight @ down_weight) * scale
-            elif kernel_size == (1, 1):
-                weight = (
-                    weight
-                    + ratio
-                    * (up_weight.squeeze(3).squeeze(2) @ down_weight.squeeze(3).squeeze(2)).unsqueeze(2).unsqueeze(3)
-                    * scale
-                )
-            else:
-                conved = torch.nn.functional.conv2d(down_weight.permute(1, 0, 2, 3), up_weight).permute(1, 0, 2, 3)
-                weight = weight + ratio * conved * scale
-
-            merged_sd[lora_module_name] = weight.to("cpu")
+            ups, downs = merged_factors.setdefault(lora_module_name, ([], []))
+            ups.append(up_weight * (ratio * scale))
+            downs.append(down_weight)
 
     # extract from merged weights
     print("extract new lora...")
-    merged_lora_sd = {}
-    with torch.no_grad():
-        for lora_module_name, mat in tqdm(list(merged_sd.items())):
-            if device:
-                mat = mat.to(device)
-
-            conv2d = len(mat.size()) == 4
-            kernel_size = None if not conv2d else mat.size()[2:4]
-            conv2d_3x3 = conv2d and kernel_size != (1, 1)
-            out_dim, in_dim = mat.size()[0:2]
-
-            if conv2d:
-                if conv2d_3x3:
-                    mat = mat.flatten(start_dim=1)
-                else:
-                    mat = mat.squeeze()
-
-            module_new_rank = new_conv_rank if conv2d_3x3 else new_rank
-            module_new_rank = min(module_new_rank, in_dim, out_dim)  # LoRA rank cannot exceed the original dim
-
-            U, S, Vh = torch.linalg.svd(mat)
-
-            U = U[:, :module_new_rank]
-            S = S[:module_new_rank]
-            U = U @ torch.diag(S)
 
-            Vh = Vh[:module_new_rank, :]
+    # up/downをrank方向に結合すると up @ down がマージした重みになる。形状の同じモジュールはまとめてSVDする
+    # concatenated up @ down is the merged weight. modules with the same shape are decomposed together
+    svd_inputs = {}
+    for lora_module_name, (ups, downs) in merged_factors.items():
+        conv2d = len(downs[0].size()) == 4
+        conv2d_3x3 = conv2d and downs[0].size()[2:4] != (1, 1)
+        out_dim, in_dim = ups[0].size()[0], downs[0].size()[1]
 
-            dist = torch.cat([U.flatten(), Vh.flatten()])
-            hi_val = torch.quantile(dist, CLAMP_QUANTILE)
-            low_val = -hi_val
+        module_new_rank = new_conv_rank if conv2d_3x3 else new_rank
+        module_new_rank = min(module_new_rank, in_dim, out_dim)  # LoRA rank cannot exceed the original dim
 
-            U = U.clamp(low_val, hi_val)
-            Vh = Vh.clamp(low_val, hi_val)
+        up = torch.cat([w.flatten(start_dim=1) for w in ups], dim=1)
+        down = torch.cat([w.flatten(start_dim=1) for w in downs], dim=0)
+        svd_inputs[lora_module_name] = (up, down, module_new_rank)
 
-            if conv2d:
-                U = U.reshape(out_dim, module_new_rank, 1, 1)
-                Vh = Vh.reshape(module_new_rank, in_dim, kernel_size[0], kernel_size[1])
-
-            up_weight = U
-            down_weight = Vh
+    with torch.no_grad():
+        svd_results = svd_batched(svd_inputs, svd_backend, device, max_workers)
+
+        merged_lora_sd = {}
+        svd_errors = []
+        for lora_module_name, (ups, downs) in merged_factors.items():
+            up, down, module_new_rank = svd_inputs[lora_module_name]
+            U, S, Vh = svd_results[lora_module_name]
+            out_dim, in_dim = ups[0].size()[0], downs[0].size()[1]
+            kernel_size = None if len(downs[0].size()) != 4 else downs[0].size()[2:4]
+
+            up_weight, down_weight = extract_lora_module(U, S, Vh, out_dim, in_dim, kernel_size, module_new_rank)
+            if check_accuracy and svd_backend != "full":
+                svd_errors.append(
+                    svd_reconstruction_error(up @ down, U[:, :module_new_rank] * S[:module_new_rank], Vh[:module_new_rank])
+                )
 
-            merged_lora_sd[lora_module_name + ".lora_up.weight"] = up_weight.to("cpu").contiguous()
-            merged_lora_sd[lora_module_name + ".lora_down.weight"] = down_weight.to("cpu").contiguous()
+            merged_lora_sd[lora_module_name + ".lora_up.weight"] = up_weight
+            merged_lora_sd[lora_module_name + ".lora_down.weight"] = down_weight
             merged_lora_sd[lora_module_name + ".alpha"] = torch.tensor(module_new_rank, device="cpu")
 
+    if svd_errors:
+        print(
+            f"SVD accuracy check, relative error to exact SVD: max {max(svd_errors):.2e}, mean {sum(svd_errors) / len(svd_errors):.2e}"
+            + f" / 厳密なSVDとの相対誤差: 最大 {max(svd_errors):.2e}, 平均 {sum(svd_errors) / len(svd_errors):.2e}"
+        )
+
     # build minimum metadata
     dims = f"{new_rank}"
     alphas = f"{new_rank}"
@@ -425,7 +422,16 @@ def merge(args):
 
     new_conv_rank = args.new_conv_rank if args.new_conv_rank is not None else args.new_rank
     state_dict, metadata, v2, base_model = merge_lora_models(
-        args.models, args.ratios, args.lbws, args.new_rank, new_conv_rank, args.device, merge_dtype
+        args.models,
+        args.ratios,
+        args.lbws,
+        args.new_rank,
+        new_conv_rank,
+        args.device,
+        merge_dtype,
+        args.svd_backend,
+        args.check_svd_accuracy,
+        args.max_workers,
     )
 
     # cast to save_dtype before calculating hashes
@@ -504,6 +510,7 @@ def setup_parser() -> argparse.ArgumentParser:
         help="do not save sai modelspec metadata (minimum ss_metadata for LoRA is saved) / "
         + "sai modelspecのメタデータを保存しない（LoRAの最低限のss_metadataは保存される）",
     )
+    add_svd_arguments(parser)
 
     return parser
 
@@ -178,6 +178,15 @@ def train(args):
 
     train_dataset_group.verify_bucket_reso_steps(32)
 
+    if args.latent_random_crop:
+        train_dataset_group.enable_latent_random_crop()
+
+    if args.dynamic_token_chunks:
+        train_dataset_group.enable_dynamic_token_chunks(args.group_by_caption_length)
+
+    if args.fast_image_decode:
+        train_dataset_group.enable_fast_image_decode()
+
     if args.debug_dataset:
         train_util.debug_dataset(train_dataset_group, True)
         return
@@ -268,6 +277,10 @@ def train(args):
         clean_memory_on_device(accelerator.device)
 
         accelerator.wait_for_everyone()
+    elif args.cache_resized_images:
+        # latentをキャッシュしない場合、リサイズ済みの画像をキャッシュする / cache resized images if latents are not cached
+        train_dataset_group.cache_resized_images(args.max_data_loader_n_workers or None, accelerator.is_main_process)
+        accelerator.wait_for_everyone()
 
     # 学習を準備する：モデルを適切な状態にする
     if args.gradient_checkpointing:
@@ -657,6 +670,7 @@ def train(args):
                             text_encoder2,
                             None if not args.full_fp16 else weight_dtype,
                             accelerator=accelerator,
+                            clip_skip_early_exit=args.clip_skip_early_exit,
                         )
                 else:
                     encoder_hidden_states1 = batch["text_encoder_outputs1_list"].to(accelerator.device).to(weight_dtype)
@@ -121,6 +121,7 @@ class SdxlNetworkTrainer(train_network.NetworkTrainer):
                     text_encoders[1],
                     None if not args.full_fp16 else weight_dtype,
                     accelerator=accelerator,
+                    clip_skip_early_exit=args.clip_skip_early_exit,
                 )
         else:
             encoder_hidden_states1 = batch["text_encoder_outputs1_list"].to(accelerator.device).to(weight_dtype)
@@ -0,0 +1,16 @@
+# LoRAのマージ後、multiplierを変更してもリストアで元の重みに正確に戻ることを確認する
+# check that the original weights are restored exactly after merging LoRA, even if the multiplier is changed
+
+from networks import lora, lora_fa
+from library.utils import setup_logging
+
+setup_logging()
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+if __name__ == "__main__":
+    lora.check_restore_weights()
+    lora_fa.check_restore_weights()
+    logger.info("weights are restored exactly / 重みは正確にリストアされます")
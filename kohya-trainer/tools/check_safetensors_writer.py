@@ -0,0 +1,15 @@
+# safetensorsの独自の書き出し処理がsafetensors.torch.saveと同じファイルを書き出すことを確認する
+# check that the own safetensors writer writes the same file as safetensors.torch.save
+
+from library import train_util
+from library.utils import setup_logging
+
+setup_logging()
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+if __name__ == "__main__":
+    train_util.check_safetensors_writer()
+    logger.info("safetensors writer is compatible with safetensors.torch.save / safetensorsの書き出しは互換性があります")
@@ -0,0 +1,266 @@
+# LoRAのカタログ（SQLiteのインデックス）を作成、検索する。safetensorsのヘッダのみを読み込むので、大量のファイルでも高速に動作する
+# build and query a catalog (SQLite index) of LoRA models. only the headers of safetensors are read, so it is fast even with many files
+
+import argparse
+import json
+import os
+import sqlite3
+import struct
+import time
+
+# torchなどの読み込みに時間がかかるため、libraryはハッシュ計算時のみimportする / library is imported only for hash calculation to start quickly
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    mtime_ns INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    num_tensors INTEGER NOT NULL,
+    rank INTEGER,
+    conv_rank INTEGER,
+    model_hash TEXT,
+    legacy_hash TEXT
+);
+CREATE TABLE IF NOT EXISTS metadata (
+    path TEXT NOT NULL REFERENCES files(path) ON DELETE CASCADE,
+    key TEXT NOT NULL,
+    value TEXT,
+    PRIMARY KEY (path, key)
+);
+CREATE TABLE IF NOT EXISTS tensors (
+    path TEXT NOT NULL REFERENCES files(path) ON DELETE CASCADE,
+    name TEXT NOT NULL,
+    dtype TEXT NOT NULL,
+    shape TEXT NOT NULL,
+    PRIMARY KEY (path, name)
+);
+CREATE INDEX IF NOT EXISTS metadata_key_value ON metadata(key, value);
+"""
+
+# 検索でfilesテーブルの列として扱うキー / keys treated as columns of the files table in queries
+FILE_COLUMNS = ["path", "mtime_ns", "size", "num_tensors", "rank", "conv_rank", "model_hash", "legacy_hash"]
+
+# カタログに保存するメタデータのキーの接頭辞 / prefixes of metadata keys stored in the catalog
+METADATA_PREFIXES = ("ss_", "sshs_", "modelspec.")
+
+DEFAULT_COLUMNS = ["rank", "ss_base_model_version", "ss_network_module", "ss_network_dim", "ss_network_alpha", "ss_steps"]
+
+
+def read_safetensors_header(file):
+    r"""
+    safetensorsのヘッダのみを読み込み、メタデータとtensorの情報（dtype、shape）を返す。tensorのデータは読み込まない
+    reads only the header of safetensors and returns the metadata and the information of tensors (dtype, shape). tensor data is not read
+    """
+    with open(file, "rb") as f:
+        header_size = struct.unpack("<Q", f.read(8))[0]
+        header = json.loads(f.read(header_size))
+    metadata = header.pop("__metadata__", None) or {}
+    tensors = {name: (info["dtype"], info["shape"]) for name, info in header.items()}
+    return metadata, tensors
+
+
+def get_ranks(tensors):
+    # returns max rank of Linear/Conv2d 1x1 and Conv2d 3x3 LoRA modules from the shapes of lora_down
+    rank = None
+    conv_rank = None
+    for name, (_, shape) in tensors.items():
+        if not name.endswith("lora_down.weight"):
+            continue
+        if len(shape) == 4 and shape[2:] != [1, 1]:
+            conv_rank = max(conv_rank or 0, shape[0])
+        else:
+            rank = max(rank or 0, shape[0])
+    return rank, conv_rank
+
+
+def open_catalog(db_file):
+    conn = sqlite3.connect(db_file)
+    # WALは共有メモリが必要でネットワークファイルシステムでは使えないため、デフォルトのrollback journalを使う
+    # use the default rollback journal: WAL needs shared memory and does not work on network filesystems
+    conn.execute("PRAGMA foreign_keys = ON")
+    conn.executescript(SCHEMA)
+    return conn
+
+
+def update_catalog(conn, root, compute_hashes=False):
+    r"""
+    rootディレクトリ以下のsafetensorsをスキャンし、更新日時かサイズが変わったファイルのみカタログを更新する。存在しないファイルは削除する
+    scans safetensors under the root directory and updates the catalog only for files whose mtime or size has changed. removed files are deleted
+    """
+    indexed = {path: (mtime_ns, size) for path, mtime_ns, size in conn.execute("SELECT path, mtime_ns, size FROM files")}
+
+    found = set()
+    updated = 0
+    for dirpath, _, filenames in os.walk(root):
+        for filename in filenames:
+            if os.path.splitext(filename)[1] != ".safetensors":
+                continue
+            path = os.path.abspath(os.path.join(dirpath, filename))
+            found.add(path)
+
+            st = os.stat(path)
+            if indexed.get(path) == (st.st_mtime_ns, st.st_size):
+                continue
+
+            try:
+                metadata, tensors = read_safetensors_header(path)
+            except (OSError, ValueError, KeyError, struct.error) as e:
+                print(f"failed to read header / ヘッダの読み込みに失敗しました: {path}: {e}")
+                continue
+
+            model_hash = metadata.get("sshs_model_hash")
+            legacy_hash = metadata.get("sshs_legacy_hash")
+            if compute_hashes and (model_hash is None or legacy_hash is None):
+                # sd-webui-additional-networksと同じハッシュ、ファイル全体を読み込む / same hashes as sd-webui-additional-networks, reads the whole file
+                from library import train_util
+
+                with open(path, "rb") as f:
+                    model_hash = train_util.addnet_hash_safetensors(f)
+                    legacy_hash = train_util.addnet_hash_legacy(f)
+
+            rank, conv_rank = get_ranks(tensors)
+            with conn:
+                conn.execute("DELETE FROM files WHERE path = ?", (path,))
+                conn.execute(
+                    "INSERT INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    (path, st.st_mtime_ns, st.st_size, len(tensors), rank, conv_rank, model_hash, legacy_hash),
+                )
+                conn.executemany(
+                    "INSERT INTO metadata VALUES (?, ?, ?)",
+                    [(path, k, str(v)) for k, v in metadata.items() if k.startswith(METADATA_PREFIXES)],
+                )
+                conn.executemany(
+                    "INSERT INTO tensors VALUES (?, ?, ?, ?)",
+                    [(path, name, dtype, json.dumps(shape)) for name, (dtype, shape) in tensors.items()],
+                )
+            updated += 1
+
+    # rootの外のファイルは残す / keep files outside of the root
+    root_prefix = os.path.join(os.path.abspath(root), "")
+    removed = [path for path in indexed.keys() if path.startswith(root_prefix) and path not in found]
+    with conn:
+        conn.executemany("DELETE FROM files WHERE path = ?", [(path,) for path in removed])
+
+    print(f"{len(found)} files found, {updated} updated, {len(removed)} removed")
+
+
+def parse_query(query):
+    r"""
+    KEY=VALUE、KEY>=VALUEなどの条件をSQLのWHERE句に変換する。=では%と_をワイルドカードとして使える
+    converts a condition such as KEY=VALUE, KEY>=VALUE to the SQL WHERE clause. % and _ can be used as wildcards with =
+    """
+    for op in ["!=", ">=", "<=", "=", ">", "<"]:
+        if op in query:
+            key, value = query.split(op, 1)
+            break
+    else:
+        raise ValueError(f"invalid query / 検索条件が不正です: {query}")
+
+    if op in ["=", "!="]:
+        sql_op = "LIKE" if op == "=" else "NOT LIKE"
+        cast = "?"
+    else:
+        # 数値として比較する / compare as numbers
+        sql_op = op
+        value = float(value)
+        cast = "CAST(? AS REAL)"
+
+    if key in FILE_COLUMNS:
+        if op in ["=", "!="]:
+            return f"COALESCE(CAST(f.{key} AS TEXT), '') {sql_op} ?", value
+        return f"f.{key} {sql_op} ?", value
+    column = "m.value" if op in ["=", "!="] else "CAST(m.value AS REAL)"
+    return f"EXISTS (SELECT 1 FROM metadata m WHERE m.path = f.path AND m.key = ? AND {column} {sql_op} {cast})", (key, value)
+
+
+def search_catalog(conn, queries, columns):
+    where = []
+    params = []
+    for query in queries:
+        clause, value = parse_query(query)
+        where.append(clause)
+        params.extend(value if isinstance(value, tuple) else (value,))
+
+    sql = "SELECT f.* FROM files f"
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    sql += " ORDER BY f.path"
+
+    rows = conn.execute(sql, params).fetchall()
+    metadata_columns = [c for c in columns if c not in FILE_COLUMNS]
+    for row in rows:
+        file_info = dict(zip(FILE_COLUMNS, row))
+        path = file_info["path"]
+        metadata = {}
+        if metadata_columns:
+            placeholders = ", ".join("?" * len(metadata_columns))
+            metadata = dict(
+                conn.execute(f"SELECT key, value FROM metadata WHERE path = ? AND key IN ({placeholders})", [path] + metadata_columns)
+            )
+        values = [str(file_info[c]) if c in FILE_COLUMNS else metadata.get(c, "-") for c in columns]
+        print("\t".join([path] + values))
+    return rows
+
+
+def main(args):
+    db_file = args.db if args.db is not None else os.path.join(args.root, "lora_catalog.sqlite")
+    conn = open_catalog(db_file)
+
+    if not args.no_update:
+        start_time = time.perf_counter()
+        update_catalog(conn, args.root, args.compute_hashes)
+        print(f"catalog updated in {time.perf_counter() - start_time:.3f} s: {db_file}")
+
+    if args.query is not None or args.list:
+        start_time = time.perf_counter()
+        columns = args.columns if args.columns is not None else DEFAULT_COLUMNS
+        rows = search_catalog(conn, args.query or [], columns)
+        print(f"{len(rows)} files found in {(time.perf_counter() - start_time) * 1000:.1f} ms")
+
+    conn.close()
+
+
+def setup_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--root", type=str, required=True, help="root directory of LoRA models to scan / スキャンするLoRAモデルのルートディレクトリ"
+    )
+    parser.add_argument(
+        "--db",
+        type=str,
+        default=None,
+        help="SQLite file of the catalog, default is ROOT/lora_catalog.sqlite / カタログのSQLiteファイル、省略時はROOT/lora_catalog.sqlite",
+    )
+    parser.add_argument(
+        "--no_update", action="store_true", help="do not scan the root directory, only search / スキャンせずに検索のみ行う"
+    )
+    parser.add_argument(
+        "--compute_hashes",
+        action="store_true",
+        help="compute hashes for files without sshs_model_hash in metadata (reads whole files) / メタデータにハッシュがないファイルのハッシュを計算する（ファイル全体を読み込む）",
+    )
+    parser.add_argument(
+        "--query",
+        type=str,
+        nargs="*",
+        default=None,
+        help="search conditions such as ss_base_model_version=sdxl% rank>=16 ss_steps<2000, combined with AND"
+        + " / 検索条件、例：ss_base_model_version=sdxl% rank>=16 ss_steps<2000、ANDで結合される",
+    )
+    parser.add_argument("--list", action="store_true", help="list all files in the catalog / カタログのすべてのファイルを表示する")
+    parser.add_argument(
+        "--columns",
+        type=str,
+        nargs="*",
+        default=None,
+        help=f"columns to show (metadata keys or {', '.join(FILE_COLUMNS[1:])}) / 表示する列（メタデータのキーまたはファイルの情報）",
+    )
+    return parser
+
+
+if __name__ == "__main__":
+    parser = setup_parser()
+
+    args = parser.parse_args()
+    main(args)
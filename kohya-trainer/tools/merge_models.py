@@ -1,10 +1,13 @@
 import argparse
+import contextlib
+import math
 import os
+import re
+import time
 
 import torch
 from safetensors import safe_open
-from safetensors.torch import load_file, save_file
-from tqdm import tqdm
+from library import train_util
 from library.utils import setup_logging
 setup_logging()
 import logging
@@ -30,6 +33,28 @@ def replace_text_encoder_key(key):
     return False, key
 
 
+# U-Netのブロックごとの比率の数: IN00-IN11, M00, OUT00-OUT11 / number of block ratios of U-Net
+NUM_BLOCK_RATIOS = 25
+
+
+def get_block_index(key):
+    # returns index of IN00-IN11, M00, OUT00-OUT11, or None if the key is not in the blocks of U-Net
+    m = re.match(r"model\.diffusion_model\.(input_blocks|middle_block|output_blocks)\.(\d+)", key)
+    if m is None:
+        return None
+    if m.group(1) == "input_blocks":
+        return int(m.group(2))
+    if m.group(1) == "middle_block":
+        return 12
+    return 13 + int(m.group(2))
+
+
+def parse_block_ratios(block_ratios):
+    ratios = [float(r) for r in block_ratios.split(",")]
+    assert len(ratios) == NUM_BLOCK_RATIOS, f"block ratios must have {NUM_BLOCK_RATIOS} values: {block_ratios}"
+    return ratios
+
+
 def merge(args):
     if args.precision == "fp16":
         dtype = torch.float16
@@ -54,97 +79,119 @@ def merge(args):
             print(f"Model {model} does not exist")
             exit()
 
-    assert args.ratios is None or len(args.models) == len(args.ratios), "ratios must be the same length as models"
-
-    # load and merge
-    ratio = 1.0 / len(args.models)  # default
-    supplementary_key_ratios = {}  # [key] = ratio, for keys not in all models, add later
-
-    merged_sd = None
-    first_model_keys = set()  # check missing keys in other models
-    for i, model in enumerate(args.models):
-        if args.ratios is not None:
-            ratio = args.ratios[i]
-
-        if merged_sd is None:
-            # load first model
-            print(f"Loading model {model}, ratio = {ratio}...")
-            merged_sd = {}
-            with safe_open(model, framework="pt", device=args.device) as f:
-                for key in tqdm(f.keys()):
-                    value = f.get_tensor(key)
-                    _, key = replace_text_encoder_key(key)
-
-                    first_model_keys.add(key)
-
-                    if not is_unet_key(key) and args.unet_only:
-                        supplementary_key_ratios[key] = 1.0  # use first model's value for VAE or TextEncoder
-                        continue
-
-                    value = ratio * value.to(dtype)  # first model's value * ratio
-                    merged_sd[key] = value
-
-            print(f"Model has {len(merged_sd)} keys " + ("(UNet only)" if args.unet_only else ""))
-            continue
-
-        # load other models
-        print(f"Loading model {model}, ratio = {ratio}...")
-
-        with safe_open(model, framework="pt", device=args.device) as f:
-            model_keys = f.keys()
-            for key in tqdm(model_keys):
-                _, new_key = replace_text_encoder_key(key)
-                if new_key not in merged_sd:
-                    if args.show_skipped and new_key not in first_model_keys:
-                        print(f"Skip: {new_key}")
-                    continue
-
-                value = f.get_tensor(key)
-                merged_sd[new_key] = merged_sd[new_key] + ratio * value.to(dtype)
-
-            # enumerate keys not in this model
-            model_keys = set(model_keys)
-            for key in merged_sd.keys():
-                if key in model_keys:
-                    continue
-                print(f"Key {key} not in model {model}, use first model's value")
-                if key in supplementary_key_ratios:
-                    supplementary_key_ratios[key] += ratio
-                else:
-                    supplementary_key_ratios[key] = ratio
-
-    # add supplementary keys' value (including VAE and TextEncoder)
-    if len(supplementary_key_ratios) > 0:
-        print("add first model's value")
-        with safe_open(args.models[0], framework="pt", device=args.device) as f:
-            for key in tqdm(f.keys()):
-                _, new_key = replace_text_encoder_key(key)
-                if new_key not in supplementary_key_ratios:
-                    continue
-
-                if is_unet_key(new_key):  # not VAE or TextEncoder
-                    print(f"Key {new_key} not in all models, ratio = {supplementary_key_ratios[new_key]}")
-
-                value = f.get_tensor(key)  # original key
+    add_difference = args.mode == "add_difference"
+    if add_difference:
+        # A + ratio * (B - C)
+        assert len(args.models) == 3, "add_difference requires 3 models: A + ratio * (B - C)"
+        assert args.ratios is None or len(args.ratios) == 1, "add_difference requires one ratio"
+        ratios = args.ratios if args.ratios is not None else [1.0]
+    else:
+        assert args.ratios is None or len(args.models) == len(args.ratios), "ratios must be the same length as models"
+        ratios = args.ratios if args.ratios is not None else [1.0 / len(args.models)] * len(args.models)  # default
 
-                if new_key not in merged_sd:
-                    merged_sd[new_key] = supplementary_key_ratios[new_key] * value.to(dtype)
-                else:
-                    merged_sd[new_key] = merged_sd[new_key] + supplementary_key_ratios[new_key] * value.to(dtype)
+    block_ratios = None
+    if args.block_ratios is not None:
+        assert len(args.block_ratios) == len(ratios), "block_ratios must be the same length as ratios"
+        block_ratios = [parse_block_ratios(r) for r in args.block_ratios]
 
-    # save
     output_file = args.output
     if not output_file.endswith(".safetensors"):
         output_file = output_file + ".safetensors"
 
-    print(f"Saving to {output_file}...")
-
-    # convert to save_dtype
-    for k in merged_sd.keys():
-        merged_sd[k] = merged_sd[k].to(save_dtype)
-
-    save_file(merged_sd, output_file)
-
+    # 入力をmmapしたまま出力を書き出すので、同じファイルには書き出せない / inputs are memory-mapped while writing, so the output must differ
+    for model in args.models:
+        assert not (os.path.exists(output_file) and os.path.samefile(model, output_file)), (
+            f"output file must not be one of the input models / 出力ファイルに入力モデルは指定できません: {output_file}"
+        )
+
+    with contextlib.ExitStack() as stack:
+        # safe_openはmmapで開くので、すべてのモデルを同時に開いておける / safe_open uses mmap, so all models can be opened at once
+        files = []
+        key_maps = []  # [new key] = original key, for each model
+        for model in args.models:
+            print(f"Opening model {model}...")
+            f = stack.enter_context(safe_open(model, framework="pt", device=args.device))
+            files.append(f)
+            key_maps.append({replace_text_encoder_key(key)[1]: key for key in f.keys()})
+
+        if args.show_skipped:
+            for key_map in key_maps[1:]:
+                for key in key_map.keys():
+                    if key not in key_maps[0]:
+                        print(f"Skip: {key}")
+
+        def get_coefficients(key):
+            if args.unet_only and not is_unet_key(key):
+                return [1.0] + [0.0] * (len(files) - 1)  # use first model's value for VAE or TextEncoder
+
+            index = get_block_index(key)
+            key_ratios = list(ratios) if block_ratios is None or index is None else [r[index] for r in block_ratios]
+            coefficients = [1.0, key_ratios[0], -key_ratios[0]] if add_difference else key_ratios
+
+            missing = [i for i in range(1, len(files)) if key not in key_maps[i]]
+            for i in missing:
+                print(f"Key {key} not in model {args.models[i]}, use first model's value")
+            if missing and add_difference:
+                coefficients = [1.0, 0.0, 0.0]
+            else:
+                for i in missing:
+                    coefficients[0] += coefficients[i]
+                    coefficients[i] = 0.0
+            return coefficients
+
+        # ヘッダを先に書くため、すべてのtensorのdtypeとshapeを先に決める / determine dtypes and shapes first to write the header
+        entries = []
+        coefficients = {}
+        shapes = {}
+        read_bytes = 0
+        for key, org_key in key_maps[0].items():
+            tensor_slice = files[0].get_slice(org_key)
+            tensor_dtype = train_util.TORCH_DTYPES_FROM_SAFETENSORS[tensor_slice.get_dtype()]
+            shape = tensor_slice.get_shape()
+            shapes[key] = shape
+
+            if not tensor_dtype.is_floating_point:
+                # position_idsなどは最初のモデルの値を使う / use first model's value for position_ids etc.
+                coefficients[key] = None
+                entries.append((key, tensor_dtype, shape))
+                read_bytes += math.prod(shape) * torch.tensor([], dtype=tensor_dtype).element_size()
+                continue
+
+            coefficients[key] = get_coefficients(key)
+            for i, c in enumerate(coefficients[key]):
+                if c == 0.0:
+                    continue
+                model_slice = files[i].get_slice(key_maps[i][key])
+                assert model_slice.get_shape() == shape, f"shape mismatch: {key} in {args.models[i]}"
+                model_dtype = train_util.TORCH_DTYPES_FROM_SAFETENSORS[model_slice.get_dtype()]
+                read_bytes += math.prod(shape) * torch.tensor([], dtype=model_dtype).element_size()
+            entries.append((key, save_dtype, shape))
+
+        def compute_tensor(key):
+            if coefficients[key] is None:
+                return files[0].get_tensor(key_maps[0][key]).to("cpu")
+
+            merged = None
+            for f, key_map, c in zip(files, key_maps, coefficients[key]):
+                if c == 0.0:
+                    continue
+                value = f.get_tensor(key_map[key]).to(dtype)
+                merged = value.mul_(c) if merged is None else merged.add_(value, alpha=c)
+            if merged is None:
+                # すべての比率が0 / all ratios are 0
+                return torch.zeros(shapes[key], dtype=save_dtype)
+            return merged.to("cpu", dtype=save_dtype)
+
+        print(f"Merging and saving to {output_file}...")
+        start_time = time.perf_counter()
+        train_util.save_safetensors_streaming(output_file, entries, compute_tensor, None, args.max_workers)
+        elapsed = time.perf_counter() - start_time
+
+    written_bytes = os.path.getsize(output_file)
+    print(
+        f"Read {read_bytes / 1e9:.2f} GB, wrote {written_bytes / 1e9:.2f} GB in {elapsed:.1f} s:"
+        + f" {(read_bytes + written_bytes) / 1e9 / elapsed:.2f} GB/s"
+    )
     print("Done!")
 
 
@@ -152,7 +199,27 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Merge models")
     parser.add_argument("--models", nargs="+", type=str, help="Models to merge")
     parser.add_argument("--output", type=str, help="Output model")
-    parser.add_argument("--ratios", nargs="+", type=float, help="Ratios of models, default is equal, total = 1.0")
+    parser.add_argument(
+        "--ratios",
+        nargs="+",
+        type=float,
+        help="Ratios of models, default is equal, total = 1.0. For add_difference, one ratio for (B - C), default is 1.0",
+    )
+    parser.add_argument(
+        "--mode",
+        type=str,
+        default="weighted_sum",
+        choices=["weighted_sum", "add_difference"],
+        help="Merge mode: weighted_sum of models, or add_difference (A + ratio * (B - C)) of 3 models",
+    )
+    parser.add_argument(
+        "--block_ratios",
+        nargs="+",
+        type=str,
+        default=None,
+        help=f"Ratios for each U-Net block, {NUM_BLOCK_RATIOS} comma separated values (IN00-IN11, M00, OUT00-OUT11) for each ratio",
+    )
+    parser.add_argument("--max_workers", type=int, default=4, help="Number of threads to merge tensors, default is 4")
     parser.add_argument("--unet_only", action="store_true", help="Only merge unet")
     parser.add_argument("--device", type=str, default="cpu", help="Device to use, default is cpu")
     parser.add_argument(
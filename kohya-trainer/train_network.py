@@ -64,6 +64,7 @@ class NetworkTrainer:
         keys_scaled=None,
         mean_norm=None,
         maximum_norm=None,
+        profile_logs=None,
     ):
         logs = {"loss/current": current_loss, "loss/average": avr_loss}
 
@@ -72,6 +73,9 @@ class NetworkTrainer:
             logs["max_norm/average_key_norm"] = mean_norm
             logs["max_norm/max_key_norm"] = maximum_norm
 
+        if profile_logs is not None:
+            logs.update(profile_logs)
+
         lrs = lr_scheduler.get_last_lr()
         for i, lr in enumerate(lrs):
             if lr_descriptions is not None:
@@ -207,6 +211,15 @@ class NetworkTrainer:
         ds_for_collator = train_dataset_group if args.max_data_loader_n_workers == 0 else None
         collator = train_util.collator_class(current_epoch, current_step, ds_for_collator)
 
+        if args.latent_random_crop:
+            train_dataset_group.enable_latent_random_crop()
+
+        if args.dynamic_token_chunks:
+            train_dataset_group.enable_dynamic_token_chunks(args.group_by_caption_length)
+
+        if args.fast_image_decode:
+            train_dataset_group.enable_fast_image_decode()
+
         if args.debug_dataset:
             train_util.debug_dataset(train_dataset_group)
             return
@@ -216,6 +229,18 @@ class NetworkTrainer:
             )
             return
 
+        if args.image_transforms_on_device and not cache_latents:
+            # debug_datasetの後に有効にする / enable after debug_dataset to show the transformed images
+            # uint8の画像を扱うのはこのスクリプトの学習ループのみ / only the training loop of this script consumes the uint8 images
+            for dataset in train_dataset_group.datasets:
+                dataset.enable_image_transforms_on_device()
+
+        # DataLoaderのworkerを作る前に有効にする / enable before creating workers of DataLoader
+        dataset_stage_stats = None
+        if args.dataset_stage_stats:
+            dataset_stage_stats = train_util.DatasetStageStats(args.max_data_loader_n_workers)
+            train_dataset_group.enable_stage_stats(dataset_stage_stats)
+
         if cache_latents:
             assert (
                 train_dataset_group.is_latent_cacheable()
@@ -276,6 +301,10 @@ class NetworkTrainer:
             clean_memory_on_device(accelerator.device)
 
             accelerator.wait_for_everyone()
+        elif args.cache_resized_images:
+            # latentをキャッシュしない場合、リサイズ済みの画像をキャッシュする / cache resized images if latents are not cached
+            train_dataset_group.cache_resized_images(args.max_data_loader_n_workers or None, accelerator.is_main_process)
+            accelerator.wait_for_everyone()
 
         # 必要ならテキストエンコーダーの出力をキャッシュする: Text Encoderはcpuまたはgpuへ移される
         # cache text encoder outputs if needed: Text Encoder is moved to cpu or gpu
@@ -311,6 +340,8 @@ class NetworkTrainer:
         if network is None:
             return
         network_has_multiplier = hasattr(network, "set_multiplier")
+        # サンプル画像の生成などで使うmultiplier / the multiplier used outside of training steps such as sampling images
+        network_multiplier = getattr(network, "multiplier", 1.0)
 
         if hasattr(network, "prepare_network"):
             network.prepare_network(args)
@@ -753,24 +784,40 @@ class NetworkTrainer:
             metadata["ss_network_args"] = json.dumps(net_kwargs)
 
         # model name and hash
+        # model_hash_in_backgroundの場合は、最初の保存の前にmetadataに設定する / set to metadata before the first save if in background
+        model_hash_futures = {}
+
+        def set_model_hashes(path, legacy_hash_key, new_hash_key):
+            if args.model_hash_in_background:
+                model_hash_futures[(legacy_hash_key, new_hash_key)] = train_util.submit_model_hashes_calculation(
+                    path, args.model_hash_cache
+                )
+            else:
+                legacy_hash, new_hash = train_util.calculate_model_hashes_with_cache(path, args.model_hash_cache)
+                metadata[legacy_hash_key] = legacy_hash
+                metadata[new_hash_key] = new_hash
+
         if args.pretrained_model_name_or_path is not None:
             sd_model_name = args.pretrained_model_name_or_path
             if os.path.exists(sd_model_name):
-                metadata["ss_sd_model_hash"] = train_util.model_hash(sd_model_name)
-                metadata["ss_new_sd_model_hash"] = train_util.calculate_sha256(sd_model_name)
+                set_model_hashes(sd_model_name, "ss_sd_model_hash", "ss_new_sd_model_hash")
                 sd_model_name = os.path.basename(sd_model_name)
             metadata["ss_sd_model_name"] = sd_model_name
 
         if args.vae is not None:
             vae_name = args.vae
             if os.path.exists(vae_name):
-                metadata["ss_vae_hash"] = train_util.model_hash(vae_name)
-                metadata["ss_new_vae_hash"] = train_util.calculate_sha256(vae_name)
+                set_model_hashes(vae_name, "ss_vae_hash", "ss_new_vae_hash")
                 vae_name = os.path.basename(vae_name)
             metadata["ss_vae_name"] = vae_name
 
         metadata = {k: str(v) for k, v in metadata.items()}
 
+        def wait_model_hashes():
+            for (legacy_hash_key, new_hash_key), future in model_hash_futures.items():
+                metadata[legacy_hash_key], metadata[new_hash_key] = future.result()
+            model_hash_futures.clear()
+
         # make minimum metadata for filtering
         minimum_metadata = {}
         for key in train_util.SS_METADATA_MINIMUM_KEYS:
@@ -847,6 +894,12 @@ class NetworkTrainer:
             )
 
         loss_recorder = train_util.LossRecorder()
+        step_profiler = train_util.StepProfiler(
+            args.profile_step_time,
+            accelerator.device,
+            trace_file=args.profile_trace_file if accelerator.is_main_process else None,
+            trace_steps=args.profile_trace_steps,
+        )
         del train_dataset_group
 
         # callback for step start
@@ -861,6 +914,7 @@ class NetworkTrainer:
             ckpt_file = os.path.join(args.output_dir, ckpt_name)
 
             accelerator.print(f"\nsaving checkpoint: {ckpt_file}")
+            wait_model_hashes()
             metadata["ss_training_finished_at"] = str(time.time())
             metadata["ss_steps"] = str(steps)
             metadata["ss_epoch"] = str(epoch_no)
@@ -869,14 +923,60 @@ class NetworkTrainer:
             sai_metadata = train_util.get_sai_model_spec(None, args, self.is_sdxl, True, False)
             metadata_to_save.update(sai_metadata)
 
+            if checkpointer is not None and not force_sync_upload:
+                # state_dictをCPUにコピーしたらすぐに学習を続ける / continue training as soon as state_dict is copied to CPU
+                checkpointer.submit_state_dict(
+                    write_weights, unwrapped_nw.state_dict(), ckpt_file, ckpt_name, dict(metadata_to_save), force_sync_upload
+                )
+                return
+
             unwrapped_nw.save_weights(ckpt_file, save_dtype, metadata_to_save)
             if args.huggingface_repo_id is not None:
                 huggingface_util.upload(args, ckpt_file, "/" + ckpt_name, force_sync_upload=force_sync_upload)
 
+        # async_save: バックグラウンドでキャストとハッシュ計算、書き出しを行う / cast, hash and write in background
+        checkpointer = train_util.AsyncCheckpointer(args.async_save_max_in_flight) if args.async_save else None
+
+        def write_weights(state_dict, ckpt_file, ckpt_name, metadata_to_save, force_sync_upload):
+            # same as save_weights of the networks
+            if save_dtype is not None:
+                state_dict = {k: v.to(save_dtype) for k, v in state_dict.items()}
+            if os.path.splitext(ckpt_file)[1] == ".safetensors":
+                train_util.save_safetensors_with_hashes(state_dict, ckpt_file, metadata_to_save)
+            else:
+                torch.save(state_dict, ckpt_file)
+            print(f"\ncheckpoint saved: {ckpt_file}")
+
+            if args.huggingface_repo_id is not None:
+                huggingface_util.upload(args, ckpt_file, "/" + ckpt_name, force_sync_upload=force_sync_upload)
+
+        metric_accumulator = train_util.DeviceMetricAccumulator(args.metrics_flush_interval)
+
+        def flush_metrics():
+            for info, record in metric_accumulator.flush():
+                current_loss = record["loss"]
+                loss_recorder.add(epoch=info["epoch"], step=info["step"], loss=current_loss)
+                avr_loss: float = loss_recorder.moving_average
+                logs = {"avr_loss": avr_loss}  # , "lr": lr_scheduler.get_last_lr()[0]}
+                progress_bar.set_postfix(**{**record["postfix"], **logs})
+
+                if record["logs"] is not None:
+                    logs = record["logs"]
+                    logs["loss/current"] = current_loss
+                    logs["loss/average"] = avr_loss
+                    accelerator.log(logs, step=info["global_step"])
+
         def remove_model(old_ckpt_name):
+            if checkpointer is not None:
+                # 新しいチェックポイントの書き出し後に削除する / remove after the new checkpoint is written
+                checkpointer.submit(remove_model_now, old_ckpt_name)
+            else:
+                remove_model_now(old_ckpt_name)
+
+        def remove_model_now(old_ckpt_name):
             old_ckpt_file = os.path.join(args.output_dir, old_ckpt_name)
             if os.path.exists(old_ckpt_file):
-                accelerator.print(f"removing old checkpoint: {old_ckpt_file}")
+                print(f"removing old checkpoint: {old_ckpt_file}")
                 os.remove(old_ckpt_file)
 
         # For --sample_at_first
@@ -908,6 +1008,7 @@ class NetworkTrainer:
                     initial_step -= 1
                     continue
 
+                step_profiler.start_step(global_step)
                 with accelerator.accumulate(training_model):
                     on_step_start(text_encoder, unet)
 
@@ -916,13 +1017,18 @@ class NetworkTrainer:
                     else:
                         with torch.no_grad():
                             # latentに変換
-                            latents = vae.encode(batch["images"].to(dtype=vae_dtype)).latent_dist.sample().to(dtype=weight_dtype)
+                            images = batch["images"]
+                            if images.dtype == torch.uint8:
+                                # image_transforms_on_device: normalize, flip and color_aug on the device
+                                images = train_util.transform_images_on_device(images, batch["flippeds"], batch["color_augs"])
+                            latents = vae.encode(images.to(dtype=vae_dtype)).latent_dist.sample().to(dtype=weight_dtype)
 
                             # NaNが含まれていれば警告を表示し0に置き換える
                             if torch.any(torch.isnan(latents)):
                                 accelerator.print("NaN found in latents, replacing with zeros")
                                 latents = torch.nan_to_num(latents, 0, out=latents)
                     latents = latents * self.vae_scale_factor
+                    step_profiler.lap("latents")
 
                     # get multiplier for each sample
                     if network_has_multiplier:
@@ -931,7 +1037,9 @@ class NetworkTrainer:
                         if torch.all(multipliers == multipliers[0]):
                             multipliers = multipliers[0].item()
                         else:
-                            raise NotImplementedError("multipliers for each sample is not supported yet")
+                            # 各サンプルのmultiplierはnetworkの各moduleでbatch次元にbroadcastされる
+                            # the multiplier of each sample is broadcast over the batch dimension in each module of the network
+                            multipliers = multipliers.to(accelerator.device)
                         # print(f"set multiplier: {multipliers}")
                         accelerator.unwrap_model(network).set_multiplier(multipliers)
 
@@ -950,6 +1058,7 @@ class NetworkTrainer:
                             text_encoder_conds = self.get_text_cond(
                                 args, accelerator, batch, tokenizers, text_encoders, weight_dtype
                             )
+                    step_profiler.lap("get_text_cond")
 
                     # Sample noise, sample a random timestep for each image, and add noise to the latents,
                     # with noise offset and/or multires noise if specified
@@ -976,6 +1085,7 @@ class NetworkTrainer:
                             batch,
                             weight_dtype,
                         )
+                    step_profiler.lap("call_unet")
 
                     if args.v_parameterization:
                         # v-parameterization training
@@ -1003,6 +1113,7 @@ class NetworkTrainer:
                         loss = apply_debiased_estimation(loss, timesteps, noise_scheduler, args.v_parameterization)
 
                     loss = loss.mean()  # 平均なのでbatch_sizeで割る必要なし
+                    step_profiler.lap("loss")
 
                     accelerator.backward(loss)
                     if accelerator.sync_gradients:
@@ -1010,16 +1121,23 @@ class NetworkTrainer:
                         if args.max_grad_norm != 0.0:
                             params_to_clip = accelerator.unwrap_model(network).get_trainable_params()
                             accelerator.clip_grad_norm_(params_to_clip, args.max_grad_norm)
+                    step_profiler.lap("backward")
 
                     optimizer.step()
                     lr_scheduler.step()
                     optimizer.zero_grad(set_to_none=True)
+                    step_profiler.lap("optimizer_step")
+
+                    if network_has_multiplier:
+                        # サンプル画像の生成などではbatchが異なるので元に戻す / restore because the batch differs in sampling images etc.
+                        accelerator.unwrap_model(network).set_multiplier(network_multiplier)
 
                 if args.scale_weight_norms:
                     keys_scaled, mean_norm, maximum_norm = accelerator.unwrap_model(network).apply_max_norm_regularization(
                         args.scale_weight_norms, accelerator.device
                     )
                     max_mean_logs = {"Keys Scaled": keys_scaled, "Average key norm": mean_norm}
+                    step_profiler.lap("max_norm")
                 else:
                     keys_scaled, mean_norm, maximum_norm = None, None, None
 
@@ -1029,6 +1147,7 @@ class NetworkTrainer:
                     global_step += 1
 
                     self.sample_images(accelerator, args, None, global_step, accelerator.device, vae, tokenizer, text_encoder, unet)
+                    step_profiler.lap("sample_images")
 
                     # 指定ステップごとにモデルを保存
                     if args.save_every_n_steps is not None and global_step % args.save_every_n_steps == 0:
@@ -1038,35 +1157,54 @@ class NetworkTrainer:
                             save_model(ckpt_name, accelerator.unwrap_model(network), global_step, epoch)
 
                             if args.save_state:
-                                train_util.save_and_remove_state_stepwise(args, accelerator, global_step)
+                                train_util.save_and_remove_state_stepwise(args, accelerator, global_step, checkpointer)
 
                             remove_step_no = train_util.get_remove_step_no(args, global_step)
                             if remove_step_no is not None:
                                 remove_ckpt_name = train_util.get_step_ckpt_name(args, "." + args.save_model_as, remove_step_no)
                                 remove_model(remove_ckpt_name)
+                        step_profiler.lap("save")
 
-                current_loss = loss.detach().item()
-                loss_recorder.add(epoch=epoch, step=step, loss=current_loss)
-                avr_loss: float = loss_recorder.moving_average
-                logs = {"avr_loss": avr_loss}  # , "lr": lr_scheduler.get_last_lr()[0]}
-                progress_bar.set_postfix(**logs)
-
-                if args.scale_weight_norms:
-                    progress_bar.set_postfix(**{**max_mean_logs, **logs})
+                step_profiler.end_step()
 
+                # lossなどはデバイス上に貯めておき、metrics_flush_intervalごとにまとめて転送する
+                # keep loss etc. on the device and transfer them at once every metrics_flush_interval steps
+                step_logs = None
                 if args.logging_dir is not None:
-                    logs = self.generate_step_logs(
-                        args, current_loss, avr_loss, lr_scheduler, lr_descriptions, keys_scaled, mean_norm, maximum_norm
+                    # loss is filled in flush_metrics. lr is recorded here because it changes every step
+                    step_logs = self.generate_step_logs(
+                        args,
+                        None,
+                        None,
+                        lr_scheduler,
+                        lr_descriptions,
+                        keys_scaled,
+                        mean_norm,
+                        maximum_norm,
+                        step_profiler.get_logs() if args.profile_step_time else None,
                     )
-                    accelerator.log(logs, step=global_step)
+                metric_accumulator.add(
+                    {"epoch": epoch, "step": step, "global_step": global_step},
+                    {"loss": loss.detach(), "postfix": max_mean_logs if args.scale_weight_norms else {}, "logs": step_logs},
+                )
+                if metric_accumulator.is_full():
+                    flush_metrics()
 
                 if global_step >= args.max_train_steps:
                     break
 
+            flush_metrics()  # flush remaining metrics before logging epoch loss
+
             if args.logging_dir is not None:
                 logs = {"loss/epoch": loss_recorder.moving_average}
                 accelerator.log(logs, step=epoch + 1)
 
+            if dataset_stage_stats is not None:
+                # すべてのrankでリセットし、表示と記録はメインプロセスのみ / reset on every rank, print and log on the main process only
+                logs = dataset_stage_stats.report_and_reset(epoch + 1, accelerator.is_main_process)
+                if args.logging_dir is not None and accelerator.is_main_process:
+                    accelerator.log(logs, step=epoch + 1)
+
             accelerator.wait_for_everyone()
 
             # 指定エポックごとにモデルを保存
@@ -1091,9 +1229,17 @@ class NetworkTrainer:
         # metadata["ss_epoch"] = str(num_train_epochs)
         metadata["ss_training_finished_at"] = str(time.time())
 
+        if accelerator.is_main_process:
+            step_profiler.print_summary()
+            step_profiler.save_trace()  # in case training ended before the end of trace steps
+
         if is_main_process:
             network = accelerator.unwrap_model(network)
 
+        if checkpointer is not None:
+            # 書き出し中のチェックポイントを待つ / wait for checkpoints being written
+            checkpointer.shutdown()
+
         accelerator.end_training()
 
         if is_main_process and (args.save_state or args.save_state_on_train_end):
@@ -1227,6 +1373,76 @@ def setup_parser() -> argparse.ArgumentParser:
         help="initial step number including all epochs, 0 means first step (same as not specifying). overwrites initial_epoch."
         + " / 初期ステップ数、全エポックを含むステップ数、0で最初のステップ（未指定時と同じ）。initial_epochを上書きする",
     )
+    parser.add_argument(
+        "--model_hash_cache",
+        type=str,
+        default=None,
+        help="JSON file to cache hashes of base model and VAE for metadata, keyed by path, size, mtime and inode. can be shared by multiple runs"
+        + " / メタデータ用のベースモデルとVAEのハッシュをキャッシュするJSONファイル。パス、サイズ、更新日時、inodeをキーとする。複数の実行で共有できる",
+    )
+    parser.add_argument(
+        "--model_hash_in_background",
+        action="store_true",
+        help="calculate hashes of base model and VAE in a background thread while training starts / ベースモデルとVAEのハッシュを学習開始と並行してバックグラウンドで計算する",
+    )
+    parser.add_argument(
+        "--async_save",
+        action="store_true",
+        help="save checkpoints and step states in a background thread. network weights are copied to pinned CPU memory, then training continues"
+        + " / チェックポイントとステップごとのstateをバックグラウンドのスレッドで保存する。networkの重みをpinned memoryにコピーした後、学習を続ける",
+    )
+    parser.add_argument(
+        "--async_save_max_in_flight",
+        type=int,
+        default=1,
+        help="max number of checkpoints being saved in background at the same time, default is 1 / バックグラウンドで同時に保存中のチェックポイントの最大数、デフォルトは1",
+    )
+    parser.add_argument(
+        "--async_save_staging_dir",
+        type=str,
+        default=None,
+        help="local directory to save states temporarily before moving them to output_dir in background with async_save, default is system temp dir"
+        + " / async_save時にstateを一時的に保存するローカルディレクトリ、バックグラウンドでoutput_dirに移動する。デフォルトはシステムの一時ディレクトリ",
+    )
+    parser.add_argument(
+        "--metrics_flush_interval",
+        type=int,
+        default=1,
+        help="transfer loss and metrics from the device every N steps at once and update progress bar and trackers then. larger value avoids device sync every step"
+        + " / lossなどのメトリクスをNステップごとにまとめてデバイスから転送し、プログレスバーとログを更新する。大きくすると毎ステップのデバイス同期を避けられる",
+    )
+    parser.add_argument(
+        "--profile_step_time",
+        action="store_true",
+        help="measure time of each phase of training steps (dataloader wait, latents, text encoder, U-Net, loss, backward, optimizer, save) and log percentiles to trackers"
+        + " / 学習ステップの各フェーズ（dataloader待ち、latent、Text Encoder、U-Net、loss、backward、optimizer、保存）の時間を計測し、パーセンタイルをログに記録する",
+    )
+    parser.add_argument(
+        "--profile_trace_file",
+        type=str,
+        default=None,
+        help="save Chrome trace JSON of the step phases to this file (requires profile_step_time)"
+        + " / ステップの各フェーズのChromeトレースJSONをこのファイルに保存する（profile_step_timeが必要）",
+    )
+    parser.add_argument(
+        "--profile_trace_steps",
+        type=int,
+        nargs=2,
+        default=None,
+        help="start and end steps of Chrome trace, default is 10 20 / Chromeトレースの開始、終了ステップ、デフォルトは10 20",
+    )
+    parser.add_argument(
+        "--dataset_stage_stats",
+        action="store_true",
+        help="collect time and counters of each stage of dataset loading (decode, crop, augmentation, caption, tokenize, cache hits) in DataLoader workers and report them every epoch"
+        + " / DataLoaderのworkerでデータセット読み込みの各ステージ（デコード、crop、augmentation、caption、tokenize、キャッシュヒット）の時間とカウンタを集計し、エポックごとに表示する",
+    )
+    parser.add_argument(
+        "--image_transforms_on_device",
+        action="store_true",
+        help="return uint8 images from the dataset and apply normalization, flip_aug and color_aug on the training device (reduces CPU load and transfer size)"
+        + " / データセットからuint8の画像を返し、正規化、flip_aug、color_augを学習デバイス上で行う（CPU負荷と転送量を削減）",
+    )
     # parser.add_argument("--loraplus_lr_ratio", default=None, type=float, help="LoRA+ learning rate ratio")
     # parser.add_argument("--loraplus_unet_lr_ratio", default=None, type=float, help="LoRA+ UNet learning rate ratio")
     # parser.add_argument("--loraplus_text_encoder_lr_ratio", default=None, type=float, help="LoRA+ text encoder learning rate ratio")